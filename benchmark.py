@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+#
+# benchmark.py -- timings of pairing, reporting, standings and rendering
+# of the tournament for fields from 16 to 100000 players
+#
+
+import argparse
+import json
+import random
+import sys
+import threading
+from cStringIO import StringIO
+from timeit import default_timer
+
+import psycopg2.extensions
+
+import gen_and_run_html
+import tournament
+from pairing import preventRematch
+
+SIZES = (16, 128, 1024, 10000, 100000)
+# number of held rounds for each field
+ROUNDS = 3
+# drawLines() is timed for at most this many pairs of a round, it is
+# called once for each pair
+DRAW_SAMPLE = 1000
+# benchmarks faster than this (in seconds) are too noisy to compare
+MIN_TIME = 0.005
+# history and standings queries are timed over a tournament with this many
+# matches of this many players, written straight into 'matches' table
+QUERY_MATCHES = 1000000
+QUERY_PLAYERS = 20000
+# number of players whose history (and pairs checked for rematch) is read
+HISTORY_SAMPLE = 100
+# number of reads of standings timed by bench_prepared()
+STANDINGS_READS = 20
+# scorekeepers reporting at once in bench_contention(), and number of times
+# each result is reported (by scorekeepers of both players, and by retries)
+SCOREKEEPERS = 16
+REPORT_COPIES = 2
+
+
+class Timings(object):
+    """Sums of wall time of each benchmark, looks like {name: seconds}."""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def measure(self, name, function, *args):
+        """Calls function(*args) and adds its time to benchmark 'name'.
+
+        Returns:
+          what function returns
+        """
+        start = default_timer()
+        value = function(*args)
+        self.seconds[name] = (self.seconds.get(name, 0) +
+                              default_timer() - start)
+        return value
+
+
+def bench_size(players, rounds=ROUNDS, seed=0, backend='memory'):
+    """Holds a tournament of 'players' players for 'rounds' rounds with
+    seeded outcomes and times every step of each round.
+
+    Args:
+      players: number of players
+      rounds: number of rounds
+      seed: seed of outcomes
+      backend: 'memory' for in-memory engine, 'postgres' for a new
+               tournament in the tournament database, deleted afterwards
+    Returns:
+      dictionary {benchmark: seconds} for all rounds together
+    """
+    rng = random.Random(seed)
+    timings = Timings()
+    if backend == 'postgres':
+        tournament_id = tournament.createTournament("benchmark")
+    else:
+        tournament_id = tournament.DEFAULT_TOURNAMENT
+        tournament.useEngine(None, tournament_id)
+    try:
+        names = ["Player %d" % i for i in xrange(players)]
+        timings.measure('registerPlayers', tournament.registerPlayers,
+                        names, tournament_id)
+        standings = tournament.playerStandings(tournament_id)
+        positions = gen_and_run_html.gen_html(
+            [(player[0], player[1]) for player in standings])
+        played = tournament.playedPairs(tournament_id)
+        for t_round in xrange(1, rounds + 1):
+            pairs_list = timings.measure(
+                'swissPairings', tournament.swissPairings, tournament_id)
+            pairs_list = timings.measure(
+                'preventRematch', preventRematch, played, pairs_list)
+            played.update(pairs_list)
+            results = []
+            for id1, id2 in pairs_list.ids():
+                if id2 == 0:
+                    results.append((id1, None))
+                elif rng.randrange(2):
+                    results.append((id1, id2))
+                else:
+                    results.append((id2, id1))
+            timings.measure('reportRound', tournament.reportRound,
+                            t_round, results, tournament_id)
+            for winner_id, looser_id in results[:DRAW_SAMPLE]:
+                positions = timings.measure(
+                    'drawLines', gen_and_run_html.drawLines, winner_id,
+                    positions, t_round, looser_id)
+            col_detected, col_ids = timings.measure(
+                'check_collisions', gen_and_run_html.check_collisions,
+                positions)
+            positions = timings.measure(
+                'fix_collisions', gen_and_run_html.fix_collisions, None,
+                positions, col_ids, [], t_round)
+            positions = timings.measure(
+                'drawNames', gen_and_run_html.drawNames, positions, t_round)
+            timings.measure('playerStandings', tournament.playerStandings,
+                            tournament_id)
+    finally:
+        if backend == 'postgres':
+            tournament.deleteTournament(tournament_id)
+        else:
+            tournament.dropEngine(tournament_id)
+    return timings.seconds
+
+
+class PlanCursor(psycopg2.extensions.cursor):
+    """Cursor, which runs EXPLAIN ANALYZE of every SELECT before the SELECT
+    itself and keeps the plans, looks like [(query, plan),...]."""
+
+    plans = []
+
+    def execute(self, query, vars=None):
+        if _selects(query):
+            super(PlanCursor, self).execute(
+                "EXPLAIN (ANALYZE, BUFFERS) " + query, vars)
+            plan = "\n".join(row[0] for row in self.fetchall())
+            PlanCursor.plans.append((" ".join(query.split()), plan))
+        return super(PlanCursor, self).execute(query, vars)
+
+
+def _selects(query):
+    """Returns True for a SELECT, or EXECUTE of a prepared SELECT."""
+    words = query.split(None, 2)
+    if words and words[0].upper() == 'EXECUTE':
+        name = words[1].split('(')[0]
+        return tournament.PREPARED[name][1].lstrip().upper().startswith(
+            'SELECT')
+    return bool(words) and words[0].upper() == 'SELECT'
+
+
+class StatementCursor(psycopg2.extensions.cursor):
+    """Cursor, which counts its statements and sums their time."""
+
+    count = 0
+    seconds = 0.0
+
+    @classmethod
+    def reset(cls):
+        """Returns average time of a statement since the last reset."""
+        average = cls.seconds / cls.count if cls.count else 0.0
+        cls.count = 0
+        cls.seconds = 0.0
+        return average
+
+    def execute(self, query, vars=None):
+        start = default_timer()
+        try:
+            return super(StatementCursor, self).execute(query, vars)
+        finally:
+            StatementCursor.count += 1
+            StatementCursor.seconds += default_timer() - start
+
+
+def bench_prepared(players, seed=0):
+    """Times statements of the hot paths with and without prepared
+    statements: inserts of one round of 'players' players reported match
+    by match, and reads of its standings (the cache is off meanwhile).
+    Time of PREPARE is counted with the first execution.
+
+    Args:
+      players: number of players
+      seed: seed of pairs
+    Returns:
+      dictionary {benchmark: seconds per statement}, like
+      {'insertMatch': ..., 'insertMatchPrepared': ...,
+       'playerStandings': ..., 'playerStandingsPrepared': ...}
+    """
+    rng = random.Random(seed)
+    seconds = {}
+    use_prepared = tournament.USE_PREPARED
+    cache_rows = tournament.CACHE_ROWS
+    tournament.CACHE_ROWS = 0
+    try:
+        for prepared in (False, True):
+            tournament.USE_PREPARED = prepared
+            suffix = 'Prepared' if prepared else ''
+            # every run starts with new connections, which have nothing
+            # prepared yet:
+            tournament.closePools()
+            tournament_id = tournament.createTournament("benchmark")
+            try:
+                ids = tournament.registerPlayers(
+                    ["Player %d" % i for i in xrange(players)],
+                    tournament_id)
+                rng.shuffle(ids)
+                tournament.cursor_factory = StatementCursor
+                StatementCursor.reset()
+                for i in xrange(0, len(ids) - 1, 2):
+                    tournament.reportMatch(ids[i], ids[i + 1], 1,
+                                           tournament_id)
+                seconds['insertMatch' + suffix] = StatementCursor.reset()
+                for i in xrange(STANDINGS_READS):
+                    tournament.playerStandings(tournament_id)
+                seconds['playerStandings' + suffix] = \
+                    StatementCursor.reset()
+            finally:
+                tournament.cursor_factory = None
+                tournament.deleteTournament(tournament_id)
+    finally:
+        tournament.USE_PREPARED = use_prepared
+        tournament.CACHE_ROWS = cache_rows
+    return seconds
+
+
+def bench_contention(players, threads=SCOREKEEPERS, rounds=ROUNDS,
+                     copies=REPORT_COPIES, seed=0):
+    """Stress test of reporting: 'threads' scorekeepers report results of
+    'rounds' rounds of 'players' players with reportMatch() at the same
+    time. Each result is reported 'copies' times, and each round is also
+    reported whole with reportRound() in the middle of reports of its
+    matches. Reports of a round are mixed with reports of the next one, so
+    players of concurrent reports are often the same. Afterwards records
+    in standings are checked against records rebuilt from matches (rounds
+    overlap, so tie-breaks can't be), the tournament is deleted.
+
+    Args:
+      players: number of players
+      threads: number of scorekeepers, each with its own connection
+      rounds: number of rounds
+      copies: number of reports of each result
+      seed: seed of pairs and outcomes
+    Returns:
+      dictionary {benchmark: seconds}: 'reportMatch' is the average time
+      of one report (reportRound() included), 'reports' is wall time of
+      all of them
+    """
+    rng = random.Random(seed)
+    pool_size = tournament.POOL_SIZE
+    tournament.setPoolSize(threads)
+    tournament_id = tournament.createTournament("benchmark")
+    try:
+        ids = tournament.registerPlayers(
+            ["Player %d" % i for i in xrange(players)], tournament_id)
+        reports = []
+        for t_round in xrange(1, rounds + 1):
+            rng.shuffle(ids)
+            for i in xrange(0, len(ids) - 1, 2):
+                reports.extend([(t_round + rng.random() * 1.5, ids[i],
+                                 ids[i + 1], t_round)] * copies)
+            # the whole round, winner None stands for reportRound():
+            results = [(ids[i], ids[i + 1])
+                       for i in xrange(0, len(ids) - 1, 2)]
+            reports.append((t_round + rng.random() * 1.5, None, results,
+                            t_round))
+        # a report can come before the last reports of previous round:
+        reports.sort()
+        reports.reverse()
+        lock = threading.Lock()
+        seconds = [0.0]
+        errors = []
+
+        def scorekeeper():
+            while True:
+                with lock:
+                    if not reports or errors:
+                        return
+                    order, winner, loser, t_round = reports.pop()
+                start = default_timer()
+                try:
+                    if winner is None:
+                        tournament.reportRound(t_round, loser,
+                                               tournament_id)
+                    else:
+                        tournament.reportMatch(winner, loser, t_round,
+                                               tournament_id)
+                except Exception as e:
+                    errors.append(e)
+                with lock:
+                    seconds[0] += default_timer() - start
+
+        count = len(reports)
+        workers = [threading.Thread(target=scorekeeper)
+                   for i in xrange(threads)]
+        start = default_timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = default_timer() - start
+        if errors:
+            raise errors[0]
+        # reportMatch() doesn't update tie-breaks, so order of standings
+        # can change with the rebuild, records can't:
+        standings = sorted(tournament.playerStandings(tournament_id))
+        tournament.refreshStandings(tournament_id)
+        matches = sum(row[3] for row in standings) // 2
+        if sorted(tournament.playerStandings(tournament_id)) != standings \
+                or matches != rounds * (players // 2):
+            raise ValueError("standings differ from reported matches")
+    finally:
+        tournament.deleteTournament(tournament_id)
+        tournament.setPoolSize(pool_size)
+    return {'reportMatch': seconds[0] / count, 'reports': elapsed}
+
+
+def _loadMatches(tournament_id, ids, matches, rng):
+    """Writes random rounds of the players with one COPY, until there are
+    'matches' matches, and refreshes standings and statistics after it."""
+    data = StringIO()
+    players = list(ids)
+    t_round = 0
+    written = 0
+    while written < matches:
+        t_round += 1
+        rng.shuffle(players)
+        for i in xrange(0, min(len(players) - 1, 2 * (matches - written)),
+                        2):
+            pair = players[i:i + 2]
+            if rng.randrange(2):
+                pair.reverse()
+            data.write("%d\t%d\t%d\t%d\n" % (tournament_id, t_round,
+                                             pair[0], pair[1]))
+            written += 1
+    data.seek(0)
+    with tournament.dbCursor() as (db, cur):
+        query = """COPY matches (tournament_id, round, winner_id, looser_id)
+                   FROM STDIN;"""
+        cur.copy_expert(query, data)
+    with tournament.dbCursor() as (db, cur):
+        cur.execute("ANALYZE matches;")
+        cur.execute("ANALYZE standings;")
+    # matches were written around the functions of tournament.py:
+    tournament.invalidateCache(tournament_id)
+
+
+def bench_queries(matches=QUERY_MATCHES, players=QUERY_PLAYERS, seed=0,
+                  log=None):
+    """Times standings and history queries over a tournament with 'matches'
+    matches in the tournament database, the tournament is deleted
+    afterwards.
+
+    Args:
+      matches: number of matches
+      players: number of players
+      seed: seed of pairs and outcomes
+      log: file, where plans of the queries are written, None to skip
+           EXPLAIN
+    Returns:
+      dictionary {benchmark: seconds}
+    """
+    rng = random.Random(seed)
+    timings = Timings()
+    tournament_id = tournament.createTournament("benchmark")
+    try:
+        ids = tournament.registerPlayers(
+            ["Player %d" % i for i in xrange(players)], tournament_id)
+        timings.measure('loadMatches', _loadMatches, tournament_id, ids,
+                        matches, rng)
+        timings.measure('refreshStandings', tournament.refreshStandings,
+                        tournament_id)
+        standings = timings.measure('playerStandings',
+                                    tournament.playerStandings, tournament_id)
+        timings.measure('topStandings', tournament.topStandings, 10,
+                        tournament_id)
+        timings.measure('standingsPage', tournament.standingsPage,
+                        standings[players // 2], 100, tournament_id)
+        sample = rng.sample(ids, HISTORY_SAMPLE)
+        for player_id in sample:
+            timings.measure('playerHistory', tournament.playerHistory,
+                            player_id, tournament_id)
+        for player_id in sample:
+            timings.measure('havePlayed', tournament.havePlayed, player_id,
+                            rng.choice(ids), tournament_id)
+        if log is not None:
+            del PlanCursor.plans[:]
+            # standings read above are cached, they are read again:
+            tournament.invalidateCache(tournament_id)
+            tournament.cursor_factory = PlanCursor
+            try:
+                tournament.playerStandings(tournament_id)
+                tournament.topStandings(10, tournament_id)
+                tournament.playerHistory(sample[0], tournament_id)
+                tournament.havePlayed(sample[0], sample[1], tournament_id)
+            finally:
+                tournament.cursor_factory = None
+            for query, plan in PlanCursor.plans:
+                log.write("%s\n%s\n\n" % (query, plan))
+    finally:
+        tournament.deleteTournament(tournament_id)
+    return timings.seconds
+
+
+def run(sizes=SIZES, rounds=ROUNDS, seed=0, backend='memory', log=None):
+    """Runs benchmarks for all sizes.
+
+    Returns:
+      report: dictionary, which can be saved as JSON, looks like
+      {'backend': ..., 'rounds': ..., 'seed': ...,
+       'results': {'16': {'swissPairings': seconds,...},...}}
+    """
+    report = {'backend': backend, 'rounds': rounds, 'seed': seed,
+              'results': {}}
+    for players in sizes:
+        seconds = bench_size(players, rounds, seed, backend)
+        report['results'][str(players)] = seconds
+        if log is not None:
+            for name in sorted(seconds):
+                log.write("%7d %-18s %9.4f s\n" % (players, name,
+                                                   seconds[name]))
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Finds benchmarks which got slower than in the baseline.
+
+    Args:
+      report: report of run()
+      baseline: stored report of run() for the same backend, rounds and
+                seed
+      tolerance: allowed slowdown, 0.2 is 20%
+    Returns:
+      list of tuples (players or matches, benchmark, baseline seconds,
+      seconds)
+    Raises:
+      ValueError if the baseline was run with other backend, rounds or
+      seed, its timings aren't comparable
+    """
+    for setting in ('backend', 'rounds', 'seed'):
+        if report.get(setting) != baseline.get(setting):
+            raise ValueError("baseline was run with %s %s, not %s" %
+                             (setting, baseline.get(setting),
+                              report.get(setting)))
+    regressions = []
+    # 'queries' are keyed by number of matches, not players
+    for section in ('results', 'queries', 'prepared', 'contention'):
+        for size, seconds in sorted(report.get(section, {}).items(),
+                                    key=lambda item: int(item[0])):
+            old = baseline.get(section, {}).get(size, {})
+            for name in sorted(seconds):
+                if name not in old or \
+                        max(old[name], seconds[name]) < MIN_TIME:
+                    continue
+                if seconds[name] > old[name] * (1 + tolerance):
+                    regressions.append((int(size), name, old[name],
+                                        seconds[name]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks pairing, reporting, standings and "
+                    "rendering of a tournament.")
+    parser.add_argument('-s', '--sizes', type=int, nargs='*', default=SIZES,
+                        help="numbers of players")
+    parser.add_argument('-r', '--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-b', '--backend', choices=('memory', 'postgres'),
+                        default='memory')
+    parser.add_argument('-o', '--output', help="write results as JSON")
+    parser.add_argument('--baseline', help="compare with stored results")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against baseline")
+    parser.add_argument('-m', '--matches', type=int, nargs='?',
+                        const=QUERY_MATCHES, default=0,
+                        help="also time standings and history queries of "
+                             "the tournament database over this many "
+                             "matches (%d if not given)" % QUERY_MATCHES)
+    parser.add_argument('--players', type=int, default=QUERY_PLAYERS,
+                        help="number of players for --matches")
+    parser.add_argument('--explain', action='store_true',
+                        help="print plans of queries timed by --matches")
+    parser.add_argument('-p', '--prepared', action='store_true',
+                        help="time statements of the tournament database "
+                             "with and without prepared statements, for "
+                             "a round of each size")
+    parser.add_argument('-c', '--contention', type=int, nargs='?',
+                        const=SCOREKEEPERS, default=0,
+                        help="stress test of this many scorekeepers (%d "
+                             "if not given) reporting rounds of each size "
+                             "at once" % SCOREKEEPERS)
+    args = parser.parse_args()
+    report = run(args.sizes, args.rounds, args.seed, args.backend,
+                 sys.stdout)
+    if args.matches:
+        seconds = bench_queries(args.matches, args.players, args.seed,
+                                sys.stdout if args.explain else None)
+        report['queries'] = {str(args.matches): seconds}
+        for name in sorted(seconds):
+            print "%7d %-18s %9.4f s" % (args.matches, name, seconds[name])
+    if args.prepared:
+        report['prepared'] = {}
+        for players in args.sizes:
+            seconds = bench_prepared(players, args.seed)
+            report['prepared'][str(players)] = seconds
+            for name in sorted(seconds):
+                print "%7d %-24s %9.6f s" % (players, name, seconds[name])
+    if args.contention:
+        report['contention'] = {}
+        for players in args.sizes:
+            seconds = bench_contention(players, args.contention,
+                                       args.rounds, REPORT_COPIES,
+                                       args.seed)
+            report['contention'][str(players)] = seconds
+            print "%7d %d scorekeepers: %.4f s per report, %.0f reports/s" \
+                % (players, args.contention, seconds['reportMatch'],
+                   (REPORT_COPIES * (players // 2) + 1) * args.rounds /
+                   seconds['reports'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare(report, baseline, args.tolerance)
+        except ValueError as error:
+            parser.error(str(error))
+        for players, name, old, new in regressions:
+            print "REGRESSION %d %s: %.4f s -> %.4f s" % (players, name,
+                                                          old, new)
+        if regressions:
+            sys.exit(1)
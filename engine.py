@@ -0,0 +1,707 @@
+#!/usr/bin/env python
+#
+# engine.py -- in-memory state of a Swiss-system tournament, with pluggable
+# storage for its players and results
+#
+
+import threading
+import sqlite3
+import multiprocessing
+import pickle
+from array import array
+from itertools import izip
+from decimal import Decimal
+from Queue import Queue
+from multiprocessing.queues import SimpleQueue
+
+import pairing
+from pairing import PlayedPairs
+
+# percentages are rounded like ROUND(x, 6) of tournament.sql, they are
+# computed as integer numbers of millionths
+MILLION = 10 ** 6
+# 1/3 rounded to millionths
+THIRD = 333333
+
+
+def _divide(numerator, denominator):
+    """Returns numerator / denominator rounded half up, for positive
+    numbers."""
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+class ReportedResults(object):
+    """Index of results of known rounds, the same rule as unique indexes of
+    tournament.sql: a pair plays once in a round, a player gets one free win
+    in it. Round 0 is an unknown round, its results aren't indexed."""
+
+    def __init__(self, matches=()):
+        """
+        Args:
+          matches: recorded matches, [(round, winner_id, looser_id),...],
+                   looser_id is None or 0 for a free win
+        """
+        # winners, looks like {(round, smaller id, bigger id): winner_id},
+        # smaller id is 0 for a free win
+        self._winners = {}
+        for t_round, winner_id, looser_id in matches:
+            self.add(t_round, winner_id, looser_id)
+
+    def add(self, t_round, winner_id, looser_id):
+        if t_round:
+            looser_id = looser_id or 0
+            self._winners[(t_round, min(winner_id, looser_id),
+                           max(winner_id, looser_id))] = winner_id
+
+    def new_results(self, t_round, results):
+        """Returns results, which aren't recorded yet: a result reported
+        again is left out.
+
+        Raises:
+          ValueError if a result differs from the one recorded in the round
+        """
+        if not t_round:
+            return results
+        new = []
+        for winner_id, looser_id in results:
+            other = looser_id or 0
+            recorded = self._winners.get((t_round, min(winner_id, other),
+                                          max(winner_id, other)))
+            if recorded is None:
+                new.append((winner_id, looser_id))
+            elif recorded != winner_id:
+                raise ValueError("result of %s and %s in round %s differs "
+                                 "from the reported one" % (
+                                     winner_id, looser_id, t_round))
+        return new
+
+
+class TournamentState(object):
+    """Players, their records and played pairs of one tournament, kept in
+    memory.
+
+    Records are parallel arrays, indexed by the place of the player in
+    registration order, matches are parallel arrays too. Every write is
+    passed to the storage, reads never touch it, so the state works at
+    memory speed with or without a database behind it.
+    """
+
+    def __init__(self, storage=None, tournament_id=1):
+        """
+        Args:
+          storage: NullStorage (default), SqliteStorage, PostgresStorage
+                   (from tournament.py) or AsyncStorage around any of them,
+                   players and matches already stored there are loaded
+          tournament_id: id of the tournament in the storage
+        """
+        self.storage = storage or NullStorage()
+        self.tournament_id = tournament_id
+        self.ids = array('l')
+        self.names = []
+        self.wins = array('l')
+        self.matches = array('l')
+        self.byes = array('l')
+        # place of each player in the arrays, looks like {id: place}
+        self._places = {}
+        # all matches, looser is 0 for a free win:
+        self.rounds = array('l')
+        self.winners = array('l')
+        self.loosers = array('l')
+        # index of played pairs, built from the matches when it's first
+        # needed (standings don't need it), see 'played'
+        self._played = None
+        # index of results of rounds, built with the first report, see
+        # 'reported'
+        self._reported = None
+        # cached standings and tie-breaks, dropped by every write
+        self._standings = None
+        self._tie_breaks = None
+        players, matches = self.storage.load(tournament_id)
+        for player_id, name in players:
+            self._add_player(player_id, name)
+        self._add_matches(matches)
+
+    def _add_player(self, player_id, name):
+        self._places[player_id] = len(self.ids)
+        self.ids.append(player_id)
+        self.names.append(name)
+        self.wins.append(0)
+        self.matches.append(0)
+        self.byes.append(0)
+        self._standings = None
+
+    def _add_match(self, t_round, winner_id, looser_id):
+        winner = self._places[winner_id]
+        self.wins[winner] += 1
+        self.matches[winner] += 1
+        if looser_id:
+            self.matches[self._places[looser_id]] += 1
+        else:
+            self.byes[winner] += 1
+        self.rounds.append(t_round)
+        self.winners.append(winner_id)
+        self.loosers.append(looser_id or 0)
+        if self._played is not None:
+            self._played.add(winner_id, looser_id or 0)
+        if self._reported is not None:
+            self._reported.add(t_round, winner_id, looser_id)
+        self._standings = None
+
+    def _add_matches(self, matches):
+        """_add_match() of all matches loaded from the storage, with the
+        lookups taken out of the loop."""
+        places = self._places
+        wins = self.wins
+        played = self.matches
+        byes = self.byes
+        winners = array('l')
+        loosers = array('l')
+        for t_round, winner_id, looser_id in matches:
+            self.rounds.append(t_round)
+            winner = places[winner_id]
+            wins[winner] += 1
+            played[winner] += 1
+            if looser_id:
+                played[places[looser_id]] += 1
+            else:
+                byes[winner] += 1
+                looser_id = 0
+            winners.append(winner_id)
+            loosers.append(looser_id)
+        self.winners.extend(winners)
+        self.loosers.extend(loosers)
+        self._played = None
+        self._reported = None
+        self._standings = None
+
+    @property
+    def played(self):
+        """PlayedPairs index of all pairs who met, free wins included."""
+        if self._played is None:
+            self._played = PlayedPairs.from_matches(izip(self.winners,
+                                                         self.loosers))
+        return self._played
+
+    @property
+    def reported(self):
+        """ReportedResults index of all matches."""
+        if self._reported is None:
+            self._reported = ReportedResults(izip(self.rounds, self.winners,
+                                                  self.loosers))
+        return self._reported
+
+    def _check(self, t_round, results):
+        """Raises ValueError if a player of results isn't registered or
+        plays twice, or if a result differs from the one already recorded
+        in the round.
+
+        Returns:
+          results, which aren't recorded yet
+        """
+        players = []
+        for winner_id, looser_id in results:
+            players.append(winner_id)
+            if looser_id:
+                players.append(looser_id)
+        if len(set(players)) != len(players):
+            raise ValueError("player can't play twice in one round")
+        for player_id in players:
+            if player_id not in self._places:
+                raise ValueError("player %s isn't registered" % player_id)
+        return self.reported.new_results(t_round, results)
+
+    def count_players(self):
+        return len(self.ids)
+
+    def register_players(self, names):
+        """Adds players, ids are given by the storage.
+
+        Returns:
+          list of ids of the new players, in the same order as names
+        """
+        names = list(names)
+        if not names:
+            return []
+        ids = self.storage.register_players(self.tournament_id, names)
+        for player_id, name in zip(ids, names):
+            self._add_player(player_id, name)
+        return ids
+
+    def register_player(self, name):
+        return self.register_players([name])[0]
+
+    def report_match(self, winner_id, looser_id, t_round=0):
+        """Records one match, looser_id is None for a free win. A result
+        already recorded in the round isn't recorded again."""
+        if not self._check(t_round, [(winner_id, looser_id)]):
+            return
+        self.storage.report_match(self.tournament_id, t_round, winner_id,
+                                  looser_id)
+        self._add_match(t_round, winner_id, looser_id)
+
+    def report_round(self, t_round, results):
+        """Records all matches of one round, results already recorded in
+        the round are left out.
+
+        Args:
+          t_round: current round
+          results: list of tuples (winner_id, looser_id), looser_id is None
+                   for a free win
+        """
+        results = self._check(t_round, list(results))
+        if not results:
+            return
+        self.storage.report_round(self.tournament_id, t_round, results)
+        for winner_id, looser_id in results:
+            self._add_match(t_round, winner_id, looser_id)
+
+    def report_pairs(self, t_round, pairs):
+        """Passes pairs of the round, [(id1, id2),...] with 0 for BYE, to
+        the storage, for storages which keep a record of pairings."""
+        self.storage.report_pairs(self.tournament_id, t_round, pairs)
+
+    def delete_matches(self):
+        self.storage.delete_matches(self.tournament_id)
+        self._clear_matches()
+
+    def _clear_matches(self):
+        for place in xrange(len(self.ids)):
+            self.wins[place] = self.matches[place] = self.byes[place] = 0
+        self.rounds = array('l')
+        self.winners = array('l')
+        self.loosers = array('l')
+        self._played = PlayedPairs()
+        self._reported = ReportedResults()
+        self._standings = None
+
+    def delete_players(self):
+        self.storage.delete_players(self.tournament_id)
+        self._clear_matches()
+        self.ids = array('l')
+        self.names = []
+        self.wins = array('l')
+        self.matches = array('l')
+        self.byes = array('l')
+        self._places = {}
+
+    def save_checkpoint(self, t_round, rounds, random_state):
+        """Passes checkpoint of a completed round (see
+        tournament.saveCheckpoint()) to the storage, which writes it after
+        results of the round."""
+        self.storage.save_checkpoint(self.tournament_id, t_round, rounds,
+                                     random_state)
+
+    def flush(self):
+        """Waits until the storage has written everything."""
+        self.storage.flush()
+
+    def _compute(self):
+        """Computes tie-breaks of all players from all matches, the same
+        way as tournament.sql does (percentages in millionths, rounded
+        like its numeric columns), and sorts the standings."""
+        size = len(self.ids)
+        pct = [max(THIRD, _divide(MILLION * self.wins[place],
+                                  self.matches[place]))
+               if self.matches[place] else 0 for place in xrange(size)]
+        buchholz = [0] * size
+        opponent_wins = [0] * size
+        omw_total = [0] * size
+        opponents = [0] * size
+        places = self._places
+        wins = self.wins
+        real_wins = [wins[place] - self.byes[place] for place in xrange(size)]
+        # both players of a match add the record of the other one:
+        for winner_id, looser_id in izip(self.winners, self.loosers):
+            if not looser_id:
+                continue
+            winner = places[winner_id]
+            looser = places[looser_id]
+            buchholz[winner] += wins[looser]
+            buchholz[looser] += wins[winner]
+            opponent_wins[winner] += real_wins[looser]
+            opponent_wins[looser] += real_wins[winner]
+            omw_total[winner] += pct[looser]
+            omw_total[looser] += pct[winner]
+            opponents[winner] += 1
+            opponents[looser] += 1
+        omw = [_divide(omw_total[place], opponents[place])
+               if opponents[place] else 0 for place in xrange(size)]
+        # same order as STANDINGS_ORDER of tournament.py:
+        order = sorted(xrange(size), key=lambda place: (
+            -self.wins[place], -buchholz[place], -omw[place],
+            -opponent_wins[place], -self.ids[place]))
+        self._standings = [(self.ids[place], self.names[place],
+                            self.wins[place], self.matches[place])
+                           for place in order]
+        self._tie_breaks = [(self.ids[place], self.wins[place],
+                             buchholz[place], omw[place],
+                             opponent_wins[place]) for place in order]
+
+    def standings(self):
+        """Returns a list of tuples (id, name, wins, matches), in the same
+        order as playerStandings() of tournament.py."""
+        if self._standings is None:
+            self._compute()
+        return list(self._standings)
+
+    def tie_breaks(self):
+        """Returns a list of tuples (id, wins, buchholz, omw, opponent_wins)
+        in the order of standings."""
+        if self._standings is None:
+            self._compute()
+        # omw is given as decimal, like numeric column of the database:
+        return [(player_id, wins, buchholz, Decimal(omw).scaleb(-6),
+                 opponent_wins)
+                for player_id, wins, buchholz, omw, opponent_wins
+                in self._tie_breaks]
+
+    def standings_page(self, after=None, limit=100):
+        """Returns players of standings placed after the given row."""
+        standings = self.standings()
+        start = 0
+        if after is not None:
+            ids = [player[0] for player in standings]
+            start = ids.index(after[0]) + 1
+        return standings[start:start + limit]
+
+    def matches_results(self):
+        """Returns a list of tuples (round, winner_id, winner_name,
+        looser_id, looser_name), looser is None for a free win."""
+        names = self.names
+        places = self._places
+        return [(t_round, winner_id, names[places[winner_id]],
+                 looser_id or None,
+                 names[places[looser_id]] if looser_id else None)
+                for t_round, winner_id, looser_id in
+                zip(self.rounds, self.winners, self.loosers)]
+
+    def player_history(self, player_id):
+        """Returns matches of the player in order of rounds, a list of
+        tuples (round, opponent_id, opponent_name, won), opponent is None
+        for a free win."""
+        history = []
+        for t_round, winner_id, looser_id in zip(self.rounds, self.winners,
+                                                 self.loosers):
+            if winner_id == player_id:
+                opponent_id, won = looser_id, True
+            elif looser_id == player_id:
+                opponent_id, won = winner_id, False
+            else:
+                continue
+            if opponent_id:
+                name = self.names[self._places[opponent_id]]
+                history.append((t_round, opponent_id, name, won))
+            else:
+                history.append((t_round, None, None, won))
+        history.sort(key=lambda match: match[0])
+        return history
+
+    def have_played(self, id1, id2):
+        # free wins are not pairs, like in tournament.havePlayed()
+        return bool(id1 and id2) and self.played.played(id1, id2)
+
+    def swiss_pairings(self):
+        return pairing.swiss_pairs(iter(self.standings()))
+
+    def matched_pairings(self, played=None):
+        if played is None:
+            played = self.played
+        return pairing.matched_pairings(self.standings(), played)
+
+
+class NullStorage(object):
+    """Storage which keeps nothing, the state lives only in memory. Ids of
+    players are given by a counter."""
+
+    def __init__(self, first_id=1):
+        self._next_id = first_id
+        self._lock = threading.Lock()
+
+    def load(self, tournament_id):
+        """Returns players [(id, name),...] and matches
+        [(round, winner_id, looser_id),...] of the tournament."""
+        return [], []
+
+    def register_players(self, tournament_id, names):
+        with self._lock:
+            first = self._next_id
+            self._next_id += len(names)
+        return range(first, first + len(names))
+
+    def report_match(self, tournament_id, t_round, winner_id, looser_id):
+        pass
+
+    def report_round(self, tournament_id, t_round, results):
+        pass
+
+    def report_pairs(self, tournament_id, t_round, pairs):
+        pass
+
+    def delete_matches(self, tournament_id):
+        pass
+
+    def delete_players(self, tournament_id):
+        pass
+
+    def save_checkpoint(self, tournament_id, t_round, rounds, random_state):
+        pass
+
+    def flush(self):
+        pass
+
+
+class SqliteStorage(object):
+    """Storage in a SQLite database, a file or ':memory:'. Tables are
+    created if they don't exist, each write is one transaction."""
+
+    def __init__(self, filename=':memory:'):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS players(
+                               id            INTEGER PRIMARY KEY,
+                               tournament_id INTEGER NOT NULL,
+                               name          TEXT NOT NULL);""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS matches(
+                               tournament_id INTEGER NOT NULL,
+                               round         INTEGER NOT NULL,
+                               winner_id     INTEGER NOT NULL,
+                               looser_id     INTEGER);""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS matches_tournament
+                               ON matches (tournament_id, round);""")
+
+    def load(self, tournament_id):
+        with self._lock:
+            players = self.db.execute(
+                """SELECT id, name FROM players WHERE tournament_id = ?
+                   ORDER BY id;""", (tournament_id,)).fetchall()
+            matches = self.db.execute(
+                """SELECT round, winner_id, looser_id FROM matches
+                   WHERE tournament_id = ? ORDER BY rowid;""",
+                (tournament_id,)).fetchall()
+        return players, matches
+
+    def register_players(self, tournament_id, names):
+        ids = []
+        with self._lock, self.db:
+            for name in names:
+                cur = self.db.execute(
+                    "INSERT INTO players (tournament_id, name) VALUES (?, ?);",
+                    (tournament_id, name))
+                ids.append(cur.lastrowid)
+        return ids
+
+    def report_match(self, tournament_id, t_round, winner_id, looser_id):
+        self.report_round(tournament_id, t_round, [(winner_id, looser_id)])
+
+    def report_round(self, tournament_id, t_round, results):
+        with self._lock, self.db:
+            self.db.executemany(
+                """INSERT INTO matches (tournament_id, round, winner_id,
+                   looser_id) VALUES (?, ?, ?, ?);""",
+                [(tournament_id, t_round, winner_id, looser_id)
+                 for winner_id, looser_id in results])
+
+    def report_pairs(self, tournament_id, t_round, pairs):
+        pass
+
+    def delete_matches(self, tournament_id):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM matches WHERE tournament_id = ?;",
+                            (tournament_id,))
+
+    def delete_players(self, tournament_id):
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM matches WHERE tournament_id = ?;",
+                            (tournament_id,))
+            self.db.execute("DELETE FROM players WHERE tournament_id = ?;",
+                            (tournament_id,))
+
+    def save_checkpoint(self, tournament_id, t_round, rounds, random_state):
+        # checkpoints are resumed only from the tournament database
+        pass
+
+    def flush(self):
+        pass
+
+
+class Worker(object):
+    """Background thread, which runs submitted tasks one by one in the
+    order they were submitted. After a task fails the rest are skipped,
+    its error is raised by the next wait().
+    """
+
+    def __init__(self):
+        self._queue = Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            function, args = task
+            try:
+                if self._error is None:
+                    function(*args)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def submit(self, function, *args):
+        """Queues function(*args), returns at once."""
+        self._queue.put((function, args))
+
+    def wait(self):
+        """Waits until all submitted tasks are done."""
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """Waits for submitted tasks and stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+        self.wait()
+
+
+def _serve(tasks, errors, initializer, finalizer):
+    """Loop of the process of ProcessWorker."""
+    if initializer is not None:
+        initializer()
+    failed = False
+    try:
+        while True:
+            task = tasks.get()
+            try:
+                if task is None:
+                    return
+                function, args = task
+                if function is None:
+                    # the error was raised by wait(), tasks run again
+                    failed = False
+                elif not failed:
+                    function(*args)
+            except Exception as error:
+                failed = True
+                try:
+                    pickle.dumps(error)
+                except Exception:
+                    error = RuntimeError(repr(error))
+                errors.put(error)
+            finally:
+                tasks.task_done()
+    finally:
+        if finalizer is not None:
+            finalizer()
+
+
+class ProcessWorker(object):
+    """Worker, which runs tasks in a child process, so they don't compete
+    with the caller for the interpreter lock. The child is forked when the
+    worker is made and has its own copy of everything the caller had then.
+    Tasks are module-level functions with picklable arguments, their
+    results are dropped.
+    """
+
+    def __init__(self, initializer=None, finalizer=None):
+        """
+        Args:
+          initializer: function called in the child before the first task
+          finalizer: function called in the child when it stops
+        """
+        self._tasks = multiprocessing.JoinableQueue()
+        # errors are sent before the task is done, so wait() sees them:
+        self._errors = SimpleQueue()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(self._tasks, self._errors, initializer, finalizer))
+        self._process.daemon = True
+        self._process.start()
+
+    def submit(self, function, *args):
+        """Queues function(*args), returns at once."""
+        self._tasks.put((function, args))
+
+    def wait(self):
+        """Waits until all submitted tasks are done."""
+        self._tasks.join()
+        if not self._errors.empty():
+            error = self._errors.get()
+            self._tasks.put((None, ()))
+            raise error
+
+    def close(self):
+        """Waits for submitted tasks and stops the process."""
+        self._tasks.put(None)
+        self._process.join()
+        self.wait()
+
+
+def _call(storage, method, args):
+    getattr(storage, method)(*args)
+
+
+class AsyncStorage(object):
+    """Wraps another storage and writes results to it from a background
+    thread, in the order they were reported, so reporting doesn't wait for
+    the database. Loading and registration wait for all queued writes,
+    because they need the answer of the storage. An error of a background
+    write is raised by the next flush().
+    """
+
+    def __init__(self, storage, worker=None):
+        """
+        Args:
+          storage: storage, which does the writes
+          worker: Worker (default) or ProcessWorker, which runs them; with
+                  ProcessWorker the storage must be picklable
+        """
+        self.storage = storage
+        self._worker = worker or Worker()
+
+    def flush(self):
+        """Waits until all queued writes are done."""
+        try:
+            self._worker.wait()
+        finally:
+            self.storage.flush()
+
+    def close(self):
+        """Waits for queued writes and stops the worker."""
+        try:
+            self._worker.close()
+        finally:
+            self.storage.flush()
+
+    def load(self, tournament_id):
+        self.flush()
+        return self.storage.load(tournament_id)
+
+    def register_players(self, tournament_id, names):
+        self.flush()
+        return self.storage.register_players(tournament_id, names)
+
+    def report_match(self, *args):
+        self._worker.submit(_call, self.storage, 'report_match', args)
+
+    def report_round(self, *args):
+        self._worker.submit(_call, self.storage, 'report_round', args)
+
+    def report_pairs(self, *args):
+        self._worker.submit(_call, self.storage, 'report_pairs', args)
+
+    def delete_matches(self, *args):
+        self._worker.submit(_call, self.storage, 'delete_matches', args)
+
+    def delete_players(self, *args):
+        self._worker.submit(_call, self.storage, 'delete_players', args)
+
+    def save_checkpoint(self, *args):
+        self._worker.submit(_call, self.storage, 'save_checkpoint', args)
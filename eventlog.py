@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+#
+# eventlog.py -- append-only log of events of tournaments (registrations,
+# pairings, results and byes) with snapshots, and replay of it
+#
+
+import os
+import json
+import pickle
+import argparse
+import threading
+from array import array
+from itertools import izip
+
+from engine import TournamentState, NullStorage, ReportedResults
+
+# events are written through a buffer of this many bytes
+BUFFER_SIZE = 64 * 1024
+# the log is synced to disk once per this many events (and by flush()), so
+# a crash loses at most the events of the last batch which weren't flushed
+SYNC_EVENTS = 100
+# snapshot of all tournaments of the log is taken after this many rounds
+SNAPSHOT_ROUNDS = 5
+
+
+class LogState(object):
+    """Players and matches of one tournament, as they are after the events
+    read so far: parallel arrays, looser is 0 for a free win."""
+
+    __slots__ = ('ids', 'names', 'rounds', 'winners', 'loosers',
+                 '_reported')
+
+    def __init__(self):
+        self.ids = array('l')
+        self.names = []
+        self.rounds = array('l')
+        self.winners = array('l')
+        self.loosers = array('l')
+        # engine.ReportedResults of the matches, built when a result is
+        # written, it isn't a part of snapshots
+        self._reported = None
+
+    def add_players(self, ids, names):
+        self.ids.extend(ids)
+        self.names.extend(names)
+
+    def add_results(self, t_round, results):
+        for winner_id, looser_id in results:
+            self.rounds.append(t_round)
+            self.winners.append(winner_id)
+            self.loosers.append(looser_id or 0)
+            if self._reported is not None:
+                self._reported.add(t_round, winner_id, looser_id)
+
+    def new_results(self, t_round, results):
+        """Returns results, which aren't in the log yet, raises ValueError
+        if one differs from the logged one (see engine.ReportedResults)."""
+        if self._reported is None:
+            self._reported = ReportedResults(izip(self.rounds, self.winners,
+                                                  self.loosers))
+        return self._reported.new_results(t_round, results)
+
+    def clear_matches(self):
+        self.rounds = array('l')
+        self.winners = array('l')
+        self.loosers = array('l')
+        self._reported = None
+
+    def players(self):
+        """Returns players like storages load them, [(id, name),...]."""
+        return zip(self.ids, self.names)
+
+    def matches(self, last_round=None):
+        """Returns matches like storages load them,
+        [(round, winner_id, looser_id),...], only of rounds up to
+        last_round if it is given."""
+        return [(t_round, winner_id, looser_id or None)
+                for t_round, winner_id, looser_id
+                in izip(self.rounds, self.winners, self.loosers)
+                if last_round is None or t_round <= last_round]
+
+    def __getstate__(self):
+        # arrays are pickled as bytes, not as lists of numbers
+        return (self.ids.tostring(), self.names, self.rounds.tostring(),
+                self.winners.tostring(), self.loosers.tostring())
+
+    def __setstate__(self, state):
+        ids, self.names, rounds, winners, loosers = state
+        self.ids = array('l', ids)
+        self.rounds = array('l', rounds)
+        self.winners = array('l', winners)
+        self.loosers = array('l', loosers)
+        self._reported = None
+
+
+def _apply(tournaments, event):
+    """Changes states of tournaments, looks like {id: LogState}, by one
+    event."""
+    tournament_id = event['tournament']
+    kind = event['event']
+    if kind == 'delete_players':
+        tournaments[tournament_id] = LogState()
+        return
+    state = tournaments.setdefault(tournament_id, LogState())
+    if kind == 'players':
+        # names read back from JSON are unicode, the database gives bytes
+        state.add_players(event['ids'], [
+            name.encode('utf-8') if isinstance(name, unicode) else name
+            for name in event['names']])
+    elif kind == 'results':
+        state.add_results(event['round'], event['results'])
+    elif kind == 'delete_matches':
+        state.clear_matches()
+    # 'pairs' are kept only as a record of how the round was paired
+
+
+def read_events(filename, offset=0):
+    """Yields events of the log from the offset, with offset of the next
+    one, looks like (event, next_offset). A line cut by a crash at the end
+    of the log isn't an event, it's dropped by the next EventLog."""
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as log:
+        log.seek(offset)
+        for line in log:
+            if not line.endswith('\n'):
+                return
+            offset += len(line)
+            yield json.loads(line), offset
+
+
+def _snapshot_name(filename):
+    return filename + '.snapshot'
+
+
+def restore(filename):
+    """Reads states of all tournaments of the log: the last snapshot and
+    events written after it.
+
+    Returns:
+      tournaments: states, looks like {tournament_id: LogState}
+      offset: end of the last complete event of the log
+    """
+    tournaments = {}
+    offset = 0
+    if os.path.exists(_snapshot_name(filename)):
+        with open(_snapshot_name(filename), 'rb') as snapshot:
+            offset, tournaments = pickle.load(snapshot)
+    for event, offset in read_events(filename, offset):
+        _apply(tournaments, event)
+    return tournaments, offset
+
+
+class EventLog(object):
+    """Storage of engine.TournamentState, which appends every write as an
+    event (one JSON line) to a log, after the storage it wraps (if any)
+    has done it. Events are buffered and synced to disk in batches, every
+    few rounds a snapshot of all tournaments of the log replaces the
+    previous one, so a new EventLog (or replay()) reads only the snapshot
+    and events after it, not the database.
+
+    Events look like:
+      {"event": "players", "tournament": 1, "ids": [...], "names": [...]}
+      {"event": "pairs", "tournament": 1, "round": 1, "pairs": [[id1, id2]]}
+      {"event": "results", "tournament": 1, "round": 1,
+       "results": [[winner_id, looser_id],...]}, looser_id is null for a bye
+      {"event": "delete_matches", "tournament": 1}
+      {"event": "delete_players", "tournament": 1}
+    """
+
+    def __init__(self, filename, storage=None, sync_events=SYNC_EVENTS,
+                 snapshot_rounds=SNAPSHOT_ROUNDS):
+        """
+        Args:
+          filename: file of the log, it's created if it doesn't exist
+          storage: storage, which does the writes too (like
+                   tournament.PostgresStorage) and gives ids of players,
+                   None to keep the tournament only in the log
+          sync_events: number of events in one synced batch
+          snapshot_rounds: number of rounds between snapshots
+        """
+        self.filename = filename
+        self.storage = storage
+        self.sync_events = sync_events
+        self.snapshot_rounds = snapshot_rounds
+        self._lock = threading.Lock()
+        self.tournaments, offset = restore(filename)
+        if os.path.exists(filename) and os.path.getsize(filename) > offset:
+            # dropping the line cut by a crash
+            with open(filename, 'r+b') as log:
+                log.truncate(offset)
+        # ids of players are given by a counter, if there is no storage:
+        last_id = max([max(state.ids) for state in self.tournaments.values()
+                       if state.ids] or [0])
+        self._counter = NullStorage(last_id + 1)
+        self._file = open(filename, 'ab', BUFFER_SIZE)
+        self._unsynced = 0
+        self._rounds = 0
+
+    def _append(self, event):
+        with self._lock:
+            self._write(event)
+
+    def _write(self, event):
+        # the caller holds self._lock
+        self._file.write(json.dumps(event, separators=(',', ':')) + '\n')
+        _apply(self.tournaments, event)
+        self._unsynced += 1
+        if self._unsynced >= self.sync_events:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def load(self, tournament_id):
+        if tournament_id in self.tournaments:
+            state = self.tournaments[tournament_id]
+            return state.players(), state.matches()
+        if self.storage is None:
+            return [], []
+        # the log starts with what the storage already has:
+        players, matches = self.storage.load(tournament_id)
+        if players:
+            self._append({'event': 'players', 'tournament': tournament_id,
+                          'ids': [player[0] for player in players],
+                          'names': [player[1] for player in players]})
+        rounds = {}
+        for t_round, winner_id, looser_id in matches:
+            rounds.setdefault(t_round, []).append((winner_id, looser_id))
+        for t_round in sorted(rounds):
+            self._append({'event': 'results', 'tournament': tournament_id,
+                          'round': t_round, 'results': rounds[t_round]})
+        return players, matches
+
+    def register_players(self, tournament_id, names):
+        ids = (self.storage or self._counter).register_players(tournament_id,
+                                                               names)
+        self._append({'event': 'players', 'tournament': tournament_id,
+                      'ids': list(ids), 'names': list(names)})
+        return ids
+
+    def _new_results(self, tournament_id, t_round, results):
+        # a result reported again isn't logged twice, so replay counts it
+        # once; the caller holds self._lock
+        state = self.tournaments.get(tournament_id)
+        if state is None:
+            return results
+        return state.new_results(t_round, results)
+
+    def _append_results(self, tournament_id, t_round, results):
+        """Logs results, which aren't logged yet, and returns them. The
+        check is made again under the lock, which writes the event, as a
+        concurrent report of the same results may have passed the first
+        check too (the storage ignores a repeated result itself)."""
+        with self._lock:
+            results = self._new_results(tournament_id, t_round, results)
+            if results:
+                self._write({'event': 'results', 'tournament': tournament_id,
+                             'round': t_round, 'results': results})
+            return results
+
+    def report_match(self, tournament_id, t_round, winner_id, looser_id):
+        with self._lock:
+            if not self._new_results(tournament_id, t_round,
+                                     [(winner_id, looser_id)]):
+                return
+        if self.storage is not None:
+            self.storage.report_match(tournament_id, t_round, winner_id,
+                                      looser_id)
+        self._append_results(tournament_id, t_round, [(winner_id, looser_id)])
+
+    def report_round(self, tournament_id, t_round, results):
+        with self._lock:
+            results = self._new_results(tournament_id, t_round,
+                                        list(results))
+        if not results:
+            return
+        if self.storage is not None:
+            self.storage.report_round(tournament_id, t_round, results)
+        if not self._append_results(tournament_id, t_round, results):
+            return
+        self._rounds += 1
+        if self._rounds >= self.snapshot_rounds:
+            self.snapshot()
+
+    def report_pairs(self, tournament_id, t_round, pairs):
+        if self.storage is not None:
+            self.storage.report_pairs(tournament_id, t_round, pairs)
+        self._append({'event': 'pairs', 'tournament': tournament_id,
+                      'round': t_round, 'pairs': list(pairs)})
+
+    def delete_matches(self, tournament_id):
+        if self.storage is not None:
+            self.storage.delete_matches(tournament_id)
+        self._append({'event': 'delete_matches',
+                      'tournament': tournament_id})
+
+    def delete_players(self, tournament_id):
+        if self.storage is not None:
+            self.storage.delete_players(tournament_id)
+        self._append({'event': 'delete_players',
+                      'tournament': tournament_id})
+
+    def save_checkpoint(self, *args):
+        if self.storage is not None:
+            self.storage.save_checkpoint(*args)
+
+    def snapshot(self):
+        """Replaces the snapshot by states of all tournaments at the end of
+        the log. The log is synced first, and the new snapshot is renamed
+        over the old one, so there is always a whole snapshot of a synced
+        part of the log."""
+        with self._lock:
+            self._sync()
+            self._rounds = 0
+            temporary = _snapshot_name(self.filename) + '.new'
+            with open(temporary, 'wb') as snapshot:
+                pickle.dump((self._file.tell(), self.tournaments), snapshot,
+                            pickle.HIGHEST_PROTOCOL)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(temporary, _snapshot_name(self.filename))
+
+    def flush(self):
+        """Syncs all events to disk."""
+        with self._lock:
+            self._sync()
+        if self.storage is not None:
+            self.storage.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class _Replayed(NullStorage):
+    # storage, which gives players and matches read from a log
+    def __init__(self, players, matches):
+        NullStorage.__init__(self, max([0] + [p[0] for p in players]) + 1)
+        self.players = players
+        self.matches = matches
+
+    def load(self, tournament_id):
+        return self.players, self.matches
+
+
+def replay(filename, tournament_id=1, t_round=None):
+    """Rebuilds the tournament from the log, as it was after the round.
+
+    Args:
+      filename: file of the log
+      tournament_id: id of the tournament
+      t_round: the last round, None for the whole tournament
+    Returns:
+      state: engine.TournamentState of the tournament, it doesn't write
+             anywhere
+    """
+    state = restore(filename)[0].get(tournament_id, LogState())
+    return TournamentState(_Replayed(state.players(),
+                                     state.matches(t_round)),
+                           tournament_id)
+
+
+def events(filename, tournament_id=None):
+    """Yields all events of the log, of one tournament if it is given; it
+    is the record of how standings were reached."""
+    for event, offset in read_events(filename):
+        if tournament_id is None or event['tournament'] == tournament_id:
+            yield event
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Prints standings of a tournament from its event log.")
+    parser.add_argument('log')
+    parser.add_argument('-t', '--tournament', type=int, default=1)
+    parser.add_argument('-r', '--round', type=int,
+                        help="standings after this round, after the last "
+                             "one by default")
+    parser.add_argument('-e', '--events', action='store_true',
+                        help="print all events of the tournament instead")
+    args = parser.parse_args()
+    if args.events:
+        for event in events(args.log, args.tournament):
+            print json.dumps(event)
+    else:
+        for player in replay(args.log, args.tournament,
+                             args.round).standings():
+            print player
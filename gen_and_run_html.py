@@ -1,84 +1,263 @@
 import webbrowser
 import os
-import fileinput
-import sys
-import random
+from array import array
+from itertools import izip
 
+# names closer than this (in pixels, by y) overlap on the canvas
+COLLISION_DISTANCE = 15
 
-def replaceAll(file, searchExp, replaceExp):
-    found = False
-    for line in fileinput.input(file, inplace=1):
-        if searchExp in line:
-            line = line.replace(searchExp, replaceExp)
-            found = True
-        sys.stdout.write(line)
-    return found
+HTML = """
+    <!DOCTYPE html>
+    <html>
+    <body>
+    <canvas id="myCanvas" width="3000" height="3000"
+     style="border:1px solid #d3d3d3;">
+    Your browser does not support the HTML5 canvas tag.</canvas>
 
+    <script>
 
-def gen_html(data):
-    """Making new html file for further visualization, Crearing initial
-    list of the names on the canvas.
+    var c = document.getElementById("myCanvas");
+    var ctx = c.getContext("2d");
+    ctx.textAlign = "start";
+    ctx.font = "15px Verdana";
+
+    {elements}
+    {lines}
+    {names}
+
+    </script>
+
+    </body>
+    </html>
+    """
+
+
+class Scene(object):
+    """Everything drawn on the canvas, kept in memory: initial names, lines
+    of all rounds and names after each round. Html file is written only by
+    flush(), at once.
+    """
+
+    def __init__(self, filename='tournament.html'):
+        self.filename = filename
+        # lists of javascript statements:
+        self.elements = []
+        self.lines = []
+        self.names = []
+        # Positions of names after the last drawn round, see drawNextRound()
+        self.positions = None
+        self.dirty = True
+        # numbers of statements of each list already given by changes()
+        self._saved = (0, 0, 0)
+
+    def add_element(self, statement):
+        """Adds initial name of a player."""
+        self.elements.append(statement)
+        self.dirty = True
+
+    def add_line(self, statement):
+        """Adds winner's or looser's line."""
+        self.lines.append(statement)
+        self.dirty = True
+
+    def add_names(self, statements):
+        """Adds names of the players after a round."""
+        self.names.append(statements)
+        self.dirty = True
+
+    def changes(self):
+        """Returns statements added since the previous call, so the scene
+        can be saved round by round (see tournament.saveDrawing()).
+
+        Returns:
+          tuple of strings (elements, lines, names)
+        """
+        lists = (self.elements, self.lines, self.names)
+        changes = tuple("".join(statements[saved:])
+                        for statements, saved in zip(lists, self._saved))
+        self._saved = tuple(len(statements) for statements in lists)
+        return changes
+
+    @classmethod
+    def restore(cls, drawings, positions, filename='tournament.html'):
+        """Makes the scene again from its saved changes().
+
+        Args:
+          drawings: list of tuples (elements, lines, names) of all rounds
+          positions: Positions of names after the last of them
+          filename: name of html file of the scene
+        """
+        scene = cls(filename)
+        for drawing in drawings:
+            for statements, added in zip((scene.elements, scene.lines,
+                                          scene.names), drawing):
+                if added:
+                    statements.append(added)
+        scene.positions = positions
+        scene._saved = (len(scene.elements), len(scene.lines),
+                        len(scene.names))
+        return scene
+
+    def render(self):
+        """Returns content of the html file."""
+        return HTML.format(elements="".join(self.elements),
+                           lines="".join(self.lines),
+                           names="".join(self.names))
+
+    def flush(self, filename=None):
+        """Writes html file, if anything was drawn since last flush.
+
+        Returns:
+          number of bytes written
+        """
+        filename = filename or self.filename
+        if not self.dirty and filename == self.filename:
+            return 0
+        content = self.render()
+        with open(filename, 'w') as f:
+            f.write(content)
+        self.filename = filename
+        self.dirty = False
+        return len(content)
+
+
+class Positions(object):
+    """Positions of names on the canvas as parallel arrays: ids, names,
+    x and y of right edge of each name, and place of each id in them.
+
+    Indexing and iteration give tuples (id, name, x, y), so Positions can
+    be used wherever a list of such tuples was; drawing functions move
+    names by changing 'xs' and 'ys' in place, no tuples are built.
+    """
+
+    __slots__ = ('ids', 'names', 'xs', 'ys', '_places')
+    __hash__ = None
+
+    def __init__(self, positions=()):
+        """
+        Args:
+          positions: iterable of tuples (id, name, x, y)
+        """
+        self.ids = array('l')
+        self.names = []
+        self.xs = array('l')
+        self.ys = array('l')
+        # looks like {id: place}
+        self._places = {}
+        for player_id, name, x, y in positions:
+            self.append(player_id, name, x, y)
+
+    @classmethod
+    def of(cls, positions):
+        """Returns positions as Positions, the same object if they are."""
+        if isinstance(positions, cls):
+            return positions
+        return cls(positions)
+
+    def append(self, player_id, name, x, y):
+        self._places[player_id] = len(self.ids)
+        self.ids.append(player_id)
+        self.names.append(name)
+        self.xs.append(x)
+        self.ys.append(y)
+
+    def place(self, player_id):
+        """Returns index of the player, None if he isn't on the canvas."""
+        return self._places.get(player_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(izip(self.ids[index], self.names[index],
+                             self.xs[index], self.ys[index]))
+        return (self.ids[index], self.names[index], self.xs[index],
+                self.ys[index])
+
+    def __setitem__(self, index, position):
+        player_id, name, x, y = position
+        if self.ids[index] != player_id:
+            del self._places[self.ids[index]]
+            self._places[player_id] = index
+        self.ids[index] = player_id
+        self.names[index] = name
+        self.xs[index] = x
+        self.ys[index] = y
+
+    def __iter__(self):
+        return izip(self.ids, self.names, self.xs, self.ys)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+# scene of the current tournament, made by gen_html():
+scene = None
+
+
+def flush(filename=None):
+    """Writes the scene of the current tournament into its html file."""
+    if scene is not None:
+        return scene.flush(filename)
+    return 0
+
+
+def gen_html(data, filename='tournament.html'):
+    """Making new scene for further visualization, Crearing initial
+    list of the names on the canvas. Nothing is written to html file
+    until flush() or run_html().
 
      Args:
       data: list of tuples with players ids and names, looks like
             [(id1,'name1'),(id2,'name2')...]
+      filename: name of html file of the scene
      Returns:
-      positions: list of positions of right edge of the names on
+      positions: Positions of right edge of the names on
                  the canvas, looks like
       [(id1, name1, xpos1, ypos1),(id2, name2, xpos2, ypos2)...]
     """
-
-    f = open('tournament.html', 'w')
+    global scene
+    scene = Scene(filename)
 
     element = """ctx.fillText("{name}", {x_pos}, {y_pos});"""
-    elements = ""
     # initial positon of first elemnt on canvas:
     y = 1000
     x = 10
-    # positions - a list, containing positions of all names on canvas,
-    # it looks like
-    # [(id1, x_pos1, y_pos1),(id2, x_pos2, y_pos2)...].
-    # This list will be returned by gen_html()
-    positions = []
+    # positions - positions of all names on canvas, it looks like
+    # [(id1, name1, x_pos1, y_pos1),(id2, name2, x_pos2, y_pos2)...].
+    # They will be returned by gen_html()
+    positions = Positions()
     for player_data in data:
-        elements += element.format(
+        scene.add_element(element.format(
             name=player_data[1],
             y_pos=str(y),
             x_pos=str(x)
-        )
+        ))
 
-        positions.append((player_data[0], player_data[1], x, y))
+        positions.append(player_data[0], player_data[1], x, y)
         # next names should lie lower on canvas, so increment y coordinate
         y += 27
 
-    content = """
-    <!DOCTYPE html>
-    <html>
-    <body>
-    <canvas id="myCanvas" width="3000" height="3000"
-     style="border:1px solid #d3d3d3;">
-    Your browser does not support the HTML5 canvas tag.</canvas>
-
-    <script>
-
-    var c = document.getElementById("myCanvas");
-    var ctx = c.getContext("2d");
-    ctx.textAlign = "start";
-    ctx.font = "15px Verdana";
+    scene.positions = positions
+    return positions
 
-    {elements}
-    //lines
-    //next_name
-    //placeholder
 
-    </script>
+def restore(drawings, positions, filename='tournament.html'):
+    """Makes the scene of a resumed tournament from drawings of its rounds
+    saved in checkpoints, see Scene.restore().
 
-    </body>
-    </html>
+    Returns:
+      positions: Positions of names after the last saved round
     """
-    content = content.format(elements=elements)
-    f.write(content)
-    f.close()
+    global scene
+    scene = Scene.restore(drawings, positions, filename)
     return positions
 
 
@@ -88,7 +267,7 @@ def drawLines(winner_id, positions, t_round, looser_id=None):
     Args:
       winner_id: id of the winner in certain pair,
       looser_id: id of the looser in certain pair,
-      positions: list of positions of right edge
+      positions: Positions (or list) of right edge
                  of the names on the canvas, looks like
       [(id1, name1, xpos1, ypos1),(id2, name2, xpos2, ypos2)...],
       t_round - number of tournament's round
@@ -106,7 +285,6 @@ def drawLines(winner_id, positions, t_round, looser_id=None):
     {y_value} - 100);
     ctx.strokeStyle = 'red';
     ctx.stroke();
-    //next_line
     """
     lines_loose = """
     ctx.beginPath();
@@ -116,52 +294,56 @@ def drawLines(winner_id, positions, t_round, looser_id=None):
     {y_value} + 100);
     ctx.strokeStyle = 'blue';
     ctx.stroke();
-    //next_line
     """
 
-    add_lines = ""
-    for index, player in enumerate(positions):
-        if player[0] == winner_id or (
-                player[0] == winner_id and looser_id is None):
-            winner_name = player[1]
-            x = player[2]
-            y = player[3]
-            add_lines = lines_win.format(
-                name=winner_name,
-                y_value=y,
-                x_value=x,
-                round=t_round
-            )
-            if not replaceAll("tournament.html", "//lines", add_lines):
-                replaceAll("tournament.html", "//next_line", add_lines)
-            # updating positions:
-            x += 100
-            y -= 100
-            positions[index] = (player[0], player[1], x, y)
-        elif player[0] == looser_id:
-            looser_name = player[1]
-            x = player[2]
-            y = player[3]
-            add_lines = lines_loose.format(
-                name=looser_name,
-                y_value=y,
-                x_value=x,
-                round=t_round
-            )
-            if not replaceAll("tournament.html", "//lines", add_lines):
-                replaceAll("tournament.html", "//next_line", add_lines)
-            # updating positions:
-            x += 100
-            y += 100
-            positions[index] = (player[0], player[1], x, y)
+    # names are found by id, not by looking through all positions, lines
+    # are added in order of names on the canvas:
+    positions = Positions.of(positions)
+    players = [(positions.place(player_id), lines, shift)
+               for player_id, lines, shift in
+               ((winner_id, lines_win, -100), (looser_id, lines_loose, 100))
+               if positions.place(player_id) is not None]
+    for index, lines, shift in sorted(players):
+        scene.add_line(lines.format(
+            name=positions.names[index],
+            y_value=positions.ys[index],
+            x_value=positions.xs[index],
+            round=t_round
+        ))
+        # updating positions:
+        positions.xs[index] += 100
+        positions.ys[index] += shift
     return positions
 
 
+def _sweep(positions):
+    """Sorting names by y coordinate and gathering them in groups of
+    overlapping names: the gap between neighbours in a group is less than
+    COLLISION_DISTANCE.
+
+    Returns:
+      groups: list of groups, each group is a list of indexes of
+              'positions', ordered from top to bottom
+    """
+    ys = positions.ys
+    order = sorted(xrange(len(ys)), key=lambda index: (ys[index], index))
+    groups = []
+    previous_y = None
+    for index in order:
+        y = ys[index]
+        if previous_y is not None and y - previous_y < COLLISION_DISTANCE:
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+        previous_y = y
+    return groups
+
+
 def check_collisions(positions):
     """Checking if names of the players overlap each other for certain round
 
     Args:
-      positions: list of positions of right ends of lines,
+      positions: Positions (or list) of right ends of lines,
                  drawed in function drawLines(),
       this list is necessary to draw new list of names. endPos looks like:
       [(id1, name1, xpos1, ypos1),(id2, name2, xpos2, ypos2)...],
@@ -169,76 +351,70 @@ def check_collisions(positions):
       col_detected: True if collision was detected
       collided_ids: list of ids of names that collides and boolean upper,
                     looks like [(id1, upper),(id2, upper)...]
-        upper: boolean, True, if name on the canvas with colided id is upper
-               then that another name, which is in collision
+        upper: boolean, True, if name on the canvas with colided id is in
+               upper half of the names it collides with
     """
 
-    # for each player's data inside 'positions' list check if any other name
-    # overlap with it's name
-    col_detected = False
+    # names are sorted by y once, so only neighbours must be compared
+    positions = Positions.of(positions)
     collided_ids = []
-    for i in xrange(len(positions)):
-        for j in xrange(len(positions)):
-            if j != i and (
-                abs(
-                    positions[i][3] -
-                    positions[j][3]) < 15 and positions[j][0] not in [
-                    el[0] for el in collided_ids]):
-                col_detected = True
-                upper = False
-                if positions[i][3] < positions[j][3]:
-                    upper = True
-                # append id's to list
-                collided_ids.append((positions[i][0], upper))
-    return col_detected, collided_ids
+    for group in _sweep(positions):
+        if len(group) < 2:
+            continue
+        for place, index in enumerate(group):
+            collided_ids.append((positions.ids[index],
+                                 2 * place < len(group) - 1))
+    return bool(collided_ids), collided_ids
 
 
 def fix_collisions(pos_copy, positions, col_ids, loosers_list, t_round):
-    # redraw line on the canvas for collided names:
-    for player in pos_copy:
-        if player[0] in [el[0] for el in col_ids]:
-            # get index of player[0] id:
-            ind = [el[0] for el in col_ids].index(player[0])
-            if player[0] in loosers_list:
-                replace_line = """  ctx.lineTo(ctx.measureText("{name}").width
-                * {round} + {x_value} + 100, {y_value} + 100);"""
-                new_line = """  ctx.lineTo(ctx.measureText("{name}").width
-                * {round} + {x_value} + 100, {y_value} + 100);"""
-            else:
-                replace_line = """  ctx.lineTo(ctx.measureText("{name}").width
-                * {round} + {x_value} + 100, {y_value} - 100);"""
-                new_line = """  ctx.lineTo(ctx.measureText("{name}").width
-                * {round} + {x_value} + 100, {y_value} - 100);"""
-            replace_line = replace_line.format(
-                name=player[1],
-                x_value=player[2],
-                y_value=player[3],
-                round=t_round
-            )
-            if col_ids[ind][1]:
-                new_line = new_line.format(
-                    name=player[1],
-                    x_value=player[2],
-                    y_value=player[3] - 7,
-                    round=t_round
-                )
-            else:
-                new_line = new_line.format(
-                    name=player[1],
-                    x_value=player[2],
-                    y_value=player[3] + 7,
-                    round=t_round
-                )
-
-            found = replaceAll("tournament.html", replace_line, new_line)
-    # updating data in positions list after fixing lines
-    for index, pl in enumerate(positions):
-        if pl[0] in [el[0] for el in col_ids]:
-            ind = [el[0] for el in col_ids].index(pl[0])
-            if col_ids[ind][1]:
-                positions[index] = (pl[0], pl[1], pl[2], pl[3] - 7)
-            else:
-                positions[index] = (pl[0], pl[1], pl[2], pl[3] + 7)
+    """Moving overlapping names apart, so there are at least
+    COLLISION_DISTANCE pixels between any two names. Each group of
+    overlapping names is spread around its center; if it gets too close to
+    the next group, both are spread together. Lines, drawn by drawLines(),
+    stay where they are.
+
+    Args:
+      pos_copy: positions before the round (not used, kept for
+                compatibility)
+      positions: Positions (or list) of right ends of lines,
+      [(id1, name1, xpos1, ypos1),(id2, name2, xpos2, ypos2)...],
+      col_ids: list of collided ids, returned by check_collisions()
+      loosers_list: ids of loosers of the round (not used)
+      t_round: current round of the tournament (not used)
+    Returns:
+      positions: positions with moved names
+    """
+    if not col_ids:
+        return positions
+    positions = Positions.of(positions)
+    order = [index for group in _sweep(positions) for index in group]
+    ys = [positions.ys[index] for index in order]
+    # sums of y of first k names, to get center of any block of names fast
+    sums = [0]
+    for y in ys:
+        sums.append(sums[-1] + y)
+    # blocks of names laid out without gaps, looks like
+    # [[first, last, top_y],...], first and last are places in 'order'
+    blocks = []
+    for place, y in enumerate(ys):
+        blocks.append([place, place, y])
+        while len(blocks) > 1:
+            first, last, top = blocks[-2]
+            bottom = top + (last - first) * COLLISION_DISTANCE
+            if blocks[-1][2] - bottom >= COLLISION_DISTANCE:
+                break
+            # merging two last blocks, centered on their names:
+            last = blocks[-1][1]
+            center = float(sums[last + 1] - sums[first]) / (last - first + 1)
+            top = center - (last - first) * COLLISION_DISTANCE / 2.0
+            blocks[-2:] = [[first, last, top]]
+    for first, last, top in blocks:
+        if first == last:
+            continue
+        for place in xrange(first, last + 1):
+            positions.ys[order[place]] = int(round(
+                top + (place - first) * COLLISION_DISTANCE))
     return positions
 
 
@@ -246,7 +422,7 @@ def drawNames(positions, t_round):
     """Drawing player's names after each held round
 
     Args:
-      positions: list of positions of right ends of lines,
+      positions: Positions (or list) of right ends of lines,
                  drawed in function drawLines(),
       this list is necessary to draw new list of names. endPos looks like:
       [(id1, name1, xpos1, ypos1),(id2, name2, xpos2, ypos2)...],
@@ -255,26 +431,54 @@ def drawNames(positions, t_round):
 
     element = """ctx.fillText("{name}", {x_pos} +
     ctx.measureText("{name}").width * {round} , {y_pos});"""
-    elements = ""
-    for player in positions:
-        elements += element.format(
-            name=player[1],
-            x_pos=str(player[2]),
-            y_pos=str(player[3]),
+    positions = Positions.of(positions)
+    elements = []
+    for name, x, y in izip(positions.names, positions.xs, positions.ys):
+        elements.append(element.format(
+            name=name,
+            x_pos=str(x),
+            y_pos=str(y),
             round=t_round
-        )
-    for line in fileinput.input('tournament.html', inplace=1):
-        print line,
-        if line.startswith("    //placeholder"):
-            print "//placeholder2"
-
-    replaceAll("tournament.html", "//next_name", elements)
-    replaceAll("tournament.html", "//placeholder2", "//next_name")
+        ))
+    scene.add_names("".join(elements))
 
     return positions
 
 
+def drawRound(positions, results, t_round):
+    """Drawing the whole round: lines of all results, then names at the
+    ends of the lines, moved apart where they overlap.
+
+    Args:
+      positions: Positions (or list) of right edge of the names
+      results: list of tuples (winner_id, looser_id) of the round,
+               looser_id is None for a free win
+      t_round: current round of the tournament
+    Returns:
+      positions: positions after the round
+    """
+    for winner_id, looser_id in results:
+        positions = drawLines(winner_id, positions, t_round, looser_id)
+    col_detected, col_ids = check_collisions(positions)
+    if col_detected:
+        loosers = [looser_id for winner_id, looser_id in results
+                   if looser_id is not None]
+        positions = fix_collisions(None, positions, col_ids, loosers,
+                                   t_round)
+    return drawNames(positions, t_round)
+
+
+def drawNextRound(results, t_round):
+    """drawRound() of the current scene, from positions where its last
+    round left the names. Being a module-level function over the module's
+    scene, it can run in a worker process, which has its own copy of the
+    scene (see tournament.RoundPipeline).
+    """
+    scene.positions = drawRound(scene.positions, results, t_round)
+
+
 def run_html(filename):
-    # open the output file in the browser
+    # writing the scene and opening the output file in the browser
+    flush(filename)
     url = os.path.abspath(filename)
     webbrowser.open('file://' + url, new=2)  # open in a new tab, if possible
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#
+# instrument.py -- opt-in timings of functions, queries and html writes of
+# the tournament
+#
+
+import sys
+import types
+import inspect
+import atexit
+import threading
+from functools import wraps
+from timeit import default_timer
+
+import psycopg2.extensions
+
+# number of slowest functions and queries shown in summaries
+TOP = 10
+# queries are grouped by their first characters (with spaces collapsed)
+QUERY_KEY_LENGTH = 60
+
+
+class Stats(object):
+    """Counters of one run: calls and wall time of functions (time of a
+    function includes functions it calls), number and latency of queries,
+    bytes written to html files."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # looks like {name: [calls, seconds]}
+        self.calls = {}
+        self.queries = {}
+        self.bytes_written = 0
+
+    def add(self, table, name, seconds):
+        with self.lock:
+            counter = table.setdefault(name, [0, 0.0])
+            counter[0] += 1
+            counter[1] += seconds
+
+    def snapshot(self):
+        """Returns a copy of all counters, looks like
+        {'calls': {...}, 'queries': {...}, 'bytes_written': n}."""
+        with self.lock:
+            return {
+                'calls': dict((name, list(counter))
+                              for name, counter in self.calls.items()),
+                'queries': dict((name, list(counter))
+                                for name, counter in self.queries.items()),
+                'bytes_written': self.bytes_written,
+            }
+
+
+def _difference(new, old):
+    """Counters of snapshot 'new' minus counters of older snapshot 'old'."""
+    result = {'bytes_written': new['bytes_written'] - old['bytes_written']}
+    for table in ('calls', 'queries'):
+        result[table] = {}
+        for name, (calls, seconds) in new[table].items():
+            old_calls, old_seconds = old[table].get(name, (0, 0.0))
+            if calls != old_calls:
+                result[table][name] = [calls - old_calls,
+                                       seconds - old_seconds]
+    return result
+
+
+def _query_key(query):
+    if not isinstance(query, basestring):
+        # psycopg2.sql objects
+        query = repr(query)
+    return " ".join(query.split())[:QUERY_KEY_LENGTH]
+
+
+# counters of the last run, None before enable()
+stats = None
+# summaries of rounds, looks like [(round, counters),...]
+rounds = []
+_last = None
+_output = None
+# dump at exit is registered once, for output of the last enable()
+_registered = False
+# replaced functions, looks like [(owner, name, original),...]
+_originals = []
+_modules = []
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor, which counts and times every statement it sends."""
+
+    def execute(self, query, vars=None):
+        start = default_timer()
+        try:
+            return super(TimedCursor, self).execute(query, vars)
+        finally:
+            stats.add(stats.queries, _query_key(query),
+                      default_timer() - start)
+
+    def executemany(self, query, vars_list):
+        start = default_timer()
+        try:
+            return super(TimedCursor, self).executemany(query, vars_list)
+        finally:
+            stats.add(stats.queries, _query_key(query),
+                      default_timer() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = default_timer()
+        try:
+            return super(TimedCursor, self).copy_expert(sql, file, size)
+        finally:
+            stats.add(stats.queries, _query_key(sql),
+                      default_timer() - start)
+
+
+def _timed(name, function):
+    """Returns function, which calls the given one and records its time.
+    Generators are timed while they are iterated."""
+    if inspect.isgeneratorfunction(function):
+        @wraps(function)
+        def timed_generator(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            seconds = 0.0
+            try:
+                while True:
+                    start = default_timer()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        seconds += default_timer() - start
+                    yield item
+            finally:
+                stats.add(stats.calls, name, seconds)
+        return timed_generator
+
+    @wraps(function)
+    def timed(*args, **kwargs):
+        start = default_timer()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.add(stats.calls, name, default_timer() - start)
+    return timed
+
+
+def _timed_flush(function):
+    """Wraps Scene.flush(), which returns number of written bytes."""
+    @wraps(function)
+    def timed_flush(*args, **kwargs):
+        start = default_timer()
+        written = function(*args, **kwargs)
+        stats.add(stats.calls, 'gen_and_run_html.Scene.flush',
+                  default_timer() - start)
+        with stats.lock:
+            stats.bytes_written += written
+        return written
+    return timed_flush
+
+
+def _replace(owner, name, function):
+    # original is taken from __dict__, so methods are put back as functions
+    _originals.append((owner, name, vars(owner)[name]))
+    setattr(owner, name, function)
+
+
+def enable(output=None, modules=None):
+    """Starts recording: every function of the modules is replaced by a
+    timed one, connect() gives TimedCursor, Scene.flush() counts bytes.
+    Nothing is changed until enable(), so disabled instrumentation costs
+    nothing.
+
+    Args:
+      output: file, where summary of each round of main() and summary of
+              the whole run (at exit) are written, None to only record
+              them (see rounds and summary())
+      modules: instrumented modules, tournament and gen_and_run_html if
+               not given; a module run as a script passes itself
+    """
+    global stats, _last, _output, _registered
+    if stats is not None:
+        disable()
+    if modules is None:
+        import tournament
+        import gen_and_run_html
+        modules = [tournament, gen_and_run_html]
+    stats = Stats()
+    _last = stats.snapshot()
+    _output = output
+    del rounds[:]
+    for module in modules:
+        _modules.append(module)
+        prefix = module.__name__ + '.'
+        for name, value in sorted(vars(module).items()):
+            if isinstance(value, types.FunctionType) and \
+                    value.__module__ == module.__name__:
+                _replace(module, name, _timed(prefix + name, value))
+        scene = getattr(module, 'Scene', None)
+        if scene is not None:
+            _replace(scene, 'flush', _timed_flush(vars(scene)['flush']))
+        if hasattr(module, 'cursor_factory'):
+            _replace(module, 'cursor_factory', TimedCursor)
+        if hasattr(module, 'round_listeners'):
+            module.round_listeners.append(end_round)
+    if output is not None and not _registered:
+        atexit.register(_dump_at_exit)
+        _registered = True
+
+
+def disable():
+    """Puts original functions back, recorded counters are kept."""
+    while _originals:
+        owner, name, original = _originals.pop()
+        setattr(owner, name, original)
+    while _modules:
+        module = _modules.pop()
+        if end_round in getattr(module, 'round_listeners', ()):
+            module.round_listeners.remove(end_round)
+
+
+def end_round(t_round):
+    """Closes summary of the round: counters since previous round are
+    stored in 'rounds' and written to output."""
+    global _last
+    if stats is None:
+        return
+    current = stats.snapshot()
+    counters = _difference(current, _last)
+    _last = current
+    rounds.append((t_round, counters))
+    if _output is not None:
+        _output.write("\n--- round %s ---\n" % t_round)
+        _output.write(summary(counters))
+
+
+def summary(counters=None):
+    """Returns text summary of counters, of the whole run if not given:
+    slowest functions, slowest queries and bytes written."""
+    if counters is None:
+        counters = stats.snapshot()
+    lines = []
+    queries = counters['queries']
+    lines.append("queries: %d, %.4f s" % (
+        sum(calls for calls, seconds in queries.values()),
+        sum(seconds for calls, seconds in queries.values())))
+    for title, table in (("functions", counters['calls']),
+                         ("queries", queries)):
+        lines.append("slowest %s (calls, seconds):" % title)
+        slowest = sorted(table.items(), key=lambda item: -item[1][1])[:TOP]
+        for name, (calls, seconds) in slowest:
+            lines.append("  %8d %10.4f  %s" % (calls, seconds, name))
+    lines.append("bytes written to html: %d" % counters['bytes_written'])
+    return "\n".join(lines) + "\n"
+
+
+def dump(output=sys.stderr):
+    """Writes summary of the whole run."""
+    if stats is None:
+        return
+    output.write("\n--- whole run ---\n")
+    output.write(summary())
+
+
+def _dump_at_exit():
+    if _output is not None:
+        dump(_output)
@@ -0,0 +1,796 @@
+#!/usr/bin/env python
+#
+# pairing.py -- pairing engine for a Swiss-system tournament, pairs players
+# with maximum-weight matching instead of swapping players around
+#
+
+import time
+from array import array
+from itertools import izip
+
+# fields up to this size are paired with one matching over all players
+EXACT_LIMIT = 128
+# bigger fields are paired block by block, going down the standings,
+# each block has this many players
+BLOCK_SIZE = 48
+# inside a block each player gets edges to this many next players in
+# standings, if it isn't enough to pair everybody all edges are used
+WINDOW = 16
+
+
+class PlayedPairs(object):
+    """Index of pairs of players who already met, keyed by player ids.
+
+    Order of players in a pair doesn't matter. Free win is stored as a pair
+    with BYE, which has id 0. Checking a pair is a dictionary and a set
+    lookup, no tuples are built for it.
+    """
+
+    def __init__(self, all_pairs=()):
+        # opponents of each player, looks like {id1: set([id2, id3]),...}
+        self._opponents = {}
+        self._count = 0
+        self.update(all_pairs)
+
+    @classmethod
+    def from_matches(cls, matches):
+        """Builds index from rows of 'matches' table.
+
+        Args:
+          matches: iterable of (winner_id, looser_id), looser_id is 0 or
+                   None for a free win
+        """
+        played = cls()
+        for winner_id, looser_id in matches:
+            played.add(winner_id, looser_id or 0)
+        return played
+
+    def add(self, id1, id2):
+        """Remembers that players id1 and id2 met."""
+        opponents = self._opponents.setdefault(id1, set())
+        if id2 not in opponents:
+            opponents.add(id2)
+            self._opponents.setdefault(id2, set()).add(id1)
+            self._count += 1
+
+    def update(self, pairs):
+        """Adds pairs of one or more rounds.
+
+        Args:
+          pairs: Pairs or list of pairs, looks like
+                 [(id1, name1, id2, name2),...]
+        """
+        if isinstance(pairs, Pairs):
+            for id1, id2 in pairs.ids():
+                self.add(id1, id2)
+            return
+        for pair in pairs:
+            self.add(pair[0], pair[2])
+
+    def played(self, id1, id2):
+        """Returns True if players id1 and id2 already met."""
+        opponents = self._opponents.get(id1)
+        return opponents is not None and id2 in opponents
+
+    def opponents(self, player_id):
+        """Returns set of ids of all opponents of the player."""
+        return self._opponents.get(player_id, set())
+
+    def copy(self):
+        played = PlayedPairs()
+        played._opponents = dict((player_id, set(opponents)) for
+                                 player_id, opponents in
+                                 self._opponents.iteritems())
+        played._count = self._count
+        return played
+
+    def __contains__(self, pair):
+        # pair is (id1, id2) or (id1, name1, id2, name2)
+        return self.played(pair[0], pair[2] if len(pair) == 4 else pair[1])
+
+    def __len__(self):
+        return self._count
+
+
+class Pairs(object):
+    """Pairs of one round as two parallel arrays of player ids, names are
+    kept once in a name table {id: name}, which can be shared by many
+    rounds. BYE has id 0.
+
+    Indexing and iteration give tuples (id1, name1, id2, name2), so Pairs
+    can be used wherever a list of such tuples was; code which needs only
+    ids reads 'first' and 'second' (or ids()) and builds no tuples.
+    """
+
+    __slots__ = ('first', 'second', 'names')
+    __hash__ = None
+
+    def __init__(self, pairs=(), names=None):
+        """
+        Args:
+          pairs: iterable of tuples (id1, name1, id2, name2)
+          names: name table, a new one if not given
+        """
+        self.first = array('l')
+        self.second = array('l')
+        self.names = {0: 'BYE'} if names is None else names
+        for pair in pairs:
+            self.append(pair)
+
+    def add(self, id1, id2):
+        """Adds a pair of players, both must be in the name table."""
+        self.first.append(id1)
+        self.second.append(id2)
+
+    def append(self, pair):
+        self.names[pair[0]] = pair[1]
+        self.names[pair[2]] = pair[3]
+        self.add(pair[0], pair[2])
+
+    def ids(self):
+        """Returns iterator over pairs of ids (id1, id2)."""
+        return izip(self.first, self.second)
+
+    def _pair(self, index):
+        id1 = self.first[index]
+        id2 = self.second[index]
+        return (id1, self.names[id1], id2, self.names[id2])
+
+    def __len__(self):
+        return len(self.first)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._pair(i) for i in xrange(*index.indices(len(self)))]
+        return self._pair(index)
+
+    def __setitem__(self, index, pair):
+        self.names[pair[0]] = pair[1]
+        self.names[pair[2]] = pair[3]
+        self.first[index] = pair[0]
+        self.second[index] = pair[2]
+
+    def __iter__(self):
+        names = self.names
+        for id1, id2 in izip(self.first, self.second):
+            yield (id1, names[id1], id2, names[id2])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def swiss_pairs(standings):
+    """Pairs players adjacent in the standings: first with second, third
+    with fourth and so on, the last player of odd number of players gets
+    BYE. Standings are consumed one by one, so they can come from a
+    generator, like tournament.iterStandings().
+
+    Args:
+      standings: iterable of tuples (id, name, wins, matches), ordered by
+                 wins
+    Returns:
+      list_of_pairs: Pairs, looks like a list of tuples
+                     [(id1, name1, id2, name2),...], lonely player gets
+                     (id, name, 0, 'BYE')
+    """
+    list_of_pairs = Pairs()
+    names = list_of_pairs.names
+    ids = array('l')
+    for player in standings:
+        names[player[0]] = player[1]
+        ids.append(player[0])
+    # first and second players of pairs are every other player:
+    paired = len(ids) - len(ids) % 2
+    list_of_pairs.first = ids[0:paired:2]
+    list_of_pairs.second = ids[1:paired:2]
+    waiting = ids[-1] if len(ids) % 2 else None
+    if waiting is not None:
+        # lonely player, I will add BYE player to him:
+        list_of_pairs.add(waiting, 0)
+    return list_of_pairs
+
+
+def preventRematch(all_pairs, pairs_list):
+    """Checking if any pair from current (for this round) pairs list is
+       already is in all_pairs list (list of pairs for all rounds) and
+       fixing this by shuffeling players
+    Args:
+      all_pairs: PlayedPairs index of all pairs for all rounds, or
+                 list of all pairs for all rounds,
+                 looks like [(id1, name1, id2, name2),()...]
+      pairs_list: list of pairs for current round, looks like
+                  [(id1, name1, id2, name2),()...]
+    Returns:
+      pairs_list: A list of fixed pairs
+                  [(id_fixed, name_fixed, id2, name2),()...]
+    """
+    if not isinstance(all_pairs, PlayedPairs):
+        all_pairs = PlayedPairs(all_pairs)
+    if isinstance(pairs_list, Pairs):
+        _fix_rematches(all_pairs.played, pairs_list.first, pairs_list.second)
+        return pairs_list
+    pairs = Pairs(pairs_list)
+    _fix_rematches(all_pairs.played, pairs.first, pairs.second)
+    pairs_list[:] = list(pairs)
+    return pairs_list
+
+
+def _fix_rematches(played, first, second):
+    """preventRematch() over parallel arrays of ids of the pairs, players
+    are swapped in place."""
+    for index in xrange(len(first)):
+        a = first[index]
+        b = second[index]
+        rematch = played(a, b)
+        j = -1
+        while rematch and index + j >= 0:
+            c = first[index + j]
+            d = second[index + j]
+            if not played(d, b) and not played(c, a):
+                first[index] = d
+                second[index + j] = a
+                break
+            elif not played(c, b) and not played(a, d):
+                first[index] = c
+                first[index + j] = a
+                break
+            j -= 1
+        else:
+            i = 1
+            while rematch and index + i <= len(first) - 1:
+                c = first[index + i]
+                d = second[index + i]
+                if not played(a, c) and not played(b, d):
+                    second[index] = c
+                    first[index + i] = b
+                    break
+                elif not played(a, d) and not played(c, b):
+                    second[index] = d
+                    second[index + i] = b
+                    break
+                i += 1
+
+
+def max_weight_matching(edges, maxcardinality=False):
+    """Computes a maximum-weight matching of a general graph with Edmonds'
+    blossom algorithm (primal-dual method, O(n^3)).
+
+    Args:
+      edges: list of tuples (i, j, weight), vertices are numbered
+             0, 1, 2... and weights are integers
+      maxcardinality: if True, only maximum-cardinality matchings are
+                      considered, and the heaviest of them is returned
+    Returns:
+      mate: list, mate[i] is the vertex matched to vertex i or -1 if i
+            isn't matched
+    """
+    if not edges:
+        return []
+    nedge = len(edges)
+    nvertex = 0
+    for (i, j, w) in edges:
+        if i >= nvertex:
+            nvertex = i + 1
+        if j >= nvertex:
+            nvertex = j + 1
+    maxweight = max(0, max(w for (i, j, w) in edges))
+
+    # endpoint[p] is the vertex at endpoint p, edge k has endpoints
+    # 2k and 2k+1:
+    endpoint = [edges[p // 2][p % 2] for p in xrange(2 * nedge)]
+    # neighbend[v] is the list of remote endpoints of edges attached to v:
+    neighbend = [[] for i in xrange(nvertex)]
+    for k in xrange(nedge):
+        (i, j, w) = edges[k]
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+    # mate[v] is the remote endpoint of the matched edge of v, or -1:
+    mate = nvertex * [-1]
+    # label of top-level blossoms and vertices: 0 free, 1 S, 2 T
+    label = (2 * nvertex) * [0]
+    # endpoint through which a blossom or vertex got its label:
+    labelend = (2 * nvertex) * [-1]
+    # top-level blossom of each vertex:
+    inblossom = range(nvertex)
+    blossomparent = (2 * nvertex) * [-1]
+    blossomchilds = (2 * nvertex) * [None]
+    blossombase = range(nvertex) + nvertex * [-1]
+    blossomendps = (2 * nvertex) * [None]
+    # least-slack edge to a different S-blossom:
+    bestedge = (2 * nvertex) * [-1]
+    blossombestedges = (2 * nvertex) * [None]
+    unusedblossoms = range(nvertex, 2 * nvertex)
+    # dual variables, doubled to keep them integral:
+    dualvar = nvertex * [maxweight] + nvertex * [0]
+    # allowedge[k] is True if edge k has zero slack:
+    allowedge = nedge * [False]
+    queue = []
+
+    def slack(k):
+        (i, j, wt) = edges[k]
+        return dualvar[i] + dualvar[j] - 2 * wt
+
+    def blossom_leaves(b):
+        if b < nvertex:
+            yield b
+        else:
+            for t in blossomchilds[b]:
+                if t < nvertex:
+                    yield t
+                else:
+                    for v in blossom_leaves(t):
+                        yield v
+
+    def assign_label(w, t, p):
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        if t == 1:
+            # b became an S-blossom, scan its vertices:
+            queue.extend(blossom_leaves(b))
+        elif t == 2:
+            # b became a T-blossom, its mate becomes an S-vertex:
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v, w):
+        # tracing back from v and w to find a new blossom or an
+        # augmenting path, returns base of the blossom or -1
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            if labelend[b] == -1:
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                v = endpoint[labelend[b]]
+            if w != -1:
+                v, w = w, v
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base, k):
+        (v, w, wt) = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        b = unusedblossoms.pop()
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        # tracing back from v to base:
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        # tracing back from w to base:
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                # T-vertices inside the blossom become S-vertices:
+                queue.append(v)
+            inblossom[v] = b
+        # least-slack edges from the new blossom to other S-blossoms:
+        bestedgeto = (2 * nvertex) * [-1]
+        for bv in path:
+            if blossombestedges[bv] is None:
+                nblists = [[p // 2 for p in neighbend[v]]
+                           for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    (i, j, wt) = edges[k]
+                    if inblossom[j] == b:
+                        i, j = j, i
+                    bj = inblossom[j]
+                    if (bj != b and label[bj] == 1 and
+                            (bestedgeto[bj] == -1 or
+                             slack(k) < slack(bestedgeto[bj]))):
+                        bestedgeto[bj] = k
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [k for k in bestedgeto if k != -1]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+
+    def expand_blossom(b, endstage):
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < nvertex:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        if (not endstage) and label[b] == 2:
+            # relabeling the T-blossom children on the path from the entry
+            # child to the base:
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                j -= len(blossomchilds[b])
+                jstep = 1
+                endptrick = 0
+            else:
+                jstep = -1
+                endptrick = 1
+            p = labelend[b]
+            while j != 0:
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^
+                               endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                allowedge[p // 2] = True
+                j += jstep
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            j += jstep
+            while blossomchilds[b][j] != entrychild:
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+
+    def augment_blossom(b, v):
+        # swapping matched and unmatched edges on the path from v to the
+        # base of blossom b, v becomes the new base
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        if t >= nvertex:
+            augment_blossom(t, v)
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            j -= len(blossomchilds[b])
+            jstep = 1
+            endptrick = 0
+        else:
+            jstep = -1
+            endptrick = 1
+        while j != 0:
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p])
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= nvertex:
+                augment_blossom(t, endpoint[p ^ 1])
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k):
+        (v, w, wt) = edges[k]
+        for (s, p) in ((v, 2 * k + 1), (w, 2 * k)):
+            while True:
+                bs = inblossom[s]
+                if bs >= nvertex:
+                    augment_blossom(bs, s)
+                mate[s] = p
+                if labelend[bs] == -1:
+                    # reached a single vertex, end of the path
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                if bt >= nvertex:
+                    augment_blossom(bt, j)
+                mate[j] = labelend[bt]
+                p = labelend[bt] ^ 1
+
+    # each stage finds one augmenting path:
+    for t in xrange(nvertex):
+        label[:] = (2 * nvertex) * [0]
+        bestedge[:] = (2 * nvertex) * [-1]
+        blossombestedges[nvertex:] = nvertex * [None]
+        allowedge[:] = nedge * [False]
+        queue[:] = []
+        for v in xrange(nvertex):
+            if mate[v] == -1 and label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+        augmented = False
+        while True:
+            while queue and not augmented:
+                v = queue.pop()
+                for p in neighbend[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    if inblossom[v] == inblossom[w]:
+                        continue
+                    if not allowedge[k]:
+                        kslack = slack(k)
+                        if kslack <= 0:
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        b = inblossom[v]
+                        if bestedge[b] == -1 or kslack < slack(bestedge[b]):
+                            bestedge[b] = k
+                    elif label[w] == 0:
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+            if augmented:
+                break
+            # no augmenting path, updating dual variables:
+            deltatype = -1
+            delta = deltaedge = deltablossom = None
+            if not maxcardinality:
+                deltatype = 1
+                delta = min(dualvar[:nvertex])
+            for v in xrange(nvertex):
+                if label[inblossom[v]] == 0 and bestedge[v] != -1:
+                    d = slack(bestedge[v])
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 2
+                        deltaedge = bestedge[v]
+            for b in xrange(2 * nvertex):
+                if (blossomparent[b] == -1 and label[b] == 1 and
+                        bestedge[b] != -1):
+                    d = slack(bestedge[b]) // 2
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 3
+                        deltaedge = bestedge[b]
+            for b in xrange(nvertex, 2 * nvertex):
+                if (blossombase[b] >= 0 and blossomparent[b] == -1 and
+                        label[b] == 2 and
+                        (deltatype == -1 or dualvar[b] < delta)):
+                    delta = dualvar[b]
+                    deltatype = 4
+                    deltablossom = b
+            if deltatype == -1:
+                # no further improvement possible, max cardinality reached
+                deltatype = 1
+                delta = max(0, min(dualvar[:nvertex]))
+            for v in xrange(nvertex):
+                if label[inblossom[v]] == 1:
+                    dualvar[v] -= delta
+                elif label[inblossom[v]] == 2:
+                    dualvar[v] += delta
+            for b in xrange(nvertex, 2 * nvertex):
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+            if deltatype == 1:
+                break
+            elif deltatype == 2:
+                allowedge[deltaedge] = True
+                (i, j, wt) = edges[deltaedge]
+                if label[inblossom[i]] == 0:
+                    i, j = j, i
+                queue.append(i)
+            elif deltatype == 3:
+                allowedge[deltaedge] = True
+                (i, j, wt) = edges[deltaedge]
+                queue.append(i)
+            elif deltatype == 4:
+                expand_blossom(deltablossom, False)
+        if not augmented:
+            break
+        # expanding S-blossoms with zero dual at the end of the stage:
+        for b in xrange(nvertex, 2 * nvertex):
+            if (blossomparent[b] == -1 and blossombase[b] >= 0 and
+                    label[b] == 1 and dualvar[b] == 0):
+                expand_blossom(b, True)
+
+    for v in xrange(nvertex):
+        if mate[v] >= 0:
+            mate[v] = endpoint[mate[v]]
+    return mate
+
+
+def _match_group(group, played, window):
+    """Pairs players of one group with maximum-weight matching.
+
+    Args:
+      group: list of tuples (rank, id, wins), ordered by rank
+      played: PlayedPairs index
+      window: number of next players in the group each player may be paired
+              with, None for everybody
+    Returns:
+      pairs: list of pairs of group indexes [(i, j),...], i < j
+      unpaired: list of indexes of players left without a pair
+    """
+    size = len(group)
+    # score difference has priority over any sum of rank differences:
+    score_factor = size ** 3
+    edges = []
+    for i in xrange(size):
+        rank_i, id_i, wins_i = group[i]
+        last = size if window is None else min(size, i + window + 1)
+        for j in xrange(i + 1, last):
+            rank_j, id_j, wins_j = group[j]
+            if played.played(id_i, id_j):
+                continue
+            cost = (score_factor * (wins_i - wins_j) ** 2 +
+                    (rank_j - rank_i) ** 2)
+            edges.append((i, j, -cost))
+    mate = max_weight_matching(edges, maxcardinality=True)
+    mate += (size - len(mate)) * [-1]
+    pairs = [(i, mate[i]) for i in xrange(size) if mate[i] > i]
+    unpaired = [i for i in xrange(size) if mate[i] == -1]
+    return pairs, unpaired
+
+
+def _pair_greedy(group, played):
+    """Pairs each player with the next one in the group he hasn't played,
+    or simply with the next one if there is no such player. Used when time
+    budget is over and for the players matching couldn't pair."""
+    pairs = []
+    left = range(len(group))
+    while len(left) > 1:
+        i = left.pop(0)
+        for pos, j in enumerate(left):
+            if not played.played(group[i][1], group[j][1]):
+                break
+        else:
+            pos = 0
+        pairs.append((i, left.pop(pos)))
+    return pairs
+
+
+def matched_pairings(standings, all_pairs=(), exact_limit=EXACT_LIMIT,
+                     block_size=BLOCK_SIZE, window=WINDOW, time_budget=None):
+    """Returns a list of pairs of players for the next round, like
+    swissPairings(), but pairs are chosen by maximum-weight matching: nobody
+    plays the same opponent twice if it is possible at all, and players
+    are paired with the closest possible score and place in standings.
+
+    Ties are broken by place in 'standings', so the same standings always
+    give the same pairs. Fields bigger than 'exact_limit' are paired in
+    blocks of 'block_size' players going down the standings, players left
+    without a pair in one block move to the next one.
+
+    Args:
+      standings: list of tuples (id, name, wins, matches), like
+                 playerStandings() returns
+      all_pairs: PlayedPairs index of all previous rounds, or list of
+                 all their pairs [(id1, name1, id2, name2),()...],
+                 BYE has id 0
+      exact_limit: biggest field paired with one matching
+      block_size: number of players in a block for bigger fields
+      window: number of next players in standings each player may be
+              paired with in a block, before all of them are tried
+      time_budget: seconds, if set and pairing takes longer, the rest of
+                   the field is paired greedily (then result depends on
+                   speed of the machine)
+    Returns:
+      list_of_pairs: Pairs, looks like a list of tuples
+                     [(id1, name1, id2, name2),...], the
+                     player with odd number of players gets
+                     (id, name, 0, 'BYE')
+    """
+    started = time.time()
+    if isinstance(all_pairs, PlayedPairs):
+        played = all_pairs
+    else:
+        played = PlayedPairs(all_pairs)
+    # ordering by wins, keeping order of standings for equal wins:
+    players = sorted(enumerate(standings), key=lambda item: -item[1][2])
+    names = {}
+    field = []
+    for rank, (player_id, name, wins, matches) in enumerate(
+            player for index, player in players):
+        names[player_id] = name
+        field.append((rank, player_id, wins))
+
+    bye = None
+    if len(field) % 2:
+        # lowest player without free win in previous rounds gets it:
+        for index in xrange(len(field) - 1, -1, -1):
+            if not played.played(field[index][1], 0):
+                break
+        else:
+            index = len(field) - 1
+        bye = field.pop(index)
+
+    pairs = []
+    if len(field) <= exact_limit:
+        blocks = [field]
+    else:
+        blocks = [field[start:start + block_size]
+                  for start in xrange(0, len(field), block_size)]
+    carried = []
+    for number, block in enumerate(blocks):
+        group = carried + block
+        last = number == len(blocks) - 1
+        if time_budget is not None and time.time() - started > time_budget:
+            group_pairs = _pair_greedy(group, played)
+            unpaired = []
+        else:
+            group_pairs, unpaired = _match_group(group, played, window)
+            if unpaired and (last or len(unpaired) > len(group) // 4):
+                # window was too narrow, trying all the edges:
+                group_pairs, unpaired = _match_group(group, played, None)
+        if last and unpaired:
+            # no pairing without rematch exists, so rematch is forced:
+            left = [group[i] for i in unpaired]
+            group_pairs += [(unpaired[i], unpaired[j])
+                            for i, j in _pair_greedy(left, played)]
+            unpaired = []
+        pairs += [(group[i], group[j]) for i, j in group_pairs]
+        carried = [group[i] for i in unpaired]
+
+    pairs.sort()
+    names[0] = 'BYE'
+    list_of_pairs = Pairs(names=names)
+    for first, second in pairs:
+        list_of_pairs.add(first[1], second[1])
+    if bye is not None:
+        list_of_pairs.add(bye[1], 0)
+    return list_of_pairs
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+#
+# simulate.py -- Monte-Carlo simulation of many Swiss-system tournaments
+# at once, with NumPy
+#
+
+import argparse
+import math
+import random
+import multiprocessing
+
+try:
+    import numpy as np
+except ImportError:
+    # simulate() needs numpy, the module can be imported without it
+    np = None
+
+import pairing
+from pairing import PlayedPairs, preventRematch
+from engine import TournamentState
+
+# played pairs of a batch of tournaments are kept in boolean matrices,
+# tournaments are simulated in batches of at most this many bytes of them
+BATCH_BYTES = 64 * 1024 * 1024
+# pairing policies: 'swiss' pairs neighbours in standings and fixes
+# rematches with preventRematch(), like swissPairings() and old main(),
+# 'matched' uses pairing.matched_pairings(), like swissPairingsMatched()
+PAIRINGS = ('swiss', 'matched')
+# bye policies: 'last' gives BYE to the last player in standings, like
+# swissPairings(), 'no_repeat' gives it to the last player without a free
+# win, like swissPairingsMatched()
+BYE_POLICIES = ('last', 'no_repeat')
+# simulate_many() sends tournaments to worker processes in chunks of this
+# size, each worker gives back one result for a chunk
+CHUNK_SIZE = 50
+
+
+def _percent(values):
+    """Rounds like ROUND(x, 6) of tournament.sql (up to float precision)."""
+    return np.round(values, 6)
+
+
+def _order(wins, byes, matches, played):
+    """Orders players of each tournament like playerStandings(): by wins,
+    then by tie-breaks (Buchholz, opponent match-win %, opponents' wins
+    without free wins), then by id, newest first.
+
+    Args:
+      wins, byes, matches: arrays (tournaments, players)
+      played: boolean array (tournaments, players, players)
+    Returns:
+      order: array (tournaments, players) of player indexes
+    """
+    met = played.view(np.int8)
+    pct = np.where(matches > 0,
+                   _percent(np.maximum(1.0 / 3, wins / np.maximum(matches,
+                                                                  1.0))),
+                   0)
+    buchholz = np.einsum('tij,tj->ti', met, wins)
+    opponent_wins = np.einsum('tij,tj->ti', met, wins - byes)
+    opponents = met.sum(axis=2)
+    omw = np.where(opponents > 0,
+                   _percent(np.einsum('tij,tj->ti', met, pct) /
+                            np.maximum(opponents, 1)), 0)
+    ids = np.broadcast_to(np.arange(wins.shape[1]), wins.shape)
+    # lexsort sorts by the last key first:
+    return np.lexsort((-ids, -opponent_wins, -omw, -buchholz, -wins),
+                      axis=-1)
+
+
+def _take_bye(order, byes, bye_policy):
+    """Takes the player who gets BYE out of the order.
+
+    Returns:
+      order: order of players to pair, without BYE player
+      bye: array (tournaments,) of indexes of players with BYE
+    """
+    count, size = order.shape
+    rows = np.arange(count)
+    place = np.full(count, size - 1)
+    if bye_policy == 'no_repeat':
+        had_bye = byes[rows[:, None], order] > 0
+        # last place without a free win, or the last place if all had one:
+        places = np.where(had_bye, -1, np.arange(size))
+        last = places.max(axis=1)
+        place = np.where(last >= 0, last, size - 1)
+    bye = order[rows, place]
+    keep = np.ones(order.shape, dtype=bool)
+    keep[rows, place] = False
+    return order[keep].reshape(count, size - 1), bye
+
+
+def _played_pairs(played, byes):
+    """Builds PlayedPairs index of one tournament, ids are indexes + 1."""
+    first, second = np.nonzero(np.triu(played))
+    index = PlayedPairs.from_matches(zip(first + 1, second + 1))
+    for player in np.nonzero(byes)[0]:
+        index.add(player + 1, 0)
+    return index
+
+
+def _from_pairs(pairs_list):
+    """Splits pairs [(id1, name1, id2, name2),...] into arrays of indexes of
+    first and second players and the index of BYE player (-1 if none)."""
+    first = []
+    second = []
+    bye = -1
+    for pair in pairs_list:
+        if pair[2] == 0 or pair[0] == 0:
+            bye = pair[0] + pair[2] - 1
+        else:
+            first.append(pair[0] - 1)
+            second.append(pair[2] - 1)
+    return first, second, bye
+
+
+def _pair_batch(wins, byes, matches, played, policy, bye_policy):
+    """Pairs players of all tournaments of a batch for the next round.
+
+    Returns:
+      first, second: arrays (tournaments, pairs) of indexes of players
+      bye: array (tournaments,) of indexes of BYE players, None if number
+           of players is even
+    """
+    count, size = wins.shape
+    rows = np.arange(count)
+    order = _order(wins, byes, matches, played)
+    if policy == 'matched':
+        first = np.empty((count, size // 2), dtype=int)
+        second = np.empty((count, size // 2), dtype=int)
+        bye = np.empty(count, dtype=int) if size % 2 else None
+        for t in xrange(count):
+            standings = [(player + 1, str(player + 1), wins[t, player],
+                          matches[t, player]) for player in order[t]]
+            pairs_list = pairing.matched_pairings(
+                standings, _played_pairs(played[t], byes[t]))
+            first[t], second[t], bye_t = _from_pairs(pairs_list)
+            if bye is not None:
+                bye[t] = bye_t
+        return first, second, bye
+    bye = None
+    if size % 2:
+        order, bye = _take_bye(order, byes, bye_policy)
+    first = order[:, 0::2]
+    second = order[:, 1::2]
+    rematch = played[rows[:, None], first, second].any(axis=1)
+    if bye is not None:
+        rematch |= byes[rows, bye] > 0
+    # rematches are fixed by the same code as in production, only in
+    # tournaments which have them:
+    for t in np.nonzero(rematch)[0]:
+        pairs_list = [(a + 1, str(a + 1), b + 1, str(b + 1))
+                      for a, b in zip(first[t], second[t])]
+        if bye is not None:
+            pairs_list.append((bye[t] + 1, str(bye[t] + 1), 0, 'BYE'))
+        pairs_list = preventRematch(_played_pairs(played[t], byes[t]),
+                                    pairs_list)
+        first[t], second[t], bye_t = _from_pairs(pairs_list)
+        if bye is not None:
+            bye[t] = bye_t
+    return first, second, bye
+
+
+def _simulate_batch(count, players, rounds, policy, bye_policy, strengths,
+                    rng, result):
+    """Holds 'count' tournaments round by round and adds their outcome to
+    the result."""
+    rows = np.arange(count)
+    wins = np.zeros((count, players), dtype=int)
+    byes = np.zeros((count, players), dtype=int)
+    matches = np.zeros((count, players), dtype=int)
+    played = np.zeros((count, players, players), dtype=bool)
+    for t_round in xrange(rounds):
+        first, second, bye = _pair_batch(wins, byes, matches, played,
+                                         policy, bye_policy)
+        # forced rematches are pairs which already met after pairing:
+        result['rematches'] += int(played[rows[:, None], first,
+                                          second].sum())
+        if bye is not None:
+            result['repeated_byes'] += int((byes[rows, bye] > 0).sum())
+        # outcomes of all matches of the round at once, first player wins
+        # with probability from Elo formula, or 1/2 without strengths:
+        if strengths is None:
+            probability = 0.5
+        else:
+            probability = 1.0 / (1.0 + 10 ** ((strengths[second] -
+                                               strengths[first]) / 400.0))
+        first_won = rng.random_sample(first.shape) < probability
+        winner = np.where(first_won, first, second)
+        looser = np.where(first_won, second, first)
+        wins[rows[:, None], winner] += 1
+        matches[rows[:, None], winner] += 1
+        matches[rows[:, None], looser] += 1
+        played[rows[:, None], first, second] = True
+        played[rows[:, None], second, first] = True
+        if bye is not None:
+            wins[rows, bye] += 1
+            matches[rows, bye] += 1
+            byes[rows, bye] += 1
+    order = _order(wins, byes, matches, played)
+    final = wins[rows[:, None], order]
+    places = np.broadcast_to(np.arange(players), final.shape)
+    np.add.at(result['places'], (places, final), 1)
+    result['byes'] += np.bincount(byes.ravel(), minlength=rounds + 1)
+    if strengths is not None:
+        # how often the strongest player won the tournament:
+        result['favourite_won'] += int(
+            (order[:, 0] == np.argmax(strengths)).sum())
+
+
+def simulate(players, tournaments=1000, rounds=None, seed=None,
+             policy='swiss', bye_policy='last', strengths=None):
+    """Simulates many complete Swiss-system tournaments with the same
+    pairing rules as tournament.py. All tournaments of a batch are held at
+    once: standings, tie-breaks and outcomes are NumPy arrays, only
+    tournaments with rematches are fixed one by one.
+
+    Args:
+      players: number of players in each tournament
+      tournaments: number of tournaments
+      rounds: number of rounds, log2 of number of players if not given,
+              like in main()
+      seed: seed of the random generator, results with one seed are the
+            same
+      policy: pairing policy, one of PAIRINGS
+      bye_policy: bye policy, one of BYE_POLICIES (used by 'swiss' policy)
+      strengths: Elo ratings of the players, all players are equal if not
+                 given
+    Returns:
+      result: dictionary with
+        places: array (players, rounds + 1), places[k][w] is how many
+                times player in place k (0 is the winner) finished with w
+                wins
+        rematches: number of forced rematches in all tournaments
+        repeated_byes: number of free wins given to players who already
+                       had one
+        byes: array, byes[n] is how many players got n free wins
+        favourite_won: how many tournaments the strongest player won
+                       (only with strengths)
+    """
+    if np is None:
+        raise ImportError("simulate() needs numpy")
+    if policy not in PAIRINGS:
+        raise ValueError("unknown pairing policy %r" % policy)
+    if bye_policy not in BYE_POLICIES:
+        raise ValueError("unknown bye policy %r" % bye_policy)
+    if rounds is None:
+        rounds = int(math.ceil(math.log(players, 2)))
+    if strengths is not None:
+        strengths = np.asarray(strengths, dtype=float)
+    rng = np.random.RandomState(seed)
+    result = {
+        'tournaments': tournaments,
+        'players': players,
+        'rounds': rounds,
+        'places': np.zeros((players, rounds + 1), dtype=int),
+        'rematches': 0,
+        'repeated_byes': 0,
+        'byes': np.zeros(rounds + 1, dtype=int),
+        'favourite_won': 0,
+    }
+    batch = max(1, min(tournaments, BATCH_BYTES // (players * players)))
+    left = tournaments
+    while left > 0:
+        count = min(batch, left)
+        _simulate_batch(count, players, rounds, policy, bye_policy,
+                        strengths, rng, result)
+        left -= count
+    return result
+
+
+def _empty_result(players, rounds):
+    return {
+        'tournaments': 0,
+        'players': players,
+        'rounds': rounds,
+        'places': [[0] * (rounds + 1) for place in xrange(players)],
+        'rematches': 0,
+        'repeated_byes': 0,
+        'byes': [0] * (rounds + 1),
+        'favourite_won': 0,
+    }
+
+
+def _merge(result, part):
+    """Adds result of some tournaments to the result of others."""
+    for key in ('tournaments', 'rematches', 'repeated_byes',
+                'favourite_won'):
+        result[key] += part[key]
+    for counts, part_counts in zip(result['places'], part['places']):
+        for wins, count in enumerate(part_counts):
+            counts[wins] += count
+    for byes, count in enumerate(part['byes']):
+        result['byes'][byes] += count
+
+
+def hold_tournament(players, rounds, seed, policy='swiss'):
+    """Holds one tournament in memory with the production pairing code:
+    swiss_pairs() of the standings fixed by preventRematch() (or
+    matched_pairings() for 'matched' policy), winners are chosen at random.
+
+    Args:
+      players: number of players
+      rounds: number of rounds
+      seed: seed of the random generator of outcomes
+      policy: pairing policy, one of PAIRINGS
+    Returns:
+      result of one tournament, like simulate() returns
+    """
+    rng = random.Random(seed)
+    state = TournamentState()
+    state.register_players(str(i) for i in xrange(1, players + 1))
+    result = _empty_result(players, rounds)
+    for t_round in xrange(1, rounds + 1):
+        if policy == 'matched':
+            pairs_list = state.matched_pairings()
+        else:
+            pairs_list = preventRematch(state.played,
+                                        state.swiss_pairings())
+        results = []
+        for id1, id2 in pairs_list.ids():
+            if state.played.played(id1, id2):
+                if id2 == 0:
+                    result['repeated_byes'] += 1
+                else:
+                    result['rematches'] += 1
+            if id2 == 0:
+                results.append((id1, None))
+            elif rng.randrange(2):
+                results.append((id1, id2))
+            else:
+                results.append((id2, id1))
+        state.report_round(t_round, results)
+    result['tournaments'] = 1
+    for place, player in enumerate(state.standings()):
+        result['places'][place][player[2]] += 1
+    for byes in state.byes:
+        result['byes'][byes] += 1
+    return result
+
+
+def _hold_chunk(task):
+    """Holds a chunk of tournaments in a worker process.
+
+    Args:
+      task: tuple (players, rounds, policy, seeds)
+    """
+    players, rounds, policy, seeds = task
+    result = _empty_result(players, rounds)
+    for seed in seeds:
+        _merge(result, hold_tournament(players, rounds, seed, policy))
+    return result
+
+
+def simulate_many(n, players, workers=None, rounds=None, seed=0,
+                  policy='swiss'):
+    """Holds n independent tournaments with the production pairing code
+    (see hold_tournament()) on all cores.
+
+    Every tournament has its own in-memory TournamentState and its own
+    seed, made from 'seed' and its number, so the result doesn't depend on
+    number of workers or on which worker held which tournament. Results of
+    chunks are merged as soon as they come, memory doesn't grow with n.
+
+    Args:
+      n: number of tournaments
+      players: number of players in each tournament
+      workers: number of worker processes, number of cores if not given,
+               with 1 tournaments are held in this process
+      rounds: number of rounds, log2 of number of players if not given
+      seed: base seed of all tournaments
+      policy: pairing policy, one of PAIRINGS
+    Returns:
+      result: like simulate() returns, 'places' and 'byes' are lists
+    """
+    if policy not in PAIRINGS:
+        raise ValueError("unknown pairing policy %r" % policy)
+    if rounds is None:
+        rounds = int(math.ceil(math.log(players, 2)))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # tasks are generated lazily, only chunks being held are in memory:
+    tasks = ((players, rounds, policy,
+              xrange(seed * n + first, seed * n + min(first + CHUNK_SIZE, n)))
+             for first in xrange(0, n, CHUNK_SIZE))
+    result = _empty_result(players, rounds)
+    if workers == 1:
+        for task in tasks:
+            _merge(result, _hold_chunk(task))
+        return result
+    pool = multiprocessing.Pool(workers)
+    try:
+        for part in pool.imap_unordered(_hold_chunk, tasks):
+            _merge(result, part)
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+
+def summary(result):
+    """Returns text report of a result of simulate() or simulate_many()."""
+    tournaments = float(result['tournaments'])
+    lines = ["%(tournaments)s tournaments, %(players)s players, "
+             "%(rounds)s rounds" % result]
+    lines.append("forced rematches per tournament: %.3f" %
+                 (result['rematches'] / tournaments))
+    lines.append("repeated free wins per tournament: %.3f" %
+                 (result['repeated_byes'] / tournaments))
+    lines.append("players by number of free wins: %s" %
+                 list(result['byes']))
+    lines.append("place: mean wins (distribution of wins)")
+    for place, counts in enumerate(result['places']):
+        mean = sum(wins * count for wins, count in enumerate(counts))
+        lines.append("%5d: %.2f %s" % (place + 1, mean / tournaments,
+                                       list(counts)))
+    if result['favourite_won']:
+        lines.append("strongest player won %.1f%%" %
+                     (100 * result['favourite_won'] / tournaments))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Simulates many Swiss-system tournaments.")
+    parser.add_argument('players', type=int)
+    parser.add_argument('-n', '--tournaments', type=int, default=1000)
+    parser.add_argument('-r', '--rounds', type=int)
+    parser.add_argument('-s', '--seed', type=int)
+    parser.add_argument('-p', '--policy', choices=PAIRINGS, default='swiss')
+    parser.add_argument('-b', '--bye-policy', choices=BYE_POLICIES,
+                        default='last')
+    parser.add_argument('-w', '--workers', type=int,
+                        help="hold tournaments with the production pairing "
+                             "code in this many processes, without numpy")
+    args = parser.parse_args()
+    if args.workers:
+        result = simulate_many(args.tournaments, args.players, args.workers,
+                               args.rounds, args.seed or 0, args.policy)
+    else:
+        result = simulate(args.players, args.tournaments, args.rounds,
+                          args.seed, args.policy, args.bye_policy)
+    print summary(result)
@@ -4,77 +4,593 @@
 #
 
 import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
 import sys
+import os
+import time
 import random
 import math
-import copy
-import gen_and_run_html
+import csv
+import cPickle as pickle
+import threading
+import argparse
+from cStringIO import StringIO
+from contextlib import contextmanager
+from collections import OrderedDict
+import pairing
+from pairing import PlayedPairs, preventRematch
+from engine import TournamentState, AsyncStorage, ProcessWorker
+
+# maximum number of connections kept open to one database, can be set with
+# TOURNAMENT_POOL_SIZE environment variable or with setPoolSize()
+POOL_SIZE = int(os.environ.get("TOURNAMENT_POOL_SIZE", 5))
+# idle connections older than this (in seconds) are pinged with 'SELECT 1'
+# before reuse, fresher ones are only checked on the client side
+HEALTH_CHECK_INTERVAL = 30
+# number of rows sent to the server in one multi-row statement
+BATCH_SIZE = 1000
+# rounds of at least this many matches refresh planner statistics of
+# 'matches' before tie-breaks are updated: statistics taken before the
+# round (or before the tournament existed) estimate its matches as a few
+# rows, and such estimate turns joins of the update into nested loops
+ANALYZE_ROWS = 1000
+# reads of standings and player counts are cached until the next write of
+# their tournament, this many rows at most (a count is one row), can be set
+# with TOURNAMENT_CACHE_ROWS environment variable, 0 turns the cache off
+CACHE_ROWS = int(os.environ.get("TOURNAMENT_CACHE_ROWS", 100000))
+# tournament used by all functions called without tournament_id,
+# created by tournament.sql
+DEFAULT_TOURNAMENT = 1
+# order of standings: by wins, then by tie-breaks (Buchholz, opponent
+# match-win %, opponents' wins without free wins), then by id, newest first.
+# All columns go in one direction, so 'standings_order' index is read
+# backward and pages can be found by row comparison
+STANDINGS_ORDER = ("wins DESC, buchholz DESC, omw DESC, opponent_wins DESC, "
+                   "id DESC")
+# statements of hot paths are prepared once in each pooled connection and
+# executed by name (see executePrepared()), can be turned off with
+# TOURNAMENT_PREPARED=0
+USE_PREPARED = os.environ.get("TOURNAMENT_PREPARED", "1") != "0"
+# class of cursors given by connect(), None for the default one; set by
+# instrument.py to count and time queries
+cursor_factory = None
+# functions called with the number of the round after each round of main(),
+# see instrument.py
+round_listeners = []
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connection, which remembers names of statements prepared in its
+    session. PREPARE isn't undone by rollback, so a statement stays
+    prepared until the connection is closed."""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparedConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        # pool, which handed the connection out, None while it is idle
+        self.pool = None
+
+    def close(self):
+        """Gives the connection back to the pool, if it was taken from it
+        (callers written before the pool close connections of connect()
+        instead of releaseConnection()), closes it otherwise."""
+        if self.pool is not None:
+            self.pool.putconn(self)
+        else:
+            super(PreparedConnection, self).close()
+
+
+class ConnectionPool(object):
+    """Pool of warm connections to one database.
+
+    At most 'size' connections are handed out at the same time, next callers
+    wait until a connection is given back. Idle connections are checked before
+    reuse and replaced by fresh ones if they are broken.
+    """
+
+    def __init__(self, database_name, size=None):
+        self.dsn = "dbname={}".format(database_name)
+        self.size = size or POOL_SIZE
+        # idle connections, looks like [(db, time_of_last_use),...]
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        # set by closeall(), connections given back after it are closed
+        self._closed = False
+
+    def _healthy(self, db, last_used):
+        """Returns True if idle connection 'db' can be reused."""
+        if db.closed or (db.get_transaction_status() ==
+                         psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN):
+            return False
+        if time.time() - last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        # connection was idle for a long time, server could drop it:
+        try:
+            cur = db.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            db.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Takes a connection from the pool, opening a new one if there are
+           no healthy idle connections."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    db, last_used = self._idle.pop()
+                if self._healthy(db, last_used):
+                    db.pool = self
+                    return db
+                db.close()
+            db = psycopg2.connect(self.dsn,
+                                  connection_factory=PreparedConnection)
+            db.pool = self
+            return db
+        except:
+            self._slots.release()
+            raise
+
+    def putconn(self, db):
+        """Gives connection back to the pool. Unfinished transaction is
+           rolled back, broken connection is closed and thrown away."""
+        db.pool = None
+        try:
+            if not db.closed and (db.get_transaction_status() !=
+                                  psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                db.rollback()
+        except psycopg2.Error:
+            db.close()
+        if not db.closed:
+            with self._lock:
+                if not self._closed:
+                    self._idle.append((db, time.time()))
+                    db = None
+            if db is not None:
+                # the pool was closed while the connection was out
+                db.close()
+        self._slots.release()
+
+    def closeall(self):
+        """Closes all idle connections of the pool, connections handed out
+        are closed when they are given back."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for db, last_used in idle:
+            db.close()
+
+
+# pools of connections, one for each database name:
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def getPool(database_name="tournament"):
+    """Returns the pool of connections to the database, creating it on
+       first use."""
+    with _pools_lock:
+        pool = _pools.get(database_name)
+        if pool is None:
+            pool = ConnectionPool(database_name)
+            _pools[database_name] = pool
+    return pool
+
+
+def setPoolSize(size):
+    """Changes the size of the pools. Existing pools are closed, new ones
+       will be created with the new size on next connect().
+
+    Args:
+      size: maximum number of open connections to one database
+    """
+    global POOL_SIZE
+    POOL_SIZE = size
+    closePools()
+
+
+def closePools():
+    """Closes idle connections of all the pools and forgets the pools."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
+
+
+# pools of the parent of a forked process, see forgetPools()
+_inherited_pools = []
+
+
+def forgetPools():
+    """Makes a forked process open its own connections. Connections of the
+    parent can't be shared with it, and it mustn't close them either
+    (closing a connection ends its session on the server), so pools of
+    the parent are only put aside."""
+    _inherited_pools.append(dict(_pools))
+    _pools.clear()
 
 
 def connect(database_name="tournament"):
-    """Connect to the PostgreSQL database.  Returns a database connection
-       and cursor."""
+    """Takes a connection to the PostgreSQL database from the pool.  Returns
+       a database connection and cursor. Connection must be given back
+       with releaseConnection()."""
     try:
-        db = psycopg2.connect("dbname={}".format(database_name))
-        cursor = db.cursor()
+        db = getPool(database_name).getconn()
+        cursor = db.cursor(cursor_factory=cursor_factory)
         return db, cursor
-    except:
+    except psycopg2.Error:
         print("error while connecting to the database")
+        raise
+
+
+def releaseConnection(db, database_name="tournament"):
+    """Gives connection taken by connect() back to the pool, which gave it
+    out (pools may be replaced meanwhile by setPoolSize() or
+    closePools())."""
+    pool = getattr(db, 'pool', None) or getPool(database_name)
+    pool.putconn(db)
+
+
+@contextmanager
+def dbCursor(database_name="tournament"):
+    """Context manager around connect() and releaseConnection(). Gives
+       (db, cursor) pair, commits changes if the block succeeds or rolls
+       them back if it raises, and returns connection to the pool.
+
+       with dbCursor() as (db, cur):
+           cur.execute(query)
+    """
+    db, cur = connect(database_name)
+    try:
+        yield db, cur
+        db.commit()
+    except:
+        try:
+            db.rollback()
+        except psycopg2.Error:
+            pass
+        raise
+    finally:
+        cur.close()
+        releaseConnection(db, database_name)
+
+
+# cached reads, looks like {(tournament_id, name): (version, rows, value)},
+# least recently used first
+_cache = OrderedDict()
+_cached_rows = 0
+# versions of tournaments, looks like {tournament_id: version}, version of
+# a tournament is its entry plus _epoch, which invalidateCache(None) raises,
+# so tournaments never written (not in _versions) get a new version too
+_versions = {}
+_epoch = 0
+_cache_lock = threading.Lock()
+
+
+def cacheVersion(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns version of the tournament, it's raised by every write of the
+    tournament through this module. Values cached at an older version are
+    never returned, and two reads with the same version saw the same
+    data."""
+    with _cache_lock:
+        return _version(tournament_id)
+
+
+def _version(tournament_id):
+    # the caller holds _cache_lock
+    return _epoch + _versions.get(tournament_id, 0)
+
+
+def invalidateCache(tournament_id=None):
+    """Raises version of the tournament (of all tournaments if None) and
+    drops its cached reads. Writes of this module call it after they
+    commit; code which writes to the database in another way (or in
+    another process) must call it too."""
+    global _cached_rows, _epoch
+    with _cache_lock:
+        for key in _cache.keys():
+            if tournament_id is None or key[0] == tournament_id:
+                _cached_rows -= _cache.pop(key)[1]
+        if tournament_id is None:
+            _epoch += 1
+        else:
+            _versions[tournament_id] = _versions.get(tournament_id, 0) + 1
+
+
+def _cacheGet(tournament_id, name):
+    # returns (version, value), value is None if it isn't cached, version
+    # is given back to _cachePut() with the value read from the database
+    with _cache_lock:
+        version = _version(tournament_id)
+        entry = _cache.get((tournament_id, name))
+        if entry is None or entry[0] != version:
+            return version, None
+        # the entry is used last now:
+        del _cache[(tournament_id, name)]
+        _cache[(tournament_id, name)] = entry
+        return version, entry[2]
+
+
+def _cachePut(tournament_id, name, version, value):
+    # the value is dropped if the tournament was written since it was read
+    # (it may be older than the write), or if it's bigger than the cache
+    global _cached_rows
+    rows = len(value) if isinstance(value, list) else 1
+    with _cache_lock:
+        if version != _version(tournament_id) or rows > CACHE_ROWS:
+            return
+        old = _cache.pop((tournament_id, name), None)
+        if old is not None:
+            _cached_rows -= old[1]
+        _cache[(tournament_id, name)] = (version, rows, value)
+        _cached_rows += rows
+        while _cached_rows > CACHE_ROWS:
+            _cached_rows -= _cache.popitem(last=False)[1][1]
+
+
+# insert of one match, it waits while the round is reported by
+# reportRound() (see _lockRound()), a result already recorded isn't
+# inserted again:
+INSERT_MATCH = """WITH round_lock AS (
+                      SELECT pg_advisory_xact_lock_shared(%(t)s, %(r)s)
+                  )
+                  INSERT INTO matches (tournament_id, round, winner_id,
+                                       looser_id)
+                  SELECT %(t)s, %(r)s, %(w)s, %(l)s FROM round_lock
+                  ON CONFLICT DO NOTHING RETURNING id"""
+
+# statements prepared by executePrepared(), looks like
+# {name: (types of parameters, query)}:
+PREPARED = {
+    'insert_match': ("int, int, int, int",
+                     INSERT_MATCH % {'t': "$1", 'r': "$2", 'w': "$3",
+                                     'l': "$4"}),
+    'player_standings': ("int",
+                         """SELECT id, name, wins, matches
+                            FROM player_standings WHERE tournament_id = $1
+                            ORDER BY """ + STANDINGS_ORDER),
+}
+
+
+def executePrepared(cur, name, param):
+    """Executes statement 'name' of PREPARED. It's parsed and planned by
+    the first execution in the session of the connection, then only its
+    parameters are sent.
+
+    Args:
+      cur: cursor of a connection from the pool
+      name: name of the statement in PREPARED
+      param: tuple of parameters of the statement
+    """
+    db = cur.connection
+    if name not in db.prepared:
+        types, query = PREPARED[name]
+        cur.execute("PREPARE %s (%s) AS %s;" % (name, types, query))
+        db.prepared.add(name)
+    cur.execute("EXECUTE %s (%s);" % (name, ", ".join(["%s"] * len(param))),
+                param)
+
+
+# in-memory engines of tournaments, looks like {tournament_id: state}. Module
+# functions of a tournament with an engine work with its TournamentState,
+# the engine writes to its own storage
+_engines = {}
+
+
+def useEngine(storage=None, tournament_id=DEFAULT_TOURNAMENT):
+    """Makes module functions of the tournament a facade over an in-memory
+    TournamentState (see engine.py). Players and matches already in the
+    storage are loaded into it.
+
+    Args:
+      storage: where the engine writes: PostgresStorage() for the tournament
+               database, engine.SqliteStorage, engine.AsyncStorage around
+               any of them, or None to keep everything only in memory
+      tournament_id: id of the tournament
+    Returns:
+      state: TournamentState of the tournament
+    """
+    state = TournamentState(storage, tournament_id)
+    _engines[tournament_id] = state
+    # the engine may write to the database from another process, reads
+    # cached before it are dropped now and after it (see dropEngine()):
+    invalidateCache(tournament_id)
+    return state
+
+
+def dropEngine(tournament_id=DEFAULT_TOURNAMENT):
+    """Waits for all writes of the tournament's engine and makes module
+    functions of the tournament work with the database again."""
+    state = _engines.pop(tournament_id, None)
+    if state is not None:
+        state.flush()
+        invalidateCache(tournament_id)
+
+
+# pipelines of rounds being held by main(), looks like
+# {tournament_id: RoundPipeline}
+_pipelines = {}
 
 
-def deleteMatches():
-    """Remove all the match records from the database."""
-    # connecting to our db:
-    db, cur = connect()
-    # deleting all match records:
-    query = "ALTER TABLE players DROP COLUMN wins;"
-    cur.execute(query)
-    query = "ALTER TABLE players ADD COLUMN wins int DEFAULT 0;"
-    cur.execute(query)
-    query = "ALTER TABLE players DROP COLUMN matches;"
-    cur.execute(query)
-    query = "ALTER TABLE players ADD COLUMN matches int DEFAULT 0;"
-    cur.execute(query)
-    # writing changes into db:
-    db.commit()
-    # closing connection:
-    db.close()
-
-
-def deletePlayers():
-    """Remove all the player records from the database."""
-    # connecting to our db:
-    db, cur = connect()
-    # deleting all rows from players table
-    query = "DELETE FROM matches;"
-    cur.execute(query)
-    query = "DELETE FROM players;"
-    cur.execute(query)
-    # resetting id_seq to 1 after clearing the table,
-    # so next players will have id's started from 1
-    # for the great justice
-    query = "ALTER SEQUENCE players_id_seq RESTART WITH 1;"
-    cur.execute(query)
-    # writing changes into db:
-    db.commit()
-    # closing connection:
-    db.close()
-
-
-def countPlayers():
+class RoundPipeline(object):
+    """Overlaps stages of rounds of one tournament. Pairing and outcomes
+    of the next round are computed from in-memory state right away, while
+    results of previous rounds are written to the database and drawn in
+    background, in order of rounds. Both run in worker processes (threads
+    would fight with pairing for the interpreter lock), so a round costs
+    about as much as its slowest stage, not as all of them together.
+
+    The renderer is forked with the current scene of gen_and_run_html, so
+    the pipeline must be made after gen_html() and it's the renderer that
+    has the drawn scene.
+    """
+
+    def __init__(self, tournament_id=DEFAULT_TOURNAMENT):
+        self.tournament_id = tournament_id
+        # a tournament which already has an engine keeps it (and its
+        # storage), others get one writing to the database in background:
+        self.own_engine = tournament_id not in _engines
+        if self.own_engine:
+            useEngine(AsyncStorage(PostgresStorage(),
+                                   ProcessWorker(forgetPools, closePools)),
+                      tournament_id)
+        # the renderer saves drawings of rounds to the database too:
+        self.renderer = ProcessWorker(forgetPools, closePools)
+        _pipelines[tournament_id] = self
+
+    def draw(self, function, *args):
+        """Queues drawing of a round, drawings run one by one in order.
+        'function' is a module-level function of the renderer's copy of
+        gen_and_run_html, like gen_and_run_html.drawNextRound."""
+        self.renderer.submit(function, *args)
+
+    def barrier(self):
+        """Waits until every round reported so far is written to the
+        storage and drawn. Raises an error of any of these writes."""
+        try:
+            self.renderer.wait()
+        finally:
+            _engines[self.tournament_id].flush()
+
+    def close(self):
+        """Waits for the barrier and stops the workers, the tournament
+        works with the database again, if it did before."""
+        try:
+            self.renderer.close()
+        finally:
+            del _pipelines[self.tournament_id]
+            state = _engines[self.tournament_id]
+            if self.own_engine:
+                dropEngine(self.tournament_id)
+                state.storage.close()
+            else:
+                state.flush()
+
+
+def waitForRounds(tournament_id=DEFAULT_TOURNAMENT):
+    """Blocks until all rounds reported so far are durable (written to the
+    storage of the tournament) and drawn. Returns at once if nothing
+    is pending."""
+    if tournament_id in _pipelines:
+        _pipelines[tournament_id].barrier()
+    elif tournament_id in _engines:
+        _engines[tournament_id].flush()
+
+
+def createTournament(name):
+    """Adds a new tournament, which has its own players and matches.
+
+    Args:
+      name: name of the tournament
+    Returns:
+      id of the new tournament
+    """
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = "INSERT INTO tournaments (name) VALUES (%s) RETURNING id;"
+        param = (name,)
+        cur.execute(query, param)
+        tournament_id = cur.fetchone()[0]
+    return tournament_id
+
+
+def deleteTournament(tournament_id):
+    """Removes the tournament with all its players and matches."""
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # players, standings and matches are deleted by cascade:
+        query = "DELETE FROM tournaments WHERE id = %s;"
+        param = (tournament_id,)
+        cur.execute(query, param)
+    invalidateCache(tournament_id)
+
+
+def deleteMatches(tournament_id=DEFAULT_TOURNAMENT):
+    """Remove all the match records of the tournament from the database."""
+    if tournament_id in _engines:
+        return _engines[tournament_id].delete_matches()
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        _deleteMatches(cur, tournament_id)
+    invalidateCache(tournament_id)
+
+
+def _deleteMatches(cur, tournament_id):
+    # standings are locked before matches (like by reportRound()), so the
+    # delete doesn't hold rows of matches, which a report waits for, while
+    # it waits for standings held by the report:
+    _lockStandings(cur, tournament_id)
+    # deleting match records of this tournament only, found by index,
+    # trigger sets standings of its players back to zero, readers and
+    # other tournaments aren't blocked:
+    query = "DELETE FROM matches WHERE tournament_id = %s;"
+    param = (tournament_id,)
+    cur.execute(query, param)
+    query = "DELETE FROM counted_rounds WHERE tournament_id = %s;"
+    cur.execute(query, param)
+    # checkpoints of deleted rounds can't be resumed:
+    query = "DELETE FROM checkpoints WHERE tournament_id = %s;"
+    cur.execute(query, param)
+    # tie-breaks aren't kept by the trigger:
+    query = """UPDATE standings
+               SET buchholz = 0, opponent_wins = 0, omw_total = 0,
+                   opponents = 0, omw = 0
+               WHERE tournament_id = %s;"""
+    cur.execute(query, param)
+
+
+def deletePlayers(tournament_id=DEFAULT_TOURNAMENT):
+    """Remove all the player records of the tournament from the database."""
+    if tournament_id in _engines:
+        return _engines[tournament_id].delete_players()
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        _deletePlayers(cur, tournament_id)
+    invalidateCache(tournament_id)
+
+
+def _deletePlayers(cur, tournament_id):
+    # deleting all rows of this tournament from players table, ids are
+    # shared by all tournaments, so id_seq isn't reset any more:
+    _lockStandings(cur, tournament_id)
+    query = "DELETE FROM matches WHERE tournament_id = %s;"
+    param = (tournament_id,)
+    cur.execute(query, param)
+    query = "DELETE FROM counted_rounds WHERE tournament_id = %s;"
+    cur.execute(query, param)
+    query = "DELETE FROM checkpoints WHERE tournament_id = %s;"
+    cur.execute(query, param)
+    query = "DELETE FROM players WHERE tournament_id = %s;"
+    cur.execute(query, param)
+
+
+def countPlayers(tournament_id=DEFAULT_TOURNAMENT):
     """Returns the number of players currently registered."""
-    # connecting to our db:
-    db, cur = connect()
-    # counting number of players:
-    query = "SELECT COUNT(*) FROM players;"
-    cur.execute(query)
-    number_of_players = cur.fetchone()[0]
-    # closing connection:
-    db.close()
+    if tournament_id in _engines:
+        return _engines[tournament_id].count_players()
+    version, number_of_players = _cacheGet(tournament_id, 'count')
+    if number_of_players is not None:
+        return number_of_players
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # counting number of players:
+        query = "SELECT COUNT(*) FROM players WHERE tournament_id = %s;"
+        param = (tournament_id,)
+        cur.execute(query, param)
+        number_of_players = cur.fetchone()[0]
+    _cachePut(tournament_id, 'count', version, number_of_players)
     return number_of_players
 
 
-def registerPlayer(name):
+def registerPlayer(name, tournament_id=DEFAULT_TOURNAMENT):
     """Adds a player to the tournament database.
 
     The database assigns a unique serial id number for the player.  (This
@@ -82,59 +598,215 @@ def registerPlayer(name):
 
     Args:
       name: the player's full name (need not be unique).
+      tournament_id: id of the tournament the player plays in
     """
-    # connecting to our db:
-    db, cur = connect()
-    # adding player inside 'players' table:
-    query = "INSERT INTO players (name) VALUES (%s);"
-    param = (name,)
-    cur.execute(query, param)
-    # writing changes into db:
-    db.commit()
-    # closing connection:
-    db.close()
+    if tournament_id in _engines:
+        _engines[tournament_id].register_player(name)
+        return
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # adding player inside 'players' table:
+        query = "INSERT INTO players (name, tournament_id) VALUES (%s, %s);"
+        param = (name, tournament_id)
+        cur.execute(query, param)
+    invalidateCache(tournament_id)
 
 
-def registerMatch(t_round, winner_id, looser_id):
-    """Adds a match results to the tournament database.
+def _copyText(value):
+    """Escapes value for text format of COPY."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def registerPlayers(names, tournament_id=DEFAULT_TOURNAMENT, use_copy=True):
+    """Adds many players to the tournament database in one transaction.
+
+    Ids are taken from players_id_seq first, then all the players are sent
+    with one COPY, so it takes about the same time as one registerPlayer().
+    If COPY can't be used (use_copy=False), players are added with
+    multi-row INSERT instead.
+
+    Args:
+      names: iterable of the player's full names
+      tournament_id: id of the tournament the players play in
+      use_copy: send players with COPY, not with INSERT
+    Returns:
+      list of ids of the new players, in the same order as names
+    """
+    names = list(names)
+    if not names:
+        return []
+    if tournament_id in _engines:
+        return _engines[tournament_id].register_players(names)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        ids = _insertPlayers(cur, names, tournament_id, use_copy)
+    invalidateCache(tournament_id)
+    return ids
+
+
+def _insertPlayers(cur, names, tournament_id, use_copy=True):
+    if use_copy:
+        query = """SELECT nextval('players_id_seq')
+                   FROM generate_series(1, %s);"""
+        param = (len(names),)
+        cur.execute(query, param)
+        ids = [row[0] for row in cur]
+        data = StringIO()
+        for player_id, name in zip(ids, names):
+            data.write("%d\t%d\t%s\n" % (player_id, tournament_id,
+                                         _copyText(name)))
+        data.seek(0)
+        query = "COPY players (id, tournament_id, name) FROM STDIN;"
+        cur.copy_expert(query, data)
+    else:
+        query = """INSERT INTO players (name, tournament_id) VALUES %s
+                   RETURNING id;"""
+        rows = [(name, tournament_id) for name in names]
+        ids = [row[0] for row in execute_values(
+            cur, query, rows, page_size=BATCH_SIZE, fetch=True)]
+    return ids
+
+
+def readNames(filename):
+    """Reads names of players from a file. File is either a CSV file (name
+    is in the first column, header 'name' is skipped) or a text file with
+    one name on each line.
+
+    Args:
+      filename: name of the file, '-' for standard input
+    Returns:
+      list of names
+    """
+    if filename == '-':
+        lines = sys.stdin
+    else:
+        lines = open(filename)
+    try:
+        if filename.endswith('.csv'):
+            names = [row[0].strip() for row in csv.reader(lines)
+                     if row and row[0].strip()]
+            if names and names[0].lower() == 'name':
+                names = names[1:]
+        else:
+            names = [line.strip() for line in lines if line.strip()]
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    return names
+
+
+def importPlayers(filename, tournament_id=DEFAULT_TOURNAMENT):
+    """Registers players from a file (see readNames()) with
+    registerPlayers().
+
+    Args:
+      filename: name of the file, '-' for standard input
+      tournament_id: id of the tournament the players play in
+    Returns:
+      list of ids of the new players
+    """
+    return registerPlayers(readNames(filename), tournament_id)
+
+
+def registerMatch(t_round, winner_id, looser_id,
+                  tournament_id=DEFAULT_TOURNAMENT):
+    """Adds a match results to the tournament database. Standings are
+    derived from matches, so it's the same as
+    reportMatch(winner_id, looser_id, t_round), don't call both.
 
     Args:
       round: current round
       winner_id: id_of the winner for the pair
       looser_id: id of looser in the pair
+      tournament_id: id of the tournament
     """
-    # connecting to our db:
-    db, cur = connect()
-    # adding player inside 'players' table:
-    query = """INSERT INTO matches (round, winner_id, looser_id) VALUES
-               (%s, %s, %s);"""
-    param = (t_round, winner_id, looser_id)
-    cur.execute(query, param)
-    # writing changes into db:
-    db.commit()
-    # closing connection:
-    db.close()
-
-
-def getMatchesResults():
-    """Returns a list of results for all matches."""
-    # connecting to our db:
-    db, cur = connect()
-    # selecting all info about players, ordering by wins:
-    query = "SELECT * FROM matches_results;"
-    cur.execute(query)
-    all_matches = cur.fetchall()
-    # closing connection:
-    db.close()
+    reportMatch(winner_id, looser_id, t_round, tournament_id)
+
+
+def getMatchesResults(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns a list of results for all matches of the tournament in order
+    of rounds, looks like
+    [(round, winner_id, winner_name, looser_id, looser_name),...],
+    looser is None for a free win."""
+    if tournament_id in _engines:
+        return _engines[tournament_id].matches_results()
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # selecting all info about matches:
+        query = """SELECT round, winner_id, winner_name, looser_id,
+                          looser_name
+                   FROM matches_results WHERE tournament_id = %s
+                   ORDER BY round, id;"""
+        param = (tournament_id,)
+        cur.execute(query, param)
+        all_matches = cur.fetchall()
     return all_matches
 
 
-def playerStandings():
+def playerHistory(player_id, tournament_id=DEFAULT_TOURNAMENT):
+    """Returns all matches of one player in order of rounds, read by
+    'matches_winner' and 'matches_looser' indexes.
+
+    Returns:
+      A list of tuples, each of which contains (round, opponent_id,
+      opponent_name, won), opponent is None for a free win
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].player_history(player_id)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = """SELECT matches.round, matches.looser_id, players.name,
+                          TRUE AS won, matches.id
+                   FROM matches LEFT JOIN players
+                   ON matches.looser_id = players.id
+                   WHERE matches.winner_id = %(p)s
+                   AND matches.tournament_id = %(t)s
+                   UNION ALL
+                   SELECT matches.round, matches.winner_id, players.name,
+                          FALSE, matches.id
+                   FROM matches INNER JOIN players
+                   ON matches.winner_id = players.id
+                   WHERE matches.looser_id = %(p)s
+                   AND matches.tournament_id = %(t)s
+                   ORDER BY 1, 5;"""
+        param = {'p': player_id, 't': tournament_id}
+        cur.execute(query, param)
+        history = [row[:4] for row in cur.fetchall()]
+    return history
+
+
+def havePlayed(id1, id2, tournament_id=DEFAULT_TOURNAMENT):
+    """Returns True if two players already met, checked by 'matches_pair'
+    index without reading the whole history."""
+    if tournament_id in _engines:
+        return _engines[tournament_id].have_played(id1, id2)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # the same expressions as in 'matches_pair', so it's used:
+        query = """SELECT EXISTS (
+                       SELECT 1 FROM matches
+                       WHERE tournament_id = %(t)s AND looser_id IS NOT NULL
+                       AND LEAST(winner_id, looser_id) = LEAST(%(a)s, %(b)s)
+                       AND GREATEST(winner_id, looser_id) =
+                           GREATEST(%(a)s, %(b)s));"""
+        param = {'t': tournament_id, 'a': id1, 'b': id2}
+        cur.execute(query, param)
+        played = cur.fetchone()[0]
+    return played
+
+
+def playerStandings(tournament_id=DEFAULT_TOURNAMENT):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a
-    player tied for first place if there is currently a tie.
+    player tied for first place if there is currently a tie. Players with
+    equal wins are ordered by tie-breaks, see STANDINGS_ORDER.
 
+    Args:
+      tournament_id: id of the tournament
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
         id: the player's unique id (assigned by the database)
@@ -142,48 +814,446 @@ def playerStandings():
         wins: the number of matches the player has won
         matches: the number of matches the player has played
     """
-    # connecting to our db:
-    db, cur = connect()
-    # selecting all info about players, ordering by wins:
-    query = "SELECT * FROM players ORDER BY wins DESC;"
-    cur.execute(query)
-    standings = cur.fetchall()
-    # closing connection:
-    db.close()
+    if tournament_id in _engines:
+        return _engines[tournament_id].standings()
+    # the list is copied, so callers can't change the cached one:
+    version, standings = _cacheGet(tournament_id, 'standings')
+    if standings is not None:
+        return list(standings)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # selecting all info about players, ordering by wins:
+        param = (tournament_id,)
+        if USE_PREPARED:
+            executePrepared(cur, 'player_standings', param)
+        else:
+            query = """SELECT id, name, wins, matches FROM player_standings
+                       WHERE tournament_id = %s ORDER BY """ + STANDINGS_ORDER
+            cur.execute(query, param)
+        standings = cur.fetchall()
+    _cachePut(tournament_id, 'standings', version, list(standings))
     return standings
 
 
-def reportMatch(winner, loser):
+def iterStandings(tournament_id=DEFAULT_TOURNAMENT, batch_size=BATCH_SIZE):
+    """Yields the players and their win records one by one, in the same
+    order as playerStandings(). Rows are read from a server-side cursor,
+    'batch_size' rows at a time, so memory doesn't grow with the field.
+
+    Args:
+      tournament_id: id of the tournament
+      batch_size: number of rows fetched from the server at once
+    Yields:
+      tuples (id, name, wins, matches)
+    """
+    if tournament_id in _engines:
+        for player in _engines[tournament_id].standings():
+            yield player
+        return
+    version, standings = _cacheGet(tournament_id, 'standings')
+    if standings is not None:
+        for player in standings:
+            yield player
+        return
+    # rows are kept for the cache only while they fit in it, so the
+    # generator still needs no more memory than the cache:
+    kept = []
+    # taking connection from the pool, it's held until the generator ends:
+    with dbCursor() as (db, cur):
+        named = db.cursor(name="standings", cursor_factory=cursor_factory)
+        named.itersize = batch_size
+        query = """SELECT id, name, wins, matches FROM player_standings
+                   WHERE tournament_id = %s ORDER BY """ + STANDINGS_ORDER
+        param = (tournament_id,)
+        named.execute(query, param)
+        for player in named:
+            if kept is not None:
+                kept.append(player)
+                if len(kept) > CACHE_ROWS:
+                    kept = None
+            yield player
+        named.close()
+    if kept is not None:
+        _cachePut(tournament_id, 'standings', version, kept)
+
+
+def topStandings(k, tournament_id=DEFAULT_TOURNAMENT):
+    """Returns first k players of playerStandings(), read by index.
+
+    Args:
+      k: number of players
+      tournament_id: id of the tournament
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].standings()[:k]
+    standings = _cacheGet(tournament_id, 'standings')[1]
+    if standings is not None:
+        return standings[:k]
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = """SELECT id, name, wins, matches FROM player_standings
+                   WHERE tournament_id = %s
+                   ORDER BY """ + STANDINGS_ORDER + """ LIMIT %s;"""
+        param = (tournament_id, k)
+        cur.execute(query, param)
+        standings = cur.fetchall()
+    return standings
+
+
+def standingsPage(after=None, limit=100, tournament_id=DEFAULT_TOURNAMENT):
+    """Returns one page of playerStandings(), found by keyset: the page
+    starts right after the given player, so every page is read from the
+    index and costs the same, however deep it is.
+
+    Args:
+      after: last row (id, name, wins, matches) of the previous page,
+             None for the first page
+      limit: number of players on the page
+      tournament_id: id of the tournament
+    Returns:
+      A list of tuples (id, name, wins, matches), empty after the last page
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].standings_page(after, limit)
+    if after is None:
+        return topStandings(limit, tournament_id)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # players placed after the given one, the whole key (with
+        # tie-breaks) is taken from its standings, so the page is one range
+        # of 'standings_order' index:
+        query = """SELECT id, name, wins, matches FROM player_standings
+                   WHERE tournament_id = %(t)s
+                   AND (wins, buchholz, omw, opponent_wins, id) <
+                       (SELECT wins, buchholz, omw, opponent_wins, player_id
+                        FROM standings WHERE player_id = %(id)s)
+                   ORDER BY """ + STANDINGS_ORDER + """
+                   LIMIT %(limit)s;"""
+        param = {'t': tournament_id, 'id': after[0], 'limit': limit}
+        cur.execute(query, param)
+        standings = cur.fetchall()
+    return standings
+
+
+def reportMatch(winner, loser, t_round=0, tournament_id=DEFAULT_TOURNAMENT):
     """Records the outcome of a single match between two players.
 
+    Many scorekeepers can report at the same time: a result of a known
+    round, which is already recorded, is not recorded again, so reports can
+    be repeated safely. A different result of the same pair in the same
+    round raises ValueError and is not recorded.
+
     Args:
       winner:  the id number of the player who won
       loser:  the id number of the player who lost
+      t_round: round of the match, 0 if unknown
+      tournament_id: id of the tournament
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].report_match(winner, loser, t_round)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        _insertMatch(cur, t_round, winner, loser, tournament_id)
+    invalidateCache(tournament_id)
+
+
+def _insertMatch(cur, t_round, winner, loser, tournament_id):
+    # adding match inside 'matches' table, standings of both
+    # players are updated by the trigger:
+    if USE_PREPARED:
+        executePrepared(cur, 'insert_match',
+                        (tournament_id, t_round, winner, loser))
+    else:
+        param = {'t': tournament_id, 'r': t_round, 'w': winner, 'l': loser}
+        cur.execute(INSERT_MATCH, param)
+    if cur.fetchone() is None:
+        # the pair (or the free win) is already in this round:
+        _checkReported(cur, t_round, [(winner, loser)], tournament_id)
+
+
+def _checkReported(cur, t_round, results, tournament_id):
+    """Raises ValueError if a result, which wasn't inserted because its
+    pair (or free win) is already recorded in the round, differs from the
+    recorded one.
+
+    Args:
+      cur: cursor of the transaction, which reported the results
+      t_round: round of the results
+      results: list of tuples (winner_id, looser_id)
+      tournament_id: id of the tournament
     """
-    # connecting to our db:
-    db, cur = connect()
-    # updating info about players:
-    query = """UPDATE players SET wins = wins + 1,
-               matches = matches + 1 WHERE id = (%s);"""
-    param = (winner,)
+    winners = [winner_id for winner_id, looser_id in results if looser_id]
+    loosers = [looser_id for winner_id, looser_id in results if looser_id]
+    byes = [winner_id for winner_id, looser_id in results if not looser_id]
+    query = """SELECT matches.winner_id, matches.looser_id
+               FROM matches,
+                    unnest(%(w)s::int[], %(l)s::int[]) AS results
+                    (winner_id, looser_id)
+               WHERE matches.tournament_id = %(t)s
+               AND matches.round = %(r)s AND matches.looser_id IS NOT NULL
+               AND LEAST(matches.winner_id, matches.looser_id) =
+                   LEAST(results.winner_id, results.looser_id)
+               AND GREATEST(matches.winner_id, matches.looser_id) =
+                   GREATEST(results.winner_id, results.looser_id)
+               UNION ALL
+               SELECT winner_id, NULL FROM matches
+               WHERE tournament_id = %(t)s AND round = %(r)s
+               AND looser_id IS NULL AND winner_id = ANY(%(b)s::int[]);"""
+    param = {'t': tournament_id, 'r': t_round, 'w': winners, 'l': loosers,
+             'b': byes}
     cur.execute(query, param)
-    query = """UPDATE players SET
-               matches = matches + 1 WHERE id = (%s);"""
-    param = (loser,)
+    reported = set(cur.fetchall())
+    for winner_id, looser_id in results:
+        if (winner_id, looser_id or None) not in reported:
+            raise ValueError("result of %s and %s in round %s differs from "
+                             "the reported one" % (winner_id, looser_id,
+                                                   t_round))
+
+
+def _lockStandings(cur, tournament_id):
+    """Locks standings of all players of the tournament until the end of
+    the transaction, in order of player_id like the trigger of matches
+    does, so the transaction can't deadlock with reports of matches."""
+    query = """SELECT 1 FROM standings WHERE tournament_id = %s
+               ORDER BY player_id FOR UPDATE;"""
+    cur.execute(query, (tournament_id,))
+
+
+def _lockRound(cur, t_round, tournament_id):
+    """Takes the round of the tournament for the transaction alone, until
+    it ends. Inserts of single matches (INSERT_MATCH) share this lock, so
+    the transaction waits for reports of the round in progress and new
+    ones wait for it. Locks are taken in this order: the round, standings
+    of the tournament, rows of matches, so two writers of the round never
+    wait for each other's uncommitted matches while holding standings."""
+    query = "SELECT pg_advisory_xact_lock(%s, %s);"
+    cur.execute(query, (tournament_id, t_round))
+
+
+def reportRound(t_round, results, tournament_id=DEFAULT_TOURNAMENT):
+    """Records the outcomes of all matches of one round in one transaction.
+
+    All matches of the round, free wins included, are written with one
+    multi-row statement, so the round is either reported completely or not
+    at all, and standings of all its players are refreshed together.
+    Results already recorded (by reportMatch() of a scorekeeper, or by
+    this round reported before) aren't recorded again, matches of the
+    round reported by reportMatch() are counted in tie-breaks with it; a
+    result different from the recorded one raises ValueError and nothing
+    of the round is recorded. Reports of single matches of the round wait
+    until it is recorded.
+
+    Args:
+      t_round: current round
+      results: list of tuples (winner_id, looser_id) for each pair,
+               looser_id is None for a player who got a free win
+      tournament_id: id of the tournament
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].report_round(t_round, results)
+    players = []
+    for winner_id, looser_id in results:
+        players.append(winner_id)
+        if looser_id is not None:
+            players.append(looser_id)
+    if len(set(players)) != len(players):
+        raise ValueError("player can't play twice in one round")
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        _insertRound(cur, t_round, results, tournament_id)
+    invalidateCache(tournament_id)
+
+
+def reportPairs(t_round, pairs, tournament_id=DEFAULT_TOURNAMENT):
+    """Records pairs of the round before it is played, for a storage which
+    keeps the record of pairings (like eventlog.EventLog). The database
+    keeps only results, so without an engine nothing is done.
+
+    Args:
+      t_round: current round
+      pairs: list of tuples (id1, id2), id2 is 0 for BYE
+      tournament_id: id of the tournament
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].report_pairs(t_round, pairs)
+
+
+def _insertRound(cur, t_round, results, tournament_id):
+    # reports of single matches of the round are finished first, then
+    # standings of the tournament can't change until the round is written,
+    # tie-breaks are computed from them:
+    _lockRound(cur, t_round, tournament_id)
+    _lockStandings(cur, tournament_id)
+    # adding matches inside 'matches' table:
+    matches = [(tournament_id, t_round, winner_id, looser_id)
+               for winner_id, looser_id in results]
+    query = """INSERT INTO matches (tournament_id, round, winner_id,
+               looser_id) VALUES %s
+               ON CONFLICT DO NOTHING RETURNING winner_id, looser_id;"""
+    inserted = execute_values(cur, query, matches, page_size=BATCH_SIZE,
+                              fetch=True)
+    if len(inserted) < len(matches):
+        inserted = set(inserted)
+        _checkReported(cur, t_round,
+                       [(winner_id, looser_id)
+                        for winner_id, looser_id in results
+                        if (winner_id, looser_id) not in inserted],
+                       tournament_id)
+    if len(inserted) >= ANALYZE_ROWS:
+        cur.execute("ANALYZE matches;")
+    # standings are already updated by the trigger, matches of the round
+    # reported before (by reportMatch()) are counted in tie-breaks too:
+    _updateTieBreaks(cur, t_round, tournament_id)
+
+
+def _updateTieBreaks(cur, t_round, tournament_id):
+    """Updates tie-breaks of the tournament after its round is reported.
+
+    Only players of the round have new records, so tie-break of a player
+    changes by the difference of records of its opponents who played this
+    round (and by the whole record of his new opponent). Only these
+    differences are added, tie-breaks aren't recomputed over all rounds.
+    Rounds must be reported in order.
+
+    Only matches of the round, which aren't counted yet (with ids above
+    last_match_id of counted_rounds), are counted, so a round reported in
+    parts, or by reportMatch() before, has each match counted once.
+
+    Args:
+      cur: cursor of the transaction, which reported the round
+      t_round: reported round
+      tournament_id: id of the tournament
+    """
+    param = {'t': tournament_id, 'r': t_round}
+    query = """SELECT last_match_id FROM counted_rounds
+               WHERE tournament_id = %(t)s AND round = %(r)s;"""
+    cur.execute(query, param)
+    row = cur.fetchone()
+    param['c'] = row[0] if row else 0
+    query = """SELECT MAX(id) FROM matches
+               WHERE tournament_id = %(t)s AND round = %(r)s
+               AND id > %(c)s;"""
+    cur.execute(query, param)
+    param['l'] = cur.fetchone()[0]
+    if param['l'] is None:
+        # all matches of the round are counted
+        return
+    # 'round_results' are matches of the round, which aren't counted yet,
+    # 'moved' are records of their players after the round and before it,
+    # 'meetings' are all matches up to this round, seen by both players:
+    query = """WITH round_results AS (
+                   SELECT winner_id AS player_id, 1 AS won,
+                          CASE WHEN looser_id IS NULL THEN 1 ELSE 0 END
+                          AS bye
+                   FROM matches
+                   WHERE tournament_id = %(t)s AND round = %(r)s
+                   AND id > %(c)s
+                   UNION ALL
+                   SELECT looser_id, 0, 0 FROM matches
+                   WHERE tournament_id = %(t)s AND round = %(r)s
+                   AND id > %(c)s AND looser_id IS NOT NULL
+               ), moved AS (
+                   SELECT standings.player_id, standings.wins,
+                          standings.wins - results.won AS old_wins,
+                          standings.wins - standings.byes AS real_wins,
+                          standings.wins - standings.byes - results.won +
+                          results.bye AS old_real_wins,
+                          ROUND(GREATEST(1.0 / 3, standings.wins::numeric /
+                                         standings.matches), 6) AS pct,
+                          CASE WHEN standings.matches > 1
+                          THEN ROUND(GREATEST(1.0 / 3,
+                                              (standings.wins - results.won)
+                                              ::numeric /
+                                              (standings.matches - 1)), 6)
+                          ELSE 0 END AS old_pct
+                   FROM standings INNER JOIN round_results AS results
+                   ON results.player_id = standings.player_id
+               ), meetings AS (
+                   SELECT winner_id AS player_id, looser_id AS opponent_id,
+                          round
+                   FROM matches
+                   WHERE tournament_id = %(t)s AND round <= %(r)s
+                   AND looser_id IS NOT NULL
+                   UNION ALL
+                   SELECT looser_id, winner_id, round FROM matches
+                   WHERE tournament_id = %(t)s AND round <= %(r)s
+                   AND looser_id IS NOT NULL
+               ), delta AS (
+                   SELECT meetings.player_id,
+                          SUM(CASE WHEN meetings.round = %(r)s
+                              THEN moved.wins
+                              ELSE moved.wins - moved.old_wins END)
+                          AS buchholz,
+                          SUM(CASE WHEN meetings.round = %(r)s
+                              THEN moved.real_wins
+                              ELSE moved.real_wins - moved.old_real_wins END)
+                          AS opponent_wins,
+                          SUM(CASE WHEN meetings.round = %(r)s
+                              THEN moved.pct
+                              ELSE moved.pct - moved.old_pct END)
+                          AS omw_total,
+                          SUM(CASE WHEN meetings.round = %(r)s
+                              THEN 1 ELSE 0 END) AS opponents
+                   FROM meetings INNER JOIN moved
+                   ON moved.player_id = meetings.opponent_id
+                   GROUP BY meetings.player_id
+               )
+               UPDATE standings
+               SET buchholz = standings.buchholz + delta.buchholz,
+                   opponent_wins = standings.opponent_wins +
+                                   delta.opponent_wins,
+                   omw_total = standings.omw_total + delta.omw_total,
+                   opponents = standings.opponents + delta.opponents,
+                   omw = COALESCE(ROUND(
+                       (standings.omw_total + delta.omw_total) /
+                       NULLIF(standings.opponents + delta.opponents, 0),
+                       6), 0)
+               FROM delta WHERE standings.player_id = delta.player_id;"""
+    cur.execute(query, param)
+    query = """INSERT INTO counted_rounds (tournament_id, round,
+                                          last_match_id)
+               VALUES (%(t)s, %(r)s, %(l)s)
+               ON CONFLICT (tournament_id, round)
+               DO UPDATE SET last_match_id = EXCLUDED.last_match_id;"""
     cur.execute(query, param)
-    # writing changes into db:
-    db.commit()
-    # closing connection:
-    db.close()
 
 
-def swissPairings():
+def playerTieBreaks(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns the players with their tie-breaks, in the order of
+    playerStandings().
+
+    Returns:
+      A list of tuples (id, wins, buchholz, omw, opponent_wins):
+        buchholz: sum of wins of all opponents
+        omw: average match-win percentage of opponents, each at least 1/3
+        opponent_wins: sum of wins of all opponents without free wins
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].tie_breaks()
+    version, tie_breaks = _cacheGet(tournament_id, 'tie_breaks')
+    if tie_breaks is not None:
+        return list(tie_breaks)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = """SELECT id, wins, buchholz, omw, opponent_wins
+                   FROM player_standings
+                   WHERE tournament_id = %s ORDER BY """ + STANDINGS_ORDER
+        param = (tournament_id,)
+        cur.execute(query, param)
+        tie_breaks = cur.fetchall()
+    _cachePut(tournament_id, 'tie_breaks', version, list(tie_breaks))
+    return tie_breaks
+
+
+def swissPairings(tournament_id=DEFAULT_TOURNAMENT):
     """Returns a list of pairs of players for the next round of a match.
 
     Assuming that there are an even number of players registered, each player
     appears exactly once in the pairings.  Each player is paired with another
     player with an equal or nearly-equal win record, that is, a player adjacent
     to him or her in the standings.
+    Args:
+      tournament_id: id of the tournament
     Returns:
         list_of_pairs: A list of tuples, looks like
         [(id1, name1, id2, name2),...]
@@ -192,155 +1262,363 @@ def swissPairings():
           id2: the second player's unique id
           name2: the second player's name
     """
-    # retrieving list of tuples with all data
-    standings = playerStandings()
-    # reverse standings for more comfortable use of pop() function,
-    # to pop() form top of the standings list
-    standings = list(reversed(standings))
-    # preparing returned value
-    list_of_pairs = []
-    count = 0
-    pair = []
-    while standings:
-        # remove two players from 'standings' list
-        # and appending them to list_of_pairs
-        for count in xrange(2):
-            # use try, because maybe we have odd number of players,
-            # if it's true, then there will be a moment when I'll pop all
-            # all the players except one and then
-            # there will be a try to pop from empty list and it will
-            # be an IndexError
-            try:
-                pair.append(standings.pop()[0:2])
-            except IndexError:
-                # if there is a player (it will be only one in 'pair' list)
-                # I will add BYE player to him.
-                # creating pair with BYE player:
-                pair = (pair[0][0], pair[0][1], 0, 'BYE')
-                list_of_pairs.append(pair)
-                break
-        # if there wasn't any break inside for loop:
-        else:
-            pair = (pair[0][0], pair[0][1], pair[1][0], pair[1][1])
-            list_of_pairs.append(pair)
-            count = 0
-            pair = []
-    return list_of_pairs
+    # standings are read from server-side cursor and paired on the fly,
+    # see pairing.swiss_pairs(); inside a group of equal wins players come
+    # in the order of their tie-breaks, stored with standings:
+    if tournament_id in _engines:
+        return _engines[tournament_id].swiss_pairings()
+    return pairing.swiss_pairs(iterStandings(tournament_id))
+
+
+def playedPairs(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns index of all pairs of players who already met, rebuilt from
+    'matches' table. Free wins are stored in it as pairs with BYE (id 0).
 
+    Returns:
+      played: PlayedPairs index
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].played.copy()
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = """SELECT winner_id, COALESCE(looser_id, 0) FROM matches
+                   WHERE tournament_id = %s;"""
+        param = (tournament_id,)
+        cur.execute(query, param)
+        played = PlayedPairs.from_matches(cur)
+    return played
 
-def giveFreeWin(unpaired):
+
+def swissPairingsMatched(played=None, tournament_id=DEFAULT_TOURNAMENT):
+    """Returns a list of pairs of players for the next round, like
+    swissPairings(), but without rematches whenever it is possible: pairs
+    are found by maximum-weight matching over the standings, see
+    pairing.matched_pairings().
+
+    Args:
+      played: PlayedPairs index of pairs which already met (or list of all
+              pairs for all previous rounds), read from 'matches' table
+              if not given
+      tournament_id: id of the tournament
+    Returns:
+      list_of_pairs: A list of tuples [(id1, name1, id2, name2),...]
+    """
+    if tournament_id in _engines:
+        return _engines[tournament_id].matched_pairings(played)
+    if played is None:
+        played = playedPairs(tournament_id)
+    return pairing.matched_pairings(playerStandings(tournament_id), played)
+
+
+def giveFreeWin(unpaired, t_round=0, tournament_id=DEFAULT_TOURNAMENT):
     """Give free win to a player without a pair in case of odd number
     of players
     Args:
       unpaired: the id number of lonely player
+      t_round: current round, 0 if unknown
+      tournament_id: id of the tournament
     """
-    # connecting to our db:
-    db, cur = connect()
-    # giving free win:
-    query = """UPDATE players SET wins = wins + 1,
-               matches = matches + 1 WHERE id = (%s);"""
-    param = (unpaired,)
+    # giving free win, it's a match without looser:
+    reportMatch(unpaired, None, t_round, tournament_id)
+
+
+def refreshStandings(tournament_id=DEFAULT_TOURNAMENT):
+    """Rebuilds standings of the tournament, tie-breaks included, from
+    'matches' table. Triggers and reportRound() keep standings up to date,
+    this is only needed to repair them, or after matches were reported
+    out of rounds order."""
+    if tournament_id in _engines:
+        # engine derives standings from its matches each time
+        return
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        _refreshStandings(cur, tournament_id)
+    invalidateCache(tournament_id)
+
+
+def _refreshStandings(cur, tournament_id):
+    _lockStandings(cur, tournament_id)
+    # records are set to zero first, then only players with matches are
+    # updated, joined by primary key (like in count_matches trigger),
+    # so no outer join of all players with the aggregate is needed:
+    query = """UPDATE standings
+               SET wins = 0, matches = 0, byes = 0, buchholz = 0,
+                   opponent_wins = 0, omw_total = 0, opponents = 0,
+                   omw = 0
+               WHERE tournament_id = %(t)s;"""
+    param = {'t': tournament_id}
+    cur.execute(query, param)
+    query = """UPDATE standings
+               SET wins = played.wins, matches = played.matches,
+                   byes = played.byes
+               FROM (SELECT player_id, SUM(won) AS wins,
+                            COUNT(*) AS matches, SUM(bye) AS byes
+                     FROM (SELECT winner_id AS player_id, 1 AS won,
+                                  CASE WHEN looser_id IS NULL THEN 1
+                                  ELSE 0 END AS bye
+                           FROM matches WHERE tournament_id = %(t)s
+                           UNION ALL
+                           SELECT looser_id, 0, 0 FROM matches
+                           WHERE tournament_id = %(t)s
+                           AND looser_id IS NOT NULL) AS results
+                     GROUP BY player_id) AS played
+               WHERE standings.player_id = played.player_id;"""
+    cur.execute(query, param)
+    # tie-breaks from the records of all opponents:
+    query = """WITH records AS (
+                   SELECT player_id, wins, wins - byes AS real_wins,
+                          CASE WHEN matches > 0
+                          THEN ROUND(GREATEST(1.0 / 3,
+                                              wins::numeric / matches), 6)
+                          ELSE 0 END AS pct
+                   FROM standings WHERE tournament_id = %(t)s
+               ), meetings AS (
+                   SELECT winner_id AS player_id, looser_id AS opponent_id
+                   FROM matches
+                   WHERE tournament_id = %(t)s AND looser_id IS NOT NULL
+                   UNION ALL
+                   SELECT looser_id, winner_id FROM matches
+                   WHERE tournament_id = %(t)s AND looser_id IS NOT NULL
+               ), totals AS (
+                   SELECT meetings.player_id,
+                          SUM(records.wins) AS buchholz,
+                          SUM(records.real_wins) AS opponent_wins,
+                          SUM(records.pct) AS omw_total,
+                          COUNT(*) AS opponents
+                   FROM meetings INNER JOIN records
+                   ON records.player_id = meetings.opponent_id
+                   GROUP BY meetings.player_id
+               )
+               UPDATE standings
+               SET buchholz = totals.buchholz,
+                   opponent_wins = totals.opponent_wins,
+                   omw_total = totals.omw_total,
+                   opponents = totals.opponents,
+                   omw = ROUND(totals.omw_total / totals.opponents, 6)
+               FROM totals WHERE standings.player_id = totals.player_id;"""
     cur.execute(query, param)
-    # writing changes into db:
-    db.commit()
-    # closing connection:
-    db.close()
+    # all matches are counted in tie-breaks now:
+    query = "DELETE FROM counted_rounds WHERE tournament_id = %(t)s;"
+    cur.execute(query, param)
+    query = """INSERT INTO counted_rounds (tournament_id, round,
+                                          last_match_id)
+               SELECT tournament_id, round, MAX(id) FROM matches
+               WHERE tournament_id = %(t)s
+               GROUP BY tournament_id, round;"""
+    cur.execute(query, param)
+
 
+def saveCheckpoint(t_round, rounds, random_state,
+                   tournament_id=DEFAULT_TOURNAMENT):
+    """Saves state of the tournament after a completed round, main() calls
+    it after reportRound() of each round, so resuming needs nothing but
+    the last checkpoint and 'matches' table.
 
-def preventRematch(all_pairs, pairs_list):
-    """Checking if any pair from current (for this round) pairs list is
-       already is in all_pairs list (list of pairs for all rounds) and
-       fixing this by shuffeling players
     Args:
-      all_pairs: 'all_pairs' - list of all pairs for all rounds,
-                  looks like [(id1, name1, id2, name2),()...]
-      pairs_list: list of pairs for current round, looks like
-                  [(id1, name1, id2, name2),()...]
+      t_round: the completed round, 0 before the first one
+      rounds: planned number of rounds
+      random_state: getstate() of the generator of outcomes
+      tournament_id: id of the tournament
+    """
+    if tournament_id in _engines:
+        # written by the storage of the engine after results of the round
+        return _engines[tournament_id].save_checkpoint(t_round, rounds,
+                                                       random_state)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        _saveCheckpoint(cur, t_round, rounds, random_state, tournament_id)
+
+
+def _saveCheckpoint(cur, t_round, rounds, random_state, tournament_id):
+    # drawing of the round may already be saved, it's kept:
+    query = """INSERT INTO checkpoints (tournament_id, round, rounds,
+                                        random_state)
+               VALUES (%s, %s, %s, %s)
+               ON CONFLICT (tournament_id, round) DO UPDATE
+               SET rounds = EXCLUDED.rounds,
+                   random_state = EXCLUDED.random_state;"""
+    state = psycopg2.Binary(pickle.dumps(random_state,
+                                         pickle.HIGHEST_PROTOCOL))
+    param = (tournament_id, t_round, rounds, state)
+    cur.execute(query, param)
+
+
+def saveDrawing(t_round, tournament_id=DEFAULT_TOURNAMENT):
+    """Saves what the scene of gen_and_run_html drew since the previous
+    call, with positions of names after it, as drawing of the round. It's
+    called where the scene is, so with RoundPipeline it runs in the
+    renderer process.
+    """
+    import gen_and_run_html
+    scene = gen_and_run_html.scene
+    elements, lines, names = scene.changes()
+    positions = psycopg2.Binary(pickle.dumps(scene.positions,
+                                             pickle.HIGHEST_PROTOCOL))
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        # state of the round may already be saved, it's kept:
+        query = """INSERT INTO checkpoints (tournament_id, round, elements,
+                                            lines, names, positions)
+                   VALUES (%s, %s, %s, %s, %s, %s)
+                   ON CONFLICT (tournament_id, round) DO UPDATE
+                   SET elements = EXCLUDED.elements,
+                       lines = EXCLUDED.lines, names = EXCLUDED.names,
+                       positions = EXCLUDED.positions;"""
+        param = (tournament_id, t_round, elements, lines, names, positions)
+        cur.execute(query, param)
+
+
+def lastCheckpoint(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns (round, rounds) of the last checkpoint of the tournament,
+    None if it has none. The tournament was stopped in the middle, if
+    round < rounds."""
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = """SELECT round, rounds FROM checkpoints
+                   WHERE tournament_id = %s AND random_state IS NOT NULL
+                   ORDER BY round DESC LIMIT 1;"""
+        param = (tournament_id,)
+        cur.execute(query, param)
+        return cur.fetchone()
+
+
+def loadCheckpoint(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns the last checkpoint of the tournament, None if it has none.
+    Rounds reported after it (the run stopped between reportRound() and
+    saveCheckpoint()) have no state to continue from, so their matches
+    are deleted and they are played again.
+
     Returns:
-      pairs_list: A list of fixed pairs
-                  [(id_fixed, name_fixed, id2, name2),()...]
-    """
-    for index, pair in enumerate(pairs_list):
-        reversed_pair = (pair[2], pair[3], pair[0], pair[1])
-        j = -1
-        while ((pair in all_pairs or reversed_pair in all_pairs) and
-                index + j >= 0):
-            if (pairs_list[index + j][2], pairs_list[index + j][3],
-                pair[2], pair[3]) not in all_pairs\
-                and (pair[2], pair[3], pairs_list[index + j][2],
-                     pairs_list[index + j][3]) not in all_pairs\
-                and (pairs_list[index + j][0], pairs_list[index + j][1],
-                     pair[0], pair[1]) not in all_pairs\
-                and (pair[0], pair[1], pairs_list[index + j][0],
-                     pairs_list[index + j][1]) not in all_pairs:
-                    pairs_list[index] = (pairs_list[index + j][2],
-                                         pairs_list[index + j][3],
-                                         pair[2], pair[3])
-                    pairs_list[index + j] = (pairs_list[index + j][0],
-                                             pairs_list[index + j][1],
-                                             pair[0], pair[1])
-                    break
-            elif (pairs_list[index + j][0], pairs_list[index + j][1],
-                  pair[2], pair[3]) not in all_pairs\
-                and (pair[2], pair[3], pairs_list[index + j][0],
-                     pairs_list[index + j][1]) not in all_pairs\
-                and (pair[0], pair[1], pairs_list[index + j][2],
-                     pairs_list[index + j][3]) not in all_pairs\
-                and (pairs_list[index + j][2], pairs_list[index + j][3],
-                     pair[0], pair[1]) not in all_pairs:
-                    pairs_list[index] = (pairs_list[index + j][0],
-                                         pairs_list[index + j][1],
-                                         pair[2], pair[3])
-                    pairs_list[index + j] = (pair[0], pair[1],
-                                             pairs_list[index + j][2],
-                                             pairs_list[index + j][3])
-                    break
-            j -= 1
-        else:
-            i = 1
-            while ((pair in all_pairs or reversed_pair in all_pairs) and
-                    index + i <= len(pairs_list) - 1):
-                if (pair[0], pair[1], pairs_list[index + i][0],
-                    pairs_list[index + i][1]) not in all_pairs\
-                    and (pairs_list[index + i][0], pairs_list[index + i][1],
-                         pair[0], pair[1]) not in all_pairs\
-                    and (pair[2], pair[3], pairs_list[index + i][2],
-                         pairs_list[index + i][3]) not in all_pairs\
-                    and (pairs_list[index + i][2], pairs_list[index + i][3],
-                         pair[2], pair[3]) not in all_pairs:
-                    pairs_list[index] = (pair[0], pair[1],
-                                         pairs_list[index + i][0],
-                                         pairs_list[index + i][1])
-                    pairs_list[index + i] = (pair[2], pair[3],
-                                             pairs_list[index + i][2],
-                                             pairs_list[index + i][3])
-                    break
-                elif (pair[0], pair[1], pairs_list[index + i][2],
-                      pairs_list[index + i][3]) not in all_pairs\
-                    and (pairs_list[index + i][2], pairs_list[index + i][3],
-                         pair[0], pair[1]) not in all_pairs\
-                    and (pairs_list[index + i][0], pairs_list[index + i][1],
-                         pair[2], pair[3]) not in all_pairs\
-                    and (pair[2], pair[3], pairs_list[index + i][0],
-                         pairs_list[index + i][1]) not in all_pairs:
-                        pairs_list[index] = (pair[0], pair[1],
-                                             pairs_list[index + i][2],
-                                             pairs_list[index + i][3])
-                        pairs_list[index + i] = (pairs_list[index + i][0],
-                                                 pairs_list[index + i][1],
-                                                 pair[2], pair[3])
-                        break
-                i += 1
-    return pairs_list
+      checkpoint: dict with keys 'round' (the last completed round),
+                  'rounds', 'random_state', 'drawings' - list of tuples
+                  (elements, lines, names) of rounds from 0 to the last
+                  one, None if any of them wasn't drawn, and 'positions'
+                  - gen_and_run_html.Positions after the last round
+    """
+    if tournament_id in _engines:
+        raise ValueError("checkpoints of tournament %s are read from the "
+                         "database, not from its engine" % tournament_id)
+    # taking connection from the pool:
+    with dbCursor() as (db, cur):
+        query = """SELECT round, rounds, random_state FROM checkpoints
+                   WHERE tournament_id = %s AND random_state IS NOT NULL
+                   ORDER BY round DESC LIMIT 1;"""
+        param = (tournament_id,)
+        cur.execute(query, param)
+        row = cur.fetchone()
+        if row is None:
+            return None
+        t_round, rounds, random_state = row
+        param = (tournament_id, t_round)
+        query = """DELETE FROM checkpoints
+                   WHERE tournament_id = %s AND round > %s;"""
+        cur.execute(query, param)
+        _lockStandings(cur, tournament_id)
+        query = """DELETE FROM matches
+                   WHERE tournament_id = %s AND round > %s;"""
+        cur.execute(query, param)
+        if cur.rowcount:
+            # trigger takes back records, tie-breaks are counted again:
+            _refreshStandings(cur, tournament_id)
+        query = """SELECT elements, lines, names, positions FROM checkpoints
+                   WHERE tournament_id = %s AND round <= %s
+                   ORDER BY round;"""
+        cur.execute(query, param)
+        rows = cur.fetchall()
+    invalidateCache(tournament_id)
+    checkpoint = {'round': t_round, 'rounds': rounds,
+                  'random_state': pickle.loads(str(random_state)),
+                  'drawings': None, 'positions': None}
+    if len(rows) == t_round + 1 and \
+            all(positions is not None for _, _, _, positions in rows):
+        checkpoint['drawings'] = [(elements, lines, names)
+                                  for elements, lines, names, _ in rows]
+        checkpoint['positions'] = pickle.loads(str(rows[-1][3]))
+    return checkpoint
+
+
+def _keepsCheckpoints(tournament_id):
+    # checkpoints are kept in the tournament database, so only tournaments
+    # written there have them:
+    if tournament_id not in _engines:
+        return True
+    storage = _engines[tournament_id].storage
+    # AsyncStorage writes to the storage it wraps:
+    storage = getattr(storage, 'storage', storage)
+    return isinstance(storage, PostgresStorage)
+
+
+class PostgresStorage(object):
+    """Storage of engine.TournamentState in the tournament database. It
+    writes with the same queries as module functions, so standings and
+    tie-breaks in the database stay up to date too.
+    """
+
+    def __init__(self, database_name="tournament", use_copy=True):
+        self.database_name = database_name
+        self.use_copy = use_copy
+
+    def load(self, tournament_id):
+        with dbCursor(self.database_name) as (db, cur):
+            query = """SELECT id, name FROM players WHERE tournament_id = %s
+                       ORDER BY id;"""
+            param = (tournament_id,)
+            cur.execute(query, param)
+            players = cur.fetchall()
+            query = """SELECT round, winner_id, looser_id FROM matches
+                       WHERE tournament_id = %s ORDER BY round, id;"""
+            cur.execute(query, param)
+            matches = cur.fetchall()
+        return players, matches
+
+    def register_players(self, tournament_id, names):
+        with dbCursor(self.database_name) as (db, cur):
+            return _insertPlayers(cur, names, tournament_id, self.use_copy)
+
+    def report_match(self, tournament_id, t_round, winner_id, looser_id):
+        with dbCursor(self.database_name) as (db, cur):
+            _insertMatch(cur, t_round, winner_id, looser_id, tournament_id)
 
+    def report_round(self, tournament_id, t_round, results):
+        with dbCursor(self.database_name) as (db, cur):
+            _insertRound(cur, t_round, results, tournament_id)
 
-def prepare():
-    """Doing initial things - asking if user wants
-       to delete or add players into the table"""
+    def report_pairs(self, tournament_id, t_round, pairs):
+        # the database keeps only results
+        pass
+
+    def delete_matches(self, tournament_id):
+        with dbCursor(self.database_name) as (db, cur):
+            _deleteMatches(cur, tournament_id)
+
+    def delete_players(self, tournament_id):
+        with dbCursor(self.database_name) as (db, cur):
+            _deletePlayers(cur, tournament_id)
+
+    def save_checkpoint(self, tournament_id, t_round, rounds, random_state):
+        with dbCursor(self.database_name) as (db, cur):
+            _saveCheckpoint(cur, t_round, rounds, random_state,
+                            tournament_id)
+
+    def flush(self):
+        pass
+
+
+def prepare(tournament_id=DEFAULT_TOURNAMENT):
+    """Doing initial things - asking if user wants to resume the
+       tournament stopped in the middle, or to delete or add players into
+       the table. Returns True, if the tournament is to be resumed"""
+    # checking if the last run stopped before the last round:
+    stopped = lastCheckpoint(tournament_id)
+    if stopped is not None and stopped[0] < stopped[1]:
+        resume = raw_input("Tournament was stopped after round %s of %s, "
+                           "would you like to resume it? y/n\n" % stopped)
+        if resume.lower() == 'y':
+            return True
     # checking if user wants to delete all entities from table
     erase = raw_input("""Would you like to erase players tables? y/n\n""")
     if erase.lower() == 'y':
-        deletePlayers()
+        deletePlayers(tournament_id)
         number_of_players = raw_input("How many players will play?\n")
         number_of_players = int(number_of_players)
         if number_of_players <= 1:
@@ -348,125 +1626,315 @@ def prepare():
             sys.exit()
         # registering players
         print "Please enter names of players, each name on new line"
-        for i in xrange(number_of_players):
-            name = raw_input("Please specify name: ")
-            registerPlayer(name)
+        names = [raw_input("Please specify name: ")
+                 for i in xrange(number_of_players)]
+        registerPlayers(names, tournament_id)
     else:
         add = raw_input("Would you like to add some new players? y/n\n")
         if add.lower() == 'y':
             how_many_to_add = raw_input("How many to add?\n")
             how_many_to_add = int(how_many_to_add)
-            for i in xrange(how_many_to_add):
-                name = raw_input("Please specify name: ")
-                registerPlayer(name)
+            names = [raw_input("Please specify name: ")
+                     for i in xrange(how_many_to_add)]
+            registerPlayers(names, tournament_id)
         # deleting previos matches
-        deleteMatches()
+        deleteMatches(tournament_id)
+    return False
 
 # I've added this function to hold the tournament, had big feeling
 # of incompleteness about our tournament without it...
 
 
-def main():
+def main(tournament_id=DEFAULT_TOURNAMENT, names=None, rounds=None,
+         seed=None, html="tournament.html", browser=True, verbose=True,
+         standings_file=None, pipeline=False, resume=False):
     """Registering players and holds the tournament, printing
-    standings after each round"""
-
-    # preparing for the battle...
-    prepare()
-    # printing initial state:
-    print "Let's get ready to rumble (initial state)"
-    standings = playerStandings()
-
-    # printing players (initial list of names) and fetching function gen_html
-    # inside gen_and_run_html.py,
-    # tuples inside 'standings' list looks like (id, name, wins, matches), so
-    # to get names and id's i must extract element with index 1 and 0, so
-    # 'names' is a list of player's ids and names
-
-    id_n_names = []
-    for player in standings:
-        print player
-        id_n_names.append((player[0], player[1]))
-
-    # gen_html() function makes initial html file with initial list of names.
-    # Result of it returned to 'positions' variable
-    # positions for now - a list, containing initial (before the first round)
-    # positions of all names on canvas, it looks like
-    # [(id1, name1, x_pos1, y_pos1),(id2, name2, x_pos2, y_pos2)...]
-
-    positions = gen_and_run_html.gen_html(id_n_names)
-
-    # holding the tournament
-    # number of rounds is log2 of number of players, so:
-    # to get number of rounds i use math.ceil, it will give us rounded value
-    # e.g. math.log() can produce 2.8422, but math.ceil() will return 3.0,
-    # then take int(), so then we would have 3 round exactly
-
-    number_of_players = countPlayers()
-    rounds = int(math.ceil(math.log(number_of_players, 2)))
-    t_round = 1
-    # 'all_pairs' - list of all pairs for all rounds, used for preventRematch
-    all_pairs = []
-    for i in xrange(rounds):
-        # defining pairs for current round, each element inside
-        # 'pairs_list' looks like (id1, name1, id2, name2)
-        pairs_list = swissPairings()
-        # calling preventRematch for each pair in current round. Only if
-        # round of tournament != 1. Cause if we are in the begining,
-        # then there are no pairs yet
-        if t_round != 1:
-            pairs_list = preventRematch(all_pairs, pairs_list)
-        # appending pairs for this round to 'all_pairs' to fetch preventRematch
-        for pair in pairs_list:
-            all_pairs.append(pair)
-        print "\nPairs for %s round of torunament:" % t_round
-        print pairs_list
-        # randomly defining winners in pairs:
-        # id in pairs_list has index 0 or 2
-        loosers_list = []
-        # save deepcopy of initial postitons list for this round
-        pos_copy = copy.deepcopy(positions)
-        for ind, pair in enumerate(pairs_list):
-            # for lonely player winner is himself. Id of BYE player is 0
-            # index of BYE player in pair list is 2, so
-            if pair[2] == 0:
-                giveFreeWin(pair[0])
-                winner_id = pair[0]
-                positions = gen_and_run_html.drawLines(winner_id,
-                                                       positions,
-                                                       t_round)
-            else:
-                # generate random number: 0 or 2
-                randomed = 2*random.randrange(2)
-                winner_id = pair[randomed]
-                if randomed == 0:
-                    looser_id = pair[2]
-                else:
-                    looser_id = pair[0]
-                # reporting match results:
-                reportMatch(winner_id, looser_id)
-                registerMatch(t_round, winner_id, looser_id)
-                # drawing winner and looser lines for this round inside html
-                positions = gen_and_run_html.drawLines(winner_id, positions,
-                                                       t_round, looser_id)
-                loosers_list.append(looser_id)
-        # checking for collisions of the names on canvas after each round:
-        col_detected, col_ids = gen_and_run_html.check_collisions(positions)
-        if col_detected:
-            positions = gen_and_run_html.fix_collisions(pos_copy, positions,
-                                                        col_ids, loosers_list,
-                                                        t_round)
-        # got new positions of ends of lines, so can draw new list of names
-        positions = gen_and_run_html.drawNames(positions, t_round)
-        # printing out standings:
-        print "\nResults after %s round:" % t_round
-        standings = playerStandings()
+    standings after each round
+
+    Called without arguments it asks for players (see prepare()) and
+    opens the bracket in the browser. Given names it runs without a human:
+    players of the tournament are replaced by them.
+
+    Args:
+      tournament_id: id of the tournament
+      names: names of the players, None to ask for them
+      rounds: number of rounds, log2 of number of players if not given
+      seed: seed of random outcomes of matches
+      html: file for the bracket, None to draw nothing (gen_and_run_html
+            isn't even imported then)
+      browser: open the bracket in the browser at the end
+      verbose: print pairs and standings of every round
+      standings_file: file, where final standings are written as CSV
+      pipeline: write and draw each round in background while the next
+                one is paired, see RoundPipeline
+      resume: continue the tournament from its last checkpoint (see
+              loadCheckpoint()), names, rounds and seed aren't used then
+    Returns:
+      final standings
+    """
+    rng = random.Random(seed)
+    if html:
+        # drawing is needed only here, so the module is imported lazily:
+        import gen_and_run_html
+    # asking for players, unless a stopped tournament is to be resumed:
+    if names is None and not resume:
+        resume = prepare(tournament_id)
+    if resume:
+        # state after the last completed round, its outcomes continue from
+        # the same state of the generator, as if the run never stopped:
+        checkpoint = loadCheckpoint(tournament_id)
+        if checkpoint is None:
+            raise ValueError("tournament %s has no checkpoint to resume"
+                             % tournament_id)
+        rng.setstate(checkpoint['random_state'])
+        rounds = checkpoint['rounds']
+        t_round = checkpoint['round'] + 1
+        print "Resuming the tournament after round %s of %s" % (
+            checkpoint['round'], rounds)
+        if html and checkpoint['drawings'] is not None:
+            gen_and_run_html.restore(checkpoint['drawings'],
+                                     checkpoint['positions'], html)
+        elif html:
+            # rounds before weren't drawn, the bracket starts from the
+            # current standings:
+            gen_and_run_html.gen_html([player[:2] for player in
+                                       playerStandings(tournament_id)], html)
+    else:
+        # preparing for the battle...
+        if names is not None:
+            deletePlayers(tournament_id)
+            registerPlayers(names, tournament_id)
+        # printing initial state:
+        print "Let's get ready to rumble (initial state)"
+        standings = playerStandings(tournament_id)
+
+        # printing players (initial list of names) and fetching function
+        # gen_html inside gen_and_run_html.py,
+        # tuples inside 'standings' list looks like (id, name, wins, matches),
+        # so to get names and id's i must extract element with index 1 and 0,
+        # so 'names' is a list of player's ids and names
+
+        id_n_names = []
         for player in standings:
-            print player
-        t_round += 1
+            if verbose:
+                print player
+            id_n_names.append((player[0], player[1]))
+
+        # gen_html() function makes initial html file with initial list of
+        # names. Positions of all names on canvas (before the first round)
+        # are kept by the scene, they look like
+        # [(id1, name1, x_pos1, y_pos1),(id2, name2, x_pos2, y_pos2)...]
+
+        if html:
+            gen_and_run_html.gen_html(id_n_names, html)
+
+        # holding the tournament
+        # number of rounds is log2 of number of players, so:
+        # to get number of rounds i use math.ceil, it will give us rounded
+        # value e.g. math.log() can produce 2.8422, but math.ceil() will
+        # return 3.0, then take int(), so then we would have 3 round exactly
+
+        if rounds is None:
+            number_of_players = countPlayers(tournament_id)
+            rounds = int(math.ceil(math.log(number_of_players, 2)))
+        t_round = 1
+    # state after each round is saved, so the tournament can be resumed
+    # after a crash (see loadCheckpoint()), if it's kept in the database:
+    checkpoints = _keepsCheckpoints(tournament_id)
+    if checkpoints and not resume:
+        # round 0 is the state before the first round:
+        saveCheckpoint(0, rounds, rng.getstate(), tournament_id)
+        if html:
+            saveDrawing(0, tournament_id)
+    # with pipeline, writes to the database and drawing of a round run in
+    # background while the next round is paired from in-memory state:
+    scheduler = RoundPipeline(tournament_id) if pipeline else None
+    try:
+        # 'played' - index of all pairs for all rounds, used to prevent
+        # rematches, byes of previous rounds are pairs with BYE in it
+        played = playedPairs(tournament_id)
+        while t_round <= rounds:
+            # defining pairs for current round without rematches,
+            # 'pairs_list' is pairing.Pairs, it looks like
+            # [(id1, name1, id2, name2),...]
+            pairs_list = swissPairingsMatched(played, tournament_id)
+            # adding pairs for this round to 'played' index
+            played.update(pairs_list)
+            reportPairs(t_round, list(pairs_list.ids()), tournament_id)
+            if verbose:
+                print "\nPairs for %s round of torunament:" % t_round
+                print pairs_list
+            # randomly defining winners in pairs, results of this round
+            # look like [(winner_id, looser_id),...]
+            results = []
+            # pairs are read by ids only, names stay in the name table of
+            # 'pairs_list':
+            for first_id, second_id in pairs_list.ids():
+                # for lonely player winner is himself. Id of BYE player is 0
+                if second_id == 0:
+                    results.append((first_id, None))
+                # randomly choosing one of two players:
+                elif rng.randrange(2):
+                    results.append((second_id, first_id))
+                else:
+                    results.append((first_id, second_id))
+            # reporting results of the whole round at once:
+            reportRound(t_round, results, tournament_id)
+            if html:
+                # drawing winner and looser lines and new list of names for
+                # this round inside html:
+                if scheduler is not None:
+                    scheduler.draw(gen_and_run_html.drawNextRound, results,
+                                   t_round)
+                else:
+                    gen_and_run_html.drawNextRound(results, t_round)
+            if checkpoints:
+                saveCheckpoint(t_round, rounds, rng.getstate(),
+                               tournament_id)
+                if html and scheduler is not None:
+                    scheduler.draw(saveDrawing, t_round, tournament_id)
+                elif html:
+                    saveDrawing(t_round, tournament_id)
+            # printing out standings:
+            if verbose:
+                print "\nResults after %s round:" % t_round
+                for player in iterStandings(tournament_id):
+                    print player
+            else:
+                print "round %s of %s reported" % (t_round, rounds)
+            for listener in round_listeners:
+                listener(t_round)
+            t_round += 1
+    finally:
+        # everything is written and drawn after this:
+        if scheduler is not None:
+            if html:
+                # only the renderer has the drawn scene, it writes the file
+                # and the stale scene of this process is dropped:
+                scheduler.draw(gen_and_run_html.flush, html)
+                gen_and_run_html.scene = None
+            scheduler.close()
     # finally run html:
-    gen_and_run_html.run_html("tournament.html")
-    print "results of all matches:"
-    print "(round, winner_id, winner_name, loosers_id)"
-    print getMatchesResults()
+    if html and browser:
+        gen_and_run_html.run_html(html)
+    elif html:
+        gen_and_run_html.flush(html)
+    standings = playerStandings(tournament_id)
+    if standings_file:
+        writeStandings(standings, standings_file)
+    if verbose:
+        print "results of all matches:"
+        print "(round, winner_id, winner_name, looser_id, looser_name)"
+        print getMatchesResults(tournament_id)
+    return standings
+
+
+def writeStandings(standings, filename):
+    """Writes standings as CSV file with header, '-' for standard output."""
+    output = sys.stdout if filename == '-' else open(filename, 'wb')
+    try:
+        writer = csv.writer(output)
+        writer.writerow(['id', 'name', 'wins', 'matches'])
+        for player_id, name, wins, matches in standings:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            writer.writerow([player_id, name, wins, matches])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def parseArguments(argv):
+    """Parses command line of tournament.py.
+
+    python tournament.py                   - asks for players, opens browser
+    python tournament.py import FILE       - only registers players
+    python tournament.py run FILE [...]    - holds the tournament without a
+                                             human, see --help
+    python tournament.py resume [...]      - continues the tournament from
+                                             its last checkpoint
+    """
+    parser = argparse.ArgumentParser(
+        description="Swiss-system tournament.")
+    commands = parser.add_subparsers(dest='command')
+    importing = commands.add_parser(
+        'import', help="register players from a file")
+    importing.add_argument('players', help="CSV or text file, - for stdin")
+    importing.add_argument('-t', '--tournament', type=int,
+                           default=DEFAULT_TOURNAMENT,
+                           help="id of the tournament")
+    running = commands.add_parser(
+        'run', help="hold the tournament without questions")
+    running.add_argument('players', help="CSV or text file, - for stdin")
+    running.add_argument('-r', '--rounds', type=int,
+                         help="number of rounds, log2 of players by default")
+    running.add_argument('-s', '--seed', type=int,
+                         help="seed of outcomes of matches")
+    running.add_argument('--html', help="write the bracket to this file")
+    running.add_argument('--browser', action='store_true',
+                         help="open the bracket in the browser")
+    running.add_argument('--standings',
+                         help="write final standings as CSV, - for stdout")
+    running.add_argument('-t', '--tournament', type=int,
+                         default=DEFAULT_TOURNAMENT,
+                         help="id of the tournament")
+    running.add_argument('-m', '--memory', action='store_true',
+                         help="keep the tournament in memory only")
+    running.add_argument('-l', '--log',
+                         help="append events of the tournament to this log "
+                              "(see eventlog.py)")
+    running.add_argument('-v', '--verbose', action='store_true',
+                         help="print pairs and standings of every round")
+    running.add_argument('-p', '--pipeline', action='store_true',
+                         help="write and draw rounds in background")
+    resuming = commands.add_parser(
+        'resume', help="continue the tournament after its last checkpoint")
+    resuming.add_argument('-t', '--tournament', type=int,
+                          default=DEFAULT_TOURNAMENT,
+                          help="id of the tournament")
+    resuming.add_argument('--html', help="write the bracket to this file")
+    resuming.add_argument('--browser', action='store_true',
+                          help="open the bracket in the browser")
+    resuming.add_argument('--standings',
+                          help="write final standings as CSV, - for stdout")
+    resuming.add_argument('-v', '--verbose', action='store_true',
+                          help="print pairs and standings of every round")
+    resuming.add_argument('-p', '--pipeline', action='store_true',
+                          help="write and draw rounds in background")
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
-    main()
+    # TOURNAMENT_INSTRUMENT=1 prints timings of functions and queries after
+    # each round and at the end, see instrument.py
+    if os.environ.get("TOURNAMENT_INSTRUMENT"):
+        import instrument
+        import gen_and_run_html
+        instrument.enable(sys.stderr, [sys.modules[__name__],
+                                       gen_and_run_html])
+    if len(sys.argv) == 1:
+        main()
+    else:
+        args = parseArguments(sys.argv[1:])
+        if args.command == 'import':
+            # registers players from the file, without holding the
+            # tournament
+            ids = importPlayers(args.players, args.tournament)
+            print "%s players registered" % len(ids)
+        elif args.command == 'resume':
+            main(args.tournament, html=args.html, browser=args.browser,
+                 verbose=args.verbose, standings_file=args.standings,
+                 pipeline=args.pipeline, resume=True)
+        else:
+            if args.log:
+                import eventlog
+                log = eventlog.EventLog(args.log, None if args.memory
+                                        else PostgresStorage())
+                useEngine(log, args.tournament)
+            elif args.memory:
+                useEngine(None, args.tournament)
+            main(args.tournament, readNames(args.players), args.rounds,
+                 args.seed, args.html, args.browser, args.verbose,
+                 args.standings, args.pipeline)
+            # events of the log are synced to disk before exit:
+            waitForRounds(args.tournament)
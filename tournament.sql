@@ -11,25 +11,188 @@ DROP DATABASE IF EXISTS tournament;
 CREATE DATABASE tournament;
 -- connecting to tournament db:
 \c tournament
+-- Many tournaments can be held at the same time, each of them has its own
+-- players and matches
+CREATE TABLE tournaments(
+   id      serial PRIMARY KEY,
+   name    TEXT   NOT NULL
+);
+-- tournament used by functions called without tournament_id:
+INSERT INTO tournaments (name) VALUES ('default');
 -- Creating table players inside "tournament"
 CREATE TABLE players(
-   id      serial PRIMARY KEY,
-   name    TEXT   NOT NULL,
-   wins    int    DEFAULT 0,
-   matches int    DEFAULT 0        
+   id            serial PRIMARY KEY,
+   tournament_id int    NOT NULL DEFAULT 1
+                 REFERENCES tournaments(id) ON DELETE CASCADE,
+   name          TEXT   NOT NULL,
+   -- lets matches check that both players are from their tournament:
+   UNIQUE (tournament_id, id)
 );
--- Also creating matches table
+-- Also creating matches table, it's the only record of results, free win
+-- is stored as a match with NULL looser_id
 CREATE TABLE matches(
-   round       int NOT NULL,
-   winner_id   int REFERENCES players(id),
-   looser_id   int REFERENCES players(id)
+   id            bigserial PRIMARY KEY,
+   tournament_id int NOT NULL DEFAULT 1,
+   round         int NOT NULL DEFAULT 0,
+   winner_id     int NOT NULL,
+   looser_id     int,
+   FOREIGN KEY (tournament_id, winner_id)
+      REFERENCES players(tournament_id, id) ON DELETE CASCADE,
+   FOREIGN KEY (tournament_id, looser_id)
+      REFERENCES players(tournament_id, id) ON DELETE CASCADE
 );
--- Create view for finall table:
--- I have a problem:
--- I've struggling to add also a column "looser_name" to this view,
--- but i can't do this, maybe you can help me with it?
-CREATE VIEW matches_results AS
-SELECT round, winner_id, players.name as winner_name, looser_id FROM matches
-INNER JOIN players ON 
-matches.winner_id = players.id;
+-- all rows of one tournament are found by index, so standings, pairing
+-- and resets of one tournament don't read rows of others:
+CREATE INDEX matches_tournament ON matches (tournament_id, round);
+-- history of one player (his wins and his losses) is read by these two,
+-- round is in them, so history comes out in order of rounds:
+CREATE INDEX matches_winner ON matches (winner_id, round);
+CREATE INDEX matches_looser ON matches (looser_id, round);
+-- rematch checks look for a pair in any order, so the pair is indexed as
+-- (smaller id, bigger id); free wins are not pairs:
+CREATE INDEX matches_pair
+ON matches (tournament_id, LEAST(winner_id, looser_id),
+            GREATEST(winner_id, looser_id))
+WHERE looser_id IS NOT NULL;
+-- a pair plays once in a round and a player gets one free win in it, so a
+-- result reported again (by another scorekeeper, or by a retry) is found
+-- by these two and isn't counted twice; round 0 is an unknown round, its
+-- pairs can meet many times:
+CREATE UNIQUE INDEX matches_round_pair
+ON matches (tournament_id, round, LEAST(winner_id, looser_id),
+            GREATEST(winner_id, looser_id))
+WHERE looser_id IS NOT NULL AND round > 0;
+CREATE UNIQUE INDEX matches_round_bye
+ON matches (tournament_id, round, winner_id)
+WHERE looser_id IS NULL AND round > 0;
+-- state of a tournament held by main() after each completed round (round 0
+-- is the state before the first one), resume continues from the last row.
+-- Pairs and byes aren't copied here, they are read from matches; round
+-- state and drawing are written separately (the drawing may be made by
+-- another process), so both kinds of columns can be NULL:
+CREATE TABLE checkpoints(
+   tournament_id int NOT NULL REFERENCES tournaments(id) ON DELETE CASCADE,
+   round         int NOT NULL,
+   -- planned number of rounds
+   rounds        int,
+   -- pickled state of the generator of outcomes after the round
+   random_state  bytea,
+   -- javascript drawn in this round and pickled positions of names
+   -- after it, NULL if the tournament isn't drawn
+   elements      text,
+   lines         text,
+   names         text,
+   positions     bytea,
+   PRIMARY KEY (tournament_id, round)
+);
+-- matches of each round, which are counted in tie-breaks of standings:
+-- reportRound() counts matches of its round with ids above last_match_id
+-- (matches reported before by reportMatch() too) and moves it to the last
+-- one, so each match is counted once, however the round was reported.
+-- reportRound() waits for reports of its round in progress and new ones
+-- wait for it (see _lockRound() in tournament.py), so later matches of
+-- the round get bigger ids:
+CREATE TABLE counted_rounds(
+   tournament_id int NOT NULL REFERENCES tournaments(id) ON DELETE CASCADE,
+   round         int NOT NULL,
+   last_match_id bigint NOT NULL,
+   PRIMARY KEY (tournament_id, round)
+);
+-- Standings are derived from matches table: this table is never written
+-- by the application, triggers below refresh it with each insert or delete
+-- of matches (one statement per insert, not per row)
+CREATE TABLE standings(
+   player_id     int PRIMARY KEY REFERENCES players(id) ON DELETE CASCADE,
+   tournament_id int NOT NULL,
+   wins          int NOT NULL DEFAULT 0,
+   matches       int NOT NULL DEFAULT 0,
+   -- free wins, they count in wins, but not in opponent_wins:
+   byes          int NOT NULL DEFAULT 0,
+   -- tie-breaks, updated once per round by reportRound():
+   -- sum of wins of all opponents (Buchholz score)
+   buchholz      int NOT NULL DEFAULT 0,
+   -- sum of wins of all opponents, without their free wins
+   opponent_wins int NOT NULL DEFAULT 0,
+   -- sum and number of match-win percentages of all opponents, each one
+   -- is at least 1/3, omw is their average (opponent match-win %)
+   omw_total     numeric NOT NULL DEFAULT 0,
+   opponents     int NOT NULL DEFAULT 0,
+   omw           numeric NOT NULL DEFAULT 0
+);
+-- index in the order of standings of each tournament, so reading them
+-- needs no sorting (it's read backward, best player first):
+CREATE INDEX standings_order
+ON standings (tournament_id, wins, buchholz, omw, opponent_wins, player_id);
 
+-- every new player gets empty standings:
+CREATE FUNCTION add_standings() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO standings (player_id, tournament_id)
+    SELECT id, tournament_id FROM new_players;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_inserted AFTER INSERT ON players
+REFERENCING NEW TABLE AS new_players
+FOR EACH STATEMENT EXECUTE PROCEDURE add_standings();
+
+-- adding (or subtracting for deleted rows) wins, matches and free wins of
+-- all players touched by one statement. Rows of standings are locked in
+-- order of player_id first: concurrent reports of matches with common
+-- players wait for each other instead of locking in opposite orders and
+-- deadlocking:
+CREATE FUNCTION count_matches() RETURNS trigger AS $$
+DECLARE
+    direction int := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    PERFORM 1 FROM standings
+    WHERE player_id IN (SELECT winner_id FROM changed_matches
+                        UNION ALL
+                        SELECT looser_id FROM changed_matches)
+    ORDER BY player_id FOR UPDATE;
+    UPDATE standings
+    SET wins = standings.wins + direction * played.wins,
+        matches = standings.matches + direction * played.matches,
+        byes = standings.byes + direction * played.byes
+    FROM (SELECT player_id, SUM(won) AS wins, COUNT(*) AS matches,
+                 SUM(bye) AS byes
+          FROM (SELECT winner_id AS player_id, 1 AS won,
+                       CASE WHEN looser_id IS NULL THEN 1 ELSE 0 END AS bye
+                FROM changed_matches
+                UNION ALL
+                SELECT looser_id, 0, 0 FROM changed_matches
+                WHERE looser_id IS NOT NULL) AS results
+          GROUP BY player_id) AS played
+    WHERE standings.player_id = played.player_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_inserted AFTER INSERT ON matches
+REFERENCING NEW TABLE AS changed_matches
+FOR EACH STATEMENT EXECUTE PROCEDURE count_matches();
+
+CREATE TRIGGER matches_deleted AFTER DELETE ON matches
+REFERENCING OLD TABLE AS changed_matches
+FOR EACH STATEMENT EXECUTE PROCEDURE count_matches();
+
+-- players with their records, looks like
+-- (id, name, wins, matches, tournament_id, buchholz, omw, opponent_wins):
+CREATE VIEW player_standings AS
+-- id is taken from standings, so ordering by id can use 'standings_order'
+SELECT standings.player_id AS id, players.name, standings.wins,
+       standings.matches, standings.tournament_id, standings.buchholz,
+       standings.omw, standings.opponent_wins
+FROM standings INNER JOIN players ON standings.player_id = players.id;
+
+-- results of all matches with names of both players, looks like
+-- (id, round, winner_id, winner_name, looser_id, looser_name,
+--  tournament_id), looser is NULL for a free win:
+CREATE VIEW matches_results AS
+SELECT matches.id, matches.round, matches.winner_id,
+       winners.name AS winner_name, matches.looser_id,
+       loosers.name AS looser_name, matches.tournament_id
+FROM matches
+INNER JOIN players AS winners ON matches.winner_id = winners.id
+LEFT JOIN players AS loosers ON matches.looser_id = loosers.id;
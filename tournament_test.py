@@ -125,6 +125,546 @@ def testPairings():
     print "8. After one match, players with one win are paired."
 
 
+def testConnectionPool():
+    closePools()
+    countPlayers()
+    # the count is cached, without this it wouldn't take a connection:
+    invalidateCache()
+    countPlayers()
+    pool = getPool()
+    if len(pool._idle) != 1:
+        raise ValueError(
+            "Sequential calls should reuse one pooled connection.")
+    with dbCursor() as (db, cur):
+        cur.execute("SELECT 1;")
+    db.close()
+    invalidateCache()
+    countPlayers()
+    if len(pool._idle) != 1 or pool._idle[0][0].closed:
+        raise ValueError("Pool should replace a closed connection.")
+    # callers written before the pool close what connect() gave them, more
+    # times than the pool has connections:
+    import threading
+    import tournament
+    size = tournament.POOL_SIZE
+    setPoolSize(2)
+    try:
+        def oldCaller():
+            for i in range(3):
+                db, cur = connect()
+                cur.execute("SELECT 1;")
+                db.close()
+        caller = threading.Thread(target=oldCaller)
+        caller.daemon = True
+        caller.start()
+        caller.join(10)
+        if caller.is_alive():
+            raise ValueError("Closed connections should go back to the "
+                             "pool.")
+        if len(getPool()._idle) != 1 or getPool()._idle[0][0].closed:
+            raise ValueError("Closed connection should be reused.")
+        # the pool is replaced while a connection is out, it goes back to
+        # the pool, which gave it out:
+        with dbCursor() as (db, cur):
+            setPoolSize(3)
+            cur.execute("SELECT 1;")
+        if not db.closed or getPool()._idle:
+            raise ValueError("Connection of a replaced pool should be "
+                             "closed when it's given back.")
+    finally:
+        setPoolSize(size)
+    print "9. Connections are reused from the pool and health-checked."
+
+
+def testReportRound():
+    deleteMatches()
+    deletePlayers()
+    for name in ("Ann", "Bob", "Cid", "Dee", "Eve"):
+        registerPlayer(name)
+    standings = playerStandings()
+    [id1, id2, id3, id4, id5] = [row[0] for row in standings]
+    reportRound(1, [(id1, id2), (id3, id4), (id5, None)])
+    standings = playerStandings()
+    for (i, n, w, m) in standings:
+        if m != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if i in (id1, id3, id5) and w != 1:
+            raise ValueError("Winners and BYE should have one win recorded.")
+        elif i in (id2, id4) and w != 0:
+            raise ValueError("Each match loser should have zero wins "
+                             "recorded.")
+    if len(getMatchesResults()) != 3:
+        raise ValueError("Both matches and BYE should be recorded.")
+    try:
+        reportRound(2, [(id1, id3), (id3, id5)])
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Player can't be reported twice in one round.")
+    print "10. A whole round can be reported at once."
+
+
+def testStandingsFromMatches():
+    deleteMatches()
+    deletePlayers()
+    for name in ("Ann", "Bob", "Cid"):
+        registerPlayer(name)
+    [id1, id2, id3] = [row[0] for row in playerStandings()]
+    reportMatch(id1, id2, 1)
+    giveFreeWin(id3, 1)
+    standings = playerStandings()
+    refreshStandings()
+    if playerStandings() != standings:
+        raise ValueError("Standings should be derived from matches.")
+    deleteMatches()
+    for (i, n, w, m) in playerStandings():
+        if w != 0 or m != 0:
+            raise ValueError("After deleting matches standings should be 0.")
+    print "11. Standings are derived from matches and reset with them."
+
+
+def testPlayedPairs():
+    deleteMatches()
+    deletePlayers()
+    for name in ("Ann", "Bob", "Cid"):
+        registerPlayer(name)
+    [id1, id2, id3] = [row[0] for row in playerStandings()]
+    reportRound(1, [(id1, id2), (id3, None)])
+    played = playedPairs()
+    if not played.played(id2, id1) or not played.played(id3, 0):
+        raise ValueError("Played pairs should be rebuilt from matches.")
+    if played.played(id1, id3) or len(played) != 2:
+        raise ValueError("Only played pairs should be in the index.")
+    print "12. Played pairs are rebuilt from matches."
+
+
+def testTournaments():
+    deleteMatches()
+    deletePlayers()
+    other = createTournament("Other event")
+    registerPlayer("Ann")
+    registerPlayer("Bob")
+    registerPlayer("Cid", other)
+    registerPlayer("Dee", other)
+    if countPlayers() != 2 or countPlayers(other) != 2:
+        raise ValueError("Each tournament should count only its players.")
+    [id1, id2] = [row[0] for row in playerStandings(other)]
+    reportMatch(id1, id2, 1, other)
+    for (i, n, w, m) in playerStandings():
+        if m != 0:
+            raise ValueError("Matches of other tournament shouldn't count.")
+    deletePlayers()
+    if countPlayers() != 0 or len(getMatchesResults(other)) != 1:
+        raise ValueError("Deleting players shouldn't touch other tournament.")
+    deleteTournament(other)
+    if countPlayers(other) != 0:
+        raise ValueError("Deleted tournament shouldn't have players.")
+    print "13. Tournaments are held independently."
+
+
+def testRegisterPlayers():
+    deleteMatches()
+    deletePlayers()
+    names = ["Ann", "Tab\tby", "Back\\slash", "Bob"]
+    ids = registerPlayers(names)
+    ids += registerPlayers(["Cid", "Dee"], use_copy=False)
+    if countPlayers() != 6 or len(set(ids)) != 6:
+        raise ValueError("All players should be registered at once.")
+    registered = dict((row[0], row[1]) for row in playerStandings())
+    if [registered[i] for i in ids] != names + ["Cid", "Dee"]:
+        raise ValueError("Returned ids should belong to the given names.")
+    print "14. Many players can be registered at once."
+
+
+def testStandingsPages():
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve", "Fay", "Gus"])
+    reportRound(1, [(ids[1], ids[0]), (ids[3], ids[2]), (ids[4], ids[5]),
+                    (ids[6], None)])
+    standings = playerStandings()
+    if list(iterStandings(batch_size=2)) != standings:
+        raise ValueError("Streamed standings should equal playerStandings.")
+    if topStandings(3) != standings[:3]:
+        raise ValueError("Top players should be the first in standings.")
+    pages = []
+    page = standingsPage(limit=3)
+    while page:
+        pages += page
+        page = standingsPage(page[-1], 3)
+    if pages != standings:
+        raise ValueError("Pages of standings should cover all standings.")
+    print "15. Standings can be streamed and read page by page."
+
+
+def testTieBreaks():
+    deleteMatches()
+    deletePlayers()
+    [ann, bob, cid, dee, eve] = registerPlayers(
+        ["Ann", "Bob", "Cid", "Dee", "Eve"])
+    reportRound(1, [(ann, bob), (cid, dee), (eve, None)])
+    reportRound(2, [(ann, cid), (eve, bob), (dee, None)])
+    expected = [(ann, 2, 1, 0.416667, 1), (eve, 2, 0, 0.333333, 0),
+                (cid, 1, 3, 0.75, 2), (dee, 1, 1, 0.5, 1),
+                (bob, 0, 4, 1.0, 3)]
+    tie_breaks = [(i, w, b, round(float(o), 6), s)
+                  for (i, w, b, o, s) in playerTieBreaks()]
+    if tie_breaks != expected:
+        raise ValueError("Tie-breaks should be updated after each round.")
+    if [row[0] for row in playerStandings()] != [ann, eve, cid, dee, bob]:
+        raise ValueError("Players with equal wins are ordered by tie-breaks.")
+    tie_breaks = playerTieBreaks()
+    refreshStandings()
+    if playerTieBreaks() != tie_breaks:
+        raise ValueError("Rebuilt tie-breaks should equal updated ones.")
+    print "16. Tie-breaks are updated round by round."
+
+
+def testEngine():
+    deleteMatches()
+    deletePlayers()
+    useEngine(PostgresStorage())
+    try:
+        ids = registerPlayers(["Ann", "Bob", "Cid", "Dee", "Eve"])
+        reportRound(1, [(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], None)])
+        reportRound(2, [(ids[0], ids[2]), (ids[4], ids[1]), (ids[3], None)])
+        standings = playerStandings()
+        pairs = swissPairings()
+    finally:
+        dropEngine()
+    if playerStandings() != standings or swissPairings() != pairs:
+        raise ValueError("Engine should write the same state to database.")
+    useEngine()
+    try:
+        registerPlayer("Fay")
+        if countPlayers() != 1:
+            raise ValueError("Engine without storage keeps players in memory.")
+    finally:
+        dropEngine()
+    if countPlayers() != 5:
+        raise ValueError("Engine without storage shouldn't touch database.")
+    print "17. Module functions work over the in-memory engine."
+
+
+def testInstrument():
+    import instrument
+    import tournament
+    instrument.enable()
+    try:
+        # functions are replaced in the module, not in this namespace;
+        # the count would be cached, it's read twice from the database:
+        tournament.invalidateCache()
+        tournament.countPlayers()
+        tournament.invalidateCache()
+        tournament.countPlayers()
+    finally:
+        instrument.disable()
+    queries = instrument.stats.queries
+    if queries["SELECT COUNT(*) FROM players WHERE tournament_id = %s;"][0] \
+            != 2:
+        raise ValueError("Every query should be counted.")
+    if instrument.stats.calls["tournament.countPlayers"][0] != 2:
+        raise ValueError("Every call should be timed.")
+    print "18. Calls and queries can be timed."
+
+
+def testHistory():
+    deleteMatches()
+    deletePlayers()
+    [ann, bob, cid] = registerPlayers(["Ann", "Bob", "Cid"])
+    reportRound(1, [(ann, bob), (cid, None)])
+    reportRound(2, [(cid, ann), (bob, None)])
+    results = getMatchesResults()
+    if results != [(1, ann, "Ann", bob, "Bob"), (1, cid, "Cid", None, None),
+                   (2, cid, "Cid", ann, "Ann"), (2, bob, "Bob", None, None)]:
+        raise ValueError("Results should have names of both players.")
+    history = playerHistory(ann)
+    if history != [(1, bob, "Bob", True), (2, cid, "Cid", False)]:
+        raise ValueError("History should list matches of one player.")
+    if playerHistory(bob)[1] != (2, None, None, True):
+        raise ValueError("Free win should be in history without opponent.")
+    if not havePlayed(bob, ann) or havePlayed(bob, cid):
+        raise ValueError("Rematch check should find pairs in any order.")
+    useEngine(PostgresStorage())
+    try:
+        if getMatchesResults() != results or playerHistory(ann) != history \
+                or not havePlayed(ann, cid) or havePlayed(bob, cid):
+            raise ValueError("Engine should give the same history.")
+    finally:
+        dropEngine()
+    print "19. History of players and rematches are found by index."
+
+
+def testPipeline():
+    deleteMatches()
+    deletePlayers()
+    names = ["Ann", "Bob", "Cid", "Dee", "Eve", "Fay", "Gus"]
+    standings = main(names=names, seed=3, html=None, verbose=False)
+    matches = len(getMatchesResults())
+    # rounds are written by a worker process, main() returns after they are
+    pipelined = main(names=names, seed=3, html=None, verbose=False,
+                     pipeline=True)
+    if [row[1:] for row in pipelined] != [row[1:] for row in standings]:
+        raise ValueError("Pipelined rounds should give the same standings.")
+    if len(getMatchesResults()) != matches or \
+            playerStandings() != pipelined:
+        raise ValueError("All pipelined rounds should be in the database.")
+    print "20. Rounds can be written in background."
+
+
+class Crash(Exception):
+    pass
+
+
+def crashAfter(stopped_round):
+    def listener(t_round):
+        if t_round == stopped_round:
+            raise Crash()
+    return listener
+
+
+def testResume():
+    import os
+    import tempfile
+    deleteMatches()
+    deletePlayers()
+    names = ["Ann", "Bob", "Cid", "Dee", "Eve", "Fay", "Gus"]
+    html = tempfile.mktemp(suffix='.html')
+    stopped_html = tempfile.mktemp(suffix='.html')
+    resumed_html = tempfile.mktemp(suffix='.html')
+    try:
+        standings = main(names=names, rounds=4, seed=5, html=html,
+                         browser=False, verbose=False)
+        if lastCheckpoint() != (4, 4):
+            raise ValueError("Each round should have a checkpoint.")
+        for pipeline in (False, True):
+            crash = crashAfter(2)
+            round_listeners.append(crash)
+            try:
+                main(names=names, rounds=4, seed=5, html=stopped_html,
+                     browser=False, verbose=False, pipeline=pipeline)
+            except Crash:
+                pass
+            finally:
+                round_listeners.remove(crash)
+            # the run stopped after writing results of round 3, but before
+            # its checkpoint, these results are played again:
+            reportRound(3, [(row[0], None) for row in playerStandings()])
+            if lastCheckpoint() != (2, 4):
+                raise ValueError("Checkpoint should be the last round.")
+            resumed = main(html=resumed_html, browser=False, verbose=False,
+                           resume=True)
+            if [row[1:] for row in resumed] != \
+                    [row[1:] for row in standings]:
+                raise ValueError("Resumed tournament should end the same.")
+            if open(resumed_html).read() != open(html).read():
+                raise ValueError("Resumed bracket should be the same.")
+    finally:
+        for filename in (html, stopped_html, resumed_html):
+            if os.path.exists(filename):
+                os.remove(filename)
+    deleteMatches()
+    if lastCheckpoint() is not None:
+        raise ValueError("Checkpoints should be deleted with matches.")
+    print "21. Stopped tournament is resumed from its checkpoints."
+
+
+def testEventLog():
+    import os
+    import tempfile
+    import eventlog
+    deleteMatches()
+    deletePlayers()
+    filename = os.path.join(tempfile.mkdtemp(), 'events.log')
+    useEngine(eventlog.EventLog(filename, PostgresStorage()))
+    try:
+        names = ["Ann", "Bob", "Cid", "Dee", "Eve", "Fay", "Gus"]
+        standings = main(names=names, seed=7, html=None, verbose=False)
+        waitForRounds()
+    finally:
+        dropEngine()
+    if playerStandings() != standings:
+        raise ValueError("Log should pass every write to the database.")
+    if eventlog.replay(filename).standings() != standings:
+        raise ValueError("Replay of the log should give the standings.")
+    # 3 matches and one free win of 7 players in the first round:
+    first = eventlog.replay(filename, 1, 1).standings()
+    if sum(player[3] for player in first) != 7:
+        raise ValueError("Replay should stop after the given round.")
+    kinds = [event['event'] for event in eventlog.events(filename)]
+    if kinds.count('pairs') != 3 or kinds.count('results') != 3:
+        raise ValueError("Pairs and results of each round should be logged.")
+    print "22. Events of the tournament are logged and replayed."
+
+
+def testCache():
+    import tournament
+    deleteMatches()
+    deletePlayers()
+    [ann, bob] = registerPlayers(["Ann", "Bob"])
+    standings = playerStandings()
+    count = countPlayers()
+    version = cacheVersion()
+    # a write around this module isn't seen until the cache is invalidated
+    with dbCursor() as (db, cur):
+        cur.execute("INSERT INTO players (name) VALUES ('Cid');")
+    if playerStandings() != standings or countPlayers() != count or \
+            cacheVersion() != version:
+        raise ValueError("Repeated reads should come from the cache.")
+    invalidateCache()
+    if countPlayers() != 3 or cacheVersion() == version:
+        raise ValueError("Invalidated reads should be read again.")
+    # a read in flight while all tournaments are invalidated isn't cached,
+    # even of a tournament never written
+    version = tournament._cacheGet(1000, 'count')[0]
+    invalidateCache()
+    tournament._cachePut(1000, 'count', version, 0)
+    if tournament._cacheGet(1000, 'count')[1] is not None:
+        raise ValueError("Reads older than invalidation shouldn't be cached.")
+    reportMatch(bob, ann)
+    if playerStandings()[0][0] != bob or topStandings(1)[0][0] != bob:
+        raise ValueError("Writes should drop cached standings.")
+    rows = tournament.CACHE_ROWS
+    tournament.CACHE_ROWS = 2
+    try:
+        invalidateCache()
+        playerStandings()
+        registerPlayer("Dee")
+        with dbCursor() as (db, cur):
+            cur.execute("INSERT INTO players (name) VALUES ('Eve');")
+        if len(list(iterStandings())) != 5:
+            raise ValueError("Reads bigger than the cache aren't cached.")
+    finally:
+        tournament.CACHE_ROWS = rows
+    print "23. Standings and counts are cached until the next write."
+
+
+def testPrepared():
+    import tournament
+    deleteMatches()
+    deletePlayers()
+    [ann, bob, cid, dee] = registerPlayers(["Ann", "Bob", "Cid", "Dee"])
+    prepared = tournament.USE_PREPARED
+    rows = tournament.CACHE_ROWS
+    tournament.CACHE_ROWS = 0
+    try:
+        tournament.USE_PREPARED = False
+        reportMatch(ann, bob)
+        standings = playerStandings()
+        tournament.USE_PREPARED = True
+        if playerStandings() != standings:
+            raise ValueError("Prepared statements should read the same "
+                             "standings.")
+        # a prepared statement outlives the rolled back transaction, which
+        # prepared it, and it's prepared once per connection:
+        try:
+            with dbCursor() as (db, cur):
+                executePrepared(cur, 'insert_match', (1, 0, cid, dee))
+                raise KeyError("rollback")
+        except KeyError:
+            pass
+        with dbCursor() as (db, cur):
+            if 'insert_match' not in db.prepared:
+                raise ValueError("Statement should be prepared once per "
+                                 "connection.")
+            cur.execute("SELECT name FROM pg_prepared_statements;")
+            if ('insert_match',) not in cur.fetchall():
+                raise ValueError("Statement should be kept by the session.")
+        if playerStandings() != standings:
+            raise ValueError("Rolled back match shouldn't be counted.")
+        reportMatch(cid, dee)
+        if [row[2] for row in playerStandings()] != [1, 1, 0, 0]:
+            raise ValueError("Prepared insert should count the match.")
+    finally:
+        tournament.USE_PREPARED = prepared
+        tournament.CACHE_ROWS = rows
+    print "24. Hot statements are prepared once per connection."
+
+
+def testConcurrentReports():
+    import threading
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["P%d" % i for i in range(9)])
+    errors = []
+
+    def scorekeeper(t_round, results):
+        try:
+            if t_round is None:
+                # the whole round reported by the main table:
+                reportRound(*results)
+            else:
+                for winner, loser in results:
+                    reportMatch(winner, loser, t_round)
+        except Exception as e:
+            errors.append(e)
+
+    def race(reports):
+        threads = [threading.Thread(target=scorekeeper, args=report)
+                   for report in reports]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def checkTieBreaks(message):
+        # tie-breaks counted round by round are the same as rebuilt ones:
+        tie_breaks = playerTieBreaks()
+        refreshStandings()
+        if playerTieBreaks() != tie_breaks:
+            raise ValueError(message)
+
+    first = [(ids[i], ids[i + 1]) for i in range(0, 8, 2)]
+    # every scorekeeper reports the whole round, in his own order:
+    race([(1, first[i:] + first[:i]) for i in range(8)])
+    if len(getMatchesResults()) != 4:
+        raise ValueError("Repeated reports should be recorded once.")
+    try:
+        reportMatch(first[0][1], first[0][0], 1)
+        raise AssertionError("Conflicting report should be refused.")
+    except ValueError:
+        pass
+    giveFreeWin(ids[8], 1)
+    giveFreeWin(ids[8], 1)
+    # the round, which is recorded already, gets its tie-breaks:
+    reportRound(1, first + [(ids[8], None)])
+    checkTieBreaks("Round reported by reportMatch() should be counted in "
+                   "tie-breaks once.")
+    second = [(ids[0], ids[2]), (ids[4], ids[6]), (ids[1], ids[3]),
+              (ids[5], ids[8]), (ids[7], None)]
+    reportMatch(ids[0], ids[2], 2)
+    reportRound(2, second[:3])
+    reportRound(2, second)
+    tie_breaks = playerTieBreaks()
+    reportRound(2, second)
+    if playerTieBreaks() != tie_breaks or len(getMatchesResults()) != 10:
+        raise ValueError("Repeated round should change nothing.")
+    checkTieBreaks("Round reported in parts should be counted in "
+                   "tie-breaks once.")
+    try:
+        reportRound(3, [(ids[0], ids[4]), (ids[1], ids[5])])
+        reportRound(3, [(ids[4], ids[0]), (ids[3], ids[7])])
+        raise AssertionError("Conflicting round should be refused.")
+    except ValueError:
+        pass
+    if len(getMatchesResults()) != 12:
+        raise ValueError("Refused round shouldn't be recorded.")
+    # the main table and scorekeepers of tables report the same round at
+    # once:
+    fourth = [(ids[0], ids[3]), (ids[2], ids[5]), (ids[4], ids[7]),
+              (ids[6], ids[8]), (ids[1], None)]
+    race([(None, (4, fourth))] +
+         [(4, fourth[i:] + fourth[:i]) for i in range(5)] * 2)
+    if len(getMatchesResults()) != 17:
+        raise ValueError("Round reported by everybody should be recorded "
+                         "once.")
+    checkTieBreaks("Round reported by everybody should be counted in "
+                   "tie-breaks once.")
+    print "25. Concurrent and repeated reports are recorded once."
+
+
 if __name__ == '__main__':
     testDeleteMatches()
     testDelete()
@@ -134,6 +674,23 @@ if __name__ == '__main__':
     testStandingsBeforeMatches()
     testReportMatches()
     testPairings()
+    testConnectionPool()
+    testReportRound()
+    testStandingsFromMatches()
+    testPlayedPairs()
+    testTournaments()
+    testRegisterPlayers()
+    testStandingsPages()
+    testTieBreaks()
+    testEngine()
+    testInstrument()
+    testHistory()
+    testPipeline()
+    testResume()
+    testEventLog()
+    testCache()
+    testPrepared()
+    testConcurrentReports()
     print "Success!  All tests pass!"
 
 
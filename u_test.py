@@ -1,5 +1,21 @@
 import unittest
+import os
+import atexit
+import tempfile
+import threading
+import cPickle as pickle
+from decimal import Decimal
+import gen_and_run_html
 from tournament import preventRematch
+from pairing import max_weight_matching, matched_pairings, PlayedPairs
+from pairing import swiss_pairs, Pairs
+from engine import TournamentState, SqliteStorage, AsyncStorage
+from engine import Worker, ProcessWorker, NullStorage
+import simulate
+import benchmark
+import instrument
+import eventlog
+import tournament
 
 
 # def preventRematch(all_pairs, pairs_list):
@@ -54,5 +70,487 @@ class TestFunction(unittest.TestCase):
             )
 
 
+class TestMatching(unittest.TestCase):
+
+    def test_max_weight(self):
+        # path 0-1-2-3: two outer edges are heavier than the middle one
+        edges = [(0, 1, 5), (1, 2, 8), (2, 3, 5)]
+        self.assertEqual(max_weight_matching(edges), [1, 0, 3, 2])
+        # blossom 0-1-2 with a tail, only maximum cardinality covers 3
+        edges = [(0, 1, 6), (1, 2, 6), (0, 2, 6), (2, 3, 1)]
+        self.assertEqual(max_weight_matching(edges, True), [1, 0, 3, 2])
+
+    def test_pairings(self):
+        standings = [(1, 'testa', 1, 1), (2, 'testb', 1, 1),
+                     (3, 'testc', 0, 1), (4, 'testd', 0, 1)]
+        all_pairs = [(1, 'testa', 3, 'testc'), (2, 'testb', 4, 'testd')]
+        # winners play each other, loosers too
+        self.assertEqual(
+            matched_pairings(standings, all_pairs),
+            [(1, 'testa', 2, 'testb'), (3, 'testc', 4, 'testd')])
+        # winners already met, so each of them gets a looser
+        all_pairs.append((1, 'testa', 2, 'testb'))
+        self.assertEqual(
+            matched_pairings(standings, all_pairs),
+            [(1, 'testa', 4, 'testd'), (2, 'testb', 3, 'testc')])
+
+    def test_no_rematch_when_possible(self):
+        # preventRematch leaves 1 and 2 together here, 1 can play only 5
+        standings = [(i, 'test%d' % i, 0, 0) for i in xrange(1, 7)]
+        all_pairs = [(1, 'test1', 2, 'test2'), (1, 'test1', 3, 'test3'),
+                     (2, 'test2', 6, 'test6'), (4, 'test4', 1, 'test1'),
+                     (1, 'test1', 6, 'test6')]
+        self.assertEqual(
+            matched_pairings(standings, all_pairs),
+            [(1, 'test1', 5, 'test5'), (2, 'test2', 3, 'test3'),
+             (4, 'test4', 6, 'test6')])
+
+    def test_swiss_pairs(self):
+        standings = [(i, 'test%d' % i, 0, 0) for i in xrange(1, 4)]
+        self.assertEqual(swiss_pairs(iter(standings)),
+                         [(1, 'test1', 2, 'test2'), (3, 'test3', 0, 'BYE')])
+
+    def test_bye(self):
+        standings = [(i, 'test%d' % i, 0, 0) for i in xrange(1, 6)]
+        # 5 already had a free win, so 4 gets it
+        pairs = matched_pairings(standings, [(5, 'test5', 0, 'BYE')])
+        self.assertEqual(pairs[-1], (4, 'test4', 0, 'BYE'))
+
+    def test_blocks(self):
+        standings = [(i, 'test%d' % i, (300 - i) // 30, 3)
+                     for i in xrange(300)]
+        pairs = matched_pairings(standings, exact_limit=64)
+        ids = sorted([p[0] for p in pairs] + [p[2] for p in pairs])
+        self.assertEqual(ids, range(300))
+        self.assertEqual(pairs, matched_pairings(standings, exact_limit=64))
+
+
+class TestPlayedPairs(unittest.TestCase):
+
+    def test_index(self):
+        played = PlayedPairs([(1, 'testa', 2, 'testb'),
+                              (3, 'testc', 0, 'BYE')])
+        played.add(2, 1)
+        self.assertEqual(len(played), 2)
+        self.assertTrue(played.played(2, 1))
+        self.assertTrue((3, 'testc', 0, 'BYE') in played)
+        self.assertTrue((1, 2) in played)
+        self.assertTrue((0, 3) in played)
+        self.assertFalse((1, 3) in played)
+        self.assertFalse(played.played(1, 3))
+        self.assertEqual(played.opponents(1), set([2]))
+
+    def test_from_matches(self):
+        played = PlayedPairs.from_matches([(1, 2), (3, None), (2, 3)])
+        self.assertTrue(played.played(3, 0))
+        self.assertTrue(played.played(3, 2))
+        # preventRematch gives the same result for the index and the list
+        pairs_list = [(1, 'testa', 2, 'testb'), (3, 'testc', 4, 'testd')]
+        self.assertEqual(
+            preventRematch(played, list(pairs_list)),
+            preventRematch([(1, 'testa', 2, 'testb'), (3, 'testc', 0, 'BYE'),
+                            (2, 'testb', 3, 'testc')], list(pairs_list)))
+
+
+class TestPairs(unittest.TestCase):
+
+    def test_view(self):
+        pairs = Pairs([(1, 'testa', 2, 'testb'), (3, 'testc', 0, 'BYE')])
+        self.assertEqual(list(pairs.ids()), [(1, 2), (3, 0)])
+        self.assertEqual(pairs[1], (3, 'testc', 0, 'BYE'))
+        pairs[0] = (2, 'testb', 1, 'testa')
+        self.assertEqual(pairs[:1], [(2, 'testb', 1, 'testa')])
+        self.assertEqual(len(pairs), 2)
+
+    def test_prevent_rematch(self):
+        # ids are swapped in place, the same way tuples of a list are
+        played = PlayedPairs([(1, 'testa', 2, 'testb'),
+                              (3, 'testc', 4, 'testd')])
+        pairs_list = [(1, 'testa', 2, 'testb'), (3, 'testc', 4, 'testd'),
+                      (5, 'teste', 6, 'testf')]
+        pairs = preventRematch(played, Pairs(pairs_list))
+        self.assertTrue(isinstance(pairs, Pairs))
+        self.assertEqual(pairs, preventRematch(played, list(pairs_list)))
+        self.assertFalse(any(played.played(*ids) for ids in pairs.ids()))
+
+    def test_positions(self):
+        positions = gen_and_run_html.Positions([(1, 'testa', 10, 100),
+                                                (2, 'testb', 10, 127)])
+        self.assertEqual(positions.place(2), 1)
+        positions[1] = (3, 'testc', 10, 127)
+        self.assertEqual(positions.place(3), 1)
+        self.assertEqual(positions.place(2), None)
+        self.assertEqual(list(positions), [(1, 'testa', 10, 100),
+                                           (3, 'testc', 10, 127)])
+
+
+class TestScene(unittest.TestCase):
+
+    def test_single_write(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'tournament.html')
+        positions = gen_and_run_html.gen_html(
+            [(1, 'testa'), (2, 'testb'), (3, 'testc')], filename)
+        positions = gen_and_run_html.drawLines(1, positions, 1, 2)
+        positions = gen_and_run_html.drawLines(3, positions, 1)
+        positions = gen_and_run_html.drawNames(positions, 1)
+        # nothing is written before flush
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(gen_and_run_html.flush() > 0)
+        content = open(filename).read()
+        self.assertEqual(content.count("ctx.stroke();"), 3)
+        self.assertEqual(content.count("ctx.fillText"), 6)
+        self.assertEqual(positions, [(1, 'testa', 110, 900),
+                                     (2, 'testb', 110, 1127),
+                                     (3, 'testc', 110, 954)])
+        # scene wasn't changed, so there is nothing to write
+        self.assertEqual(gen_and_run_html.flush(), 0)
+
+    def test_collisions(self):
+        # three names on one place and the fourth one below them, it
+        # doesn't overlap them, but will after they are spread
+        positions = [(1, 'testa', 110, 100), (2, 'testb', 110, 100),
+                     (3, 'testc', 110, 100), (4, 'testd', 110, 120),
+                     (5, 'teste', 110, 300)]
+        col_detected, col_ids = gen_and_run_html.check_collisions(positions)
+        self.assertTrue(col_detected)
+        self.assertEqual(col_ids, [(1, True), (2, False), (3, False)])
+        positions = gen_and_run_html.fix_collisions(
+            None, positions, col_ids, [], 1)
+        self.assertEqual([pl[3] for pl in positions], [83, 98, 113, 128, 300])
+        self.assertEqual(gen_and_run_html.check_collisions(positions),
+                         (False, []))
+
+    def test_restore(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'tournament.html')
+        gen_and_run_html.gen_html(
+            [(1, 'testa'), (2, 'testb'), (3, 'testc')], filename)
+        drawings = [gen_and_run_html.scene.changes()]
+        gen_and_run_html.drawNextRound([(1, 2), (3, None)], 1)
+        drawings.append(gen_and_run_html.scene.changes())
+        self.assertEqual(drawings[1][0], "")
+        self.assertEqual(gen_and_run_html.scene.changes(), ("", "", ""))
+        positions = pickle.loads(pickle.dumps(
+            gen_and_run_html.scene.positions, pickle.HIGHEST_PROTOCOL))
+        content = gen_and_run_html.scene.render()
+        gen_and_run_html.drawNextRound([(1, 3), (2, None)], 2)
+        drawn = gen_and_run_html.scene.render()
+        # the scene made from saved rounds draws the next round the same
+        gen_and_run_html.restore(drawings, positions, filename)
+        self.assertEqual(gen_and_run_html.scene.render(), content)
+        gen_and_run_html.drawNextRound([(1, 3), (2, None)], 2)
+        self.assertEqual(gen_and_run_html.scene.render(), drawn)
+
+
+class TestEngine(unittest.TestCase):
+
+    def hold(self, state):
+        ann, bob, cid, dee, eve = state.register_players(
+            ['Ann', 'Bob', 'Cid', 'Dee', 'Eve'])
+        state.report_round(1, [(ann, bob), (cid, dee), (eve, None)])
+        state.report_round(2, [(ann, cid), (eve, bob), (dee, None)])
+        return ann, bob, cid, dee, eve
+
+    def test_memory(self):
+        state = TournamentState()
+        ann, bob, cid, dee, eve = self.hold(state)
+        self.assertEqual(state.count_players(), 5)
+        self.assertEqual([p[0] for p in state.standings()],
+                         [ann, eve, cid, dee, bob])
+        self.assertEqual(state.tie_breaks()[0],
+                         (ann, 2, 1, Decimal('0.416667'), 1))
+        self.assertTrue(state.played.played(dee, 0))
+        self.assertEqual(state.standings_page(state.standings()[1], 2),
+                         state.standings()[2:4])
+        self.assertRaises(ValueError, state.report_round, 3,
+                          [(ann, bob), (bob, cid)])
+        self.assertEqual(state.player_history(dee),
+                         [(1, cid, 'Cid', False), (2, None, None, True)])
+        self.assertTrue(state.have_played(bob, eve))
+        self.assertFalse(state.have_played(dee, 0))
+        state.delete_matches()
+        self.assertEqual(state.matches_results(), [])
+        self.assertEqual(sum(p[3] for p in state.standings()), 0)
+
+    def test_storage(self):
+        storage = SqliteStorage()
+        state = TournamentState(AsyncStorage(storage))
+        self.hold(state)
+        state.flush()
+        # the state is the same after it is loaded from the storage
+        loaded = TournamentState(storage)
+        self.assertEqual(loaded.standings(), state.standings())
+        self.assertEqual(loaded.matches_results(), state.matches_results())
+        loaded.delete_players()
+        self.assertEqual(TournamentState(storage).count_players(), 0)
+
+    def test_repeated_reports(self):
+        storage = SqliteStorage()
+        state = TournamentState(AsyncStorage(storage))
+        ann, bob, cid, dee, eve = self.hold(state)
+        standings = state.standings()
+        # results reported again aren't counted twice, like in the database
+        state.report_match(ann, bob, 1)
+        state.report_round(2, [(ann, cid), (eve, bob), (dee, None)])
+        state.report_match(dee, None, 2)
+        self.assertEqual(state.standings(), standings)
+        # a different result is refused before the storage gets it
+        self.assertRaises(ValueError, state.report_match, bob, ann, 1)
+        self.assertRaises(ValueError, state.report_round, 2, [(cid, ann)])
+        state.flush()
+        self.assertEqual(TournamentState(storage).standings(), standings)
+        # pairs of unknown round can meet many times
+        state.report_match(ann, bob)
+        state.report_match(ann, bob)
+        self.assertEqual(len(state.matches_results()), 8)
+
+
+class TestEventLog(unittest.TestCase):
+
+    def test_replay(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'events.log')
+        state = TournamentState(eventlog.EventLog(filename,
+                                                  snapshot_rounds=2))
+        ann, bob, cid, dee, eve = state.register_players(
+            ['Ann', 'Bob', 'Cid', 'Dee', 'Eve'])
+        state.report_pairs(1, [(ann, bob), (cid, dee), (eve, 0)])
+        state.report_round(1, [(ann, bob), (cid, dee), (eve, None)])
+        state.report_round(2, [(ann, cid), (eve, bob), (dee, None)])
+        after_two = state.standings()
+        state.report_round(3, [(ann, eve), (bob, dee), (cid, None)])
+        state.storage.close()
+        # the snapshot was taken after round 2, round 3 is read from events
+        self.assertTrue(os.path.exists(filename + '.snapshot'))
+        self.assertEqual(eventlog.replay(filename).standings(),
+                         state.standings())
+        self.assertEqual(eventlog.replay(filename, 1, 2).standings(),
+                         after_two)
+        self.assertEqual([event['event'] for event in
+                          eventlog.events(filename)],
+                         ['players', 'pairs', 'results', 'results',
+                          'results'])
+        # a line cut by a crash is dropped, the log goes on after it
+        with open(filename, 'ab') as log:
+            log.write('{"event":"results","tourn')
+        loaded = TournamentState(eventlog.EventLog(filename))
+        self.assertEqual(loaded.standings(), state.standings())
+        self.assertEqual(loaded.register_player('Fay'), eve + 1)
+        loaded.delete_matches()
+        loaded.flush()
+        self.assertEqual(eventlog.replay(filename).count_players(), 6)
+        self.assertEqual(eventlog.replay(filename).matches_results(), [])
+
+    def test_repeated_reports(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'events.log')
+        log = eventlog.EventLog(filename)
+        ann, bob, cid = log.register_players(1, ['Ann', 'Bob', 'Cid'])
+        log.report_round(1, 1, [(ann, bob), (cid, None)])
+        # a result reported again isn't logged, a different one is refused
+        log.report_round(1, 1, [(ann, bob), (cid, None)])
+        log.report_match(1, 1, ann, bob)
+        self.assertRaises(ValueError, log.report_match, 1, 1, bob, ann)
+        log.close()
+        self.assertEqual([event['event'] for event in
+                          eventlog.events(filename)],
+                         ['players', 'results'])
+        self.assertEqual(len(eventlog.replay(filename).matches_results()),
+                         2)
+
+    def test_concurrent_reports(self):
+        class MeetingStorage(NullStorage):
+            # both reports pass the first check, before one is logged
+            met = threading.Condition()
+            reports = 0
+
+            def report_match(self, *args):
+                with self.met:
+                    MeetingStorage.reports += 1
+                    self.met.notify_all()
+                    while self.reports < 2:
+                        self.met.wait(1)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'events.log')
+        log = eventlog.EventLog(filename, MeetingStorage())
+        ann, bob = log.register_players(1, ['Ann', 'Bob'])
+        threads = [threading.Thread(target=log.report_match,
+                                    args=(1, 1, ann, bob)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        log.close()
+        self.assertEqual(len(eventlog.replay(filename).matches_results()),
+                         1)
+
+
+class TestSimulateMany(unittest.TestCase):
+
+    def test_workers(self):
+        result = simulate.simulate_many(20, 7, workers=2, seed=1)
+        self.assertEqual(result['tournaments'], 20)
+        self.assertEqual([sum(counts) for counts in result['places']],
+                         [20] * 7)
+        # result doesn't depend on the number of workers
+        self.assertEqual(result,
+                         simulate.simulate_many(20, 7, workers=1, seed=1))
+
+
+@unittest.skipIf(simulate.np is None, "numpy isn't installed")
+class TestSimulate(unittest.TestCase):
+
+    def test_simulate(self):
+        result = simulate.simulate(9, 50, seed=1)
+        self.assertEqual(result['rounds'], 4)
+        # every place is taken in every tournament
+        self.assertEqual(list(result['places'].sum(axis=1)), [50] * 9)
+        # one free win in each round of each tournament
+        self.assertEqual(result['byes'][1], 200)
+        again = simulate.simulate(9, 50, seed=1)
+        self.assertTrue((result['places'] == again['places']).all())
+
+    def test_rematches(self):
+        # 6 players can't play 5 rounds of Swiss system without rematches,
+        # matching needs less of them than preventRematch()
+        swiss = simulate.simulate(6, 100, rounds=5, seed=1)
+        matched = simulate.simulate(6, 100, rounds=5, seed=1,
+                                    policy='matched')
+        self.assertTrue(0 < matched['rematches'] < swiss['rematches'])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        report = benchmark.run([16], rounds=2)
+        self.assertEqual(sorted(report['results']['16']),
+                         ['check_collisions', 'drawLines', 'drawNames',
+                          'fix_collisions', 'playerStandings',
+                          'preventRematch', 'registerPlayers', 'reportRound',
+                          'swissPairings'])
+
+    def test_compare(self):
+        baseline = {'results': {'16': {'swissPairings': 0.1,
+                                       'drawNames': 0.001}}}
+        report = {'results': {'16': {'swissPairings': 0.2,
+                                     'drawNames': 0.003,
+                                     'reportRound': 0.5}}}
+        # too fast and new benchmarks aren't compared
+        self.assertEqual(benchmark.compare(report, baseline),
+                         [(16, 'swissPairings', 0.1, 0.2)])
+        self.assertEqual(benchmark.compare(report, baseline, 1.5), [])
+        # query benchmarks are keyed by number of matches
+        baseline['queries'] = {'1000000': {'playerHistory': 0.1}}
+        report['queries'] = {'1000000': {'playerHistory': 0.5}}
+        self.assertEqual(benchmark.compare(report, baseline, 1.5),
+                         [(1000000, 'playerHistory', 0.1, 0.5)])
+        # timings of other rounds, seed or backend aren't comparable
+        baseline['seed'] = 1
+        self.assertRaises(ValueError, benchmark.compare, report, baseline)
+
+
+class TestInstrument(unittest.TestCase):
+
+    def test_enable(self):
+        report_round = tournament.reportRound
+        instrument.enable()
+        tournament.useEngine()
+        try:
+            ids = tournament.registerPlayers(['testa', 'testb', 'testc'])
+            gen_and_run_html.gen_html(
+                [(i, 'test') for i in ids],
+                os.path.join(tempfile.mkdtemp(), 'tournament.html'))
+            tournament.reportRound(1, [(ids[0], ids[1]), (ids[2], None)])
+            list(tournament.iterStandings())
+            written = gen_and_run_html.flush()
+            instrument.end_round(1)
+        finally:
+            tournament.dropEngine()
+            instrument.disable()
+        t_round, counters = instrument.rounds[0]
+        self.assertEqual(t_round, 1)
+        self.assertEqual(counters['calls']['tournament.reportRound'][0], 1)
+        # generator is one call, however many rows it gives
+        self.assertEqual(counters['calls']['tournament.iterStandings'][0], 1)
+        self.assertEqual(counters['bytes_written'], written)
+        self.assertTrue(tournament.reportRound is report_round)
+
+    def test_dump_registered_once(self):
+        registered = []
+        register = atexit.register
+        atexit.register = registered.append
+        try:
+            instrument._registered = False
+            for _ in range(3):
+                instrument.enable(open(os.devnull, 'w'), [])
+                instrument.disable()
+        finally:
+            atexit.register = register
+            instrument._registered = False
+        self.assertEqual(registered, [instrument._dump_at_exit])
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_main(self):
+        folder = tempfile.mkdtemp()
+        players = os.path.join(folder, 'players.csv')
+        with open(players, 'w') as f:
+            f.write('name\ntesta\ntestb\ntestc\ntestd\n')
+        names = tournament.readNames(players)
+        self.assertEqual(names, ['testa', 'testb', 'testc', 'testd'])
+        standings_file = os.path.join(folder, 'standings.csv')
+        tournament.useEngine()
+        try:
+            standings = tournament.main(names=names, seed=1, html=None,
+                                        verbose=False,
+                                        standings_file=standings_file)
+            # the same seed gives the same tournament (with new ids)
+            again = tournament.main(names=names, seed=1, html=None,
+                                    verbose=False)
+            self.assertEqual([p[1:] for p in again],
+                             [p[1:] for p in standings])
+        finally:
+            tournament.dropEngine()
+        self.assertEqual([p[3] for p in standings], [2, 2, 2, 2])
+        lines = open(standings_file).read().splitlines()
+        self.assertEqual(lines[0], 'id,name,wins,matches')
+        self.assertEqual(len(lines), 5)
+
+    def test_arguments(self):
+        args = tournament.parseArguments(['import', 'players.csv', '-t', '2'])
+        self.assertEqual((args.players, args.tournament), ('players.csv', 2))
+        args = tournament.parseArguments(['import', 'players.csv'])
+        self.assertEqual(args.tournament, tournament.DEFAULT_TOURNAMENT)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_workers(self):
+        for worker in (Worker(), ProcessWorker()):
+            worker.submit(int, '1')
+            worker.submit(int, 'x')
+            self.assertRaises(ValueError, worker.wait)
+            # the error is raised once, next tasks run again
+            worker.submit(int, '2')
+            worker.close()
+
+    def test_main(self):
+        folder = tempfile.mkdtemp()
+        names = ['test%d' % i for i in xrange(9)]
+        brackets = []
+        tournament.useEngine()
+        try:
+            for pipeline in (False, True):
+                html = os.path.join(folder, '%s.html' % pipeline)
+                standings = tournament.main(names=names, seed=1, html=html,
+                                            browser=False, verbose=False,
+                                            pipeline=pipeline)
+                brackets.append(open(html).read())
+                tournament.waitForRounds()
+        finally:
+            tournament.dropEngine()
+        # the renderer process draws the same bracket
+        self.assertEqual(brackets[0], brackets[1])
+        self.assertEqual(len(standings), 9)
+
+
 if __name__ == '__main__':
     unittest.main()